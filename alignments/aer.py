@@ -6,6 +6,7 @@ Check the test function below for an example of how to use these helper function
 
 For test results, please use the official AER perl script.
 """
+import numpy as np
 
 def read_naacl_alignments(path):
     """
@@ -75,11 +76,90 @@ class AERSufficientStatistics:
         self.a += len(predicted)
         self.s += len(sure)
 
+    def merge(self, other):
+        """
+        Add the sufficient statistics of another (disjoint) set of sentences.
+
+        :param other: AERSufficientStatistics
+        :return: self
+        """
+        self.a_and_s += other.a_and_s
+        self.a_and_p += other.a_and_p
+        self.a += other.a
+        self.s += other.s
+        return self
+
     def aer(self):
         """Return alignment error rate: 1 - (|A & S| + |A & P|)/(|A| + |S|)"""
         return 1 - (self.a_and_s + self.a_and_p) / (self.a + self.s)
 
 
+class ValidationStatistics:
+    """
+    Sums of the validation metrics over a set of sentence pairs: the AER sufficient
+    statistics, the number of sentences, the number of target words and of correctly
+    predicted target words, and the total NLL, ELBO and KL. Statistics of disjoint sets of
+    sentence pairs, such as the shards of a test set, are combined with merge.
+    """
+
+    counters = ["num_sentences", "num_predictions", "num_correct_predictions", "total_NLL",
+                "total_ELBO", "total_KL"]
+
+    def __init__(self):
+        self.aer_statistics = AERSufficientStatistics()
+        for name in self.counters:
+            setattr(self, name, 0)
+
+    def merge(self, other):
+        """
+        Add the statistics of another (disjoint) set of sentence pairs.
+
+        :param other: ValidationStatistics
+        :return: self
+        """
+        self.aer_statistics.merge(other.aer_statistics)
+        for name in self.counters:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        return self
+
+
+def sentence_statistics(predicted_alignments, gold_alignments):
+    """
+    Return the AER sufficient statistics of every sentence.
+
+    :param predicted_alignments: list of sets of predicted links
+    :param gold_alignments: list of pairs [sure set, possible set], sentences with gold
+        alignments None are skipped
+    :return: an array [num_sentences, 4] of |A & S|, |A & P|, |A| and |S| per sentence
+    """
+    statistics = [(len(predicted & gold[0]), len(predicted & gold[1]), len(predicted),
+                   len(gold[0]))
+                  for predicted, gold in zip(predicted_alignments, gold_alignments)
+                  if gold is not None]
+    return np.array(statistics, dtype=np.int64).reshape(-1, 4)
+
+
+def bootstrap_aer(statistics, num_samples=1000, confidence=0.95, seed=0):
+    """
+    Estimate a confidence interval of the corpus AER with the percentile bootstrap, by
+    resampling the sentences with replacement.
+
+    :param statistics: the statistics of every sentence as returned by sentence_statistics
+    :return: the AER of the sentences and the lower and upper bound of the interval
+    """
+    def aer(totals):
+        return 1 - (totals[..., 0] + totals[..., 1]) / np.maximum(totals[..., 2] + totals[..., 3], 1)
+
+    if len(statistics) == 0:
+        raise Exception("Cannot bootstrap the AER of sentences without gold alignments.")
+    rng = np.random.RandomState(seed)
+    samples = rng.randint(0, len(statistics), size=(num_samples, len(statistics)))
+    sample_aers = aer(statistics[samples].sum(axis=1))
+    alpha = (1 - confidence) / 2
+    lower, upper = np.quantile(sample_aers, [alpha, 1 - alpha])
+    return float(aer(statistics.sum(axis=0))), float(lower), float(upper)
+
+
 def test(path):
     from random import random
     # 1. Read in gold alignments
@@ -1,13 +1,26 @@
 import torch
 
-from torch.utils.data import DataLoader
-
-from alignments.aer import AERSufficientStatistics
+from alignments.aer import ValidationStatistics
 from alignments.models import AlignmentVAE
-from alignments.data import PAD_TOKEN, create_batch
-from alignments.train_utils import alignment_summary
+from alignments.data import PAD_TOKEN, ValidationCache
+from alignments.dist import BitPackedAlignments
+from alignments.train_utils import create_validation_cache, fast_validation
+from alignments.train_utils import example_alignment, print_example_alignment
 
 def create_model(hparams, vocab_src, vocab_tgt):
+    if hparams.chunk_size > 0 or hparams.band_width >= 0 or hparams.num_candidates > 0:
+        if hparams.model_type not in ["bernoulli-RF", "bernoulli-ST"]:
+            raise Exception("chunk_size, band_width and num_candidates are not supported for"
+                            f" {hparams.model_type}")
+        if hparams.model_type == "bernoulli-RF" and \
+                (hparams.PPO_steps > 0 or hparams.RF_num_samples > 1):
+            raise Exception("chunk_size, band_width and num_candidates do not support"
+                            " PPO_steps > 0 or RF_num_samples > 1")
+        if hparams.num_candidates > 0 and (hparams.chunk_size > 0 or hparams.band_width >= 0):
+            raise Exception("num_candidates cannot be combined with chunk_size or band_width")
+        if hparams.compile:
+            raise Exception("compile cannot be combined with chunk_size, band_width or"
+                            " num_candidates")
     return AlignmentVAE(dist=hparams.model_type,
                         prior_params=(hparams.prior_param_1, hparams.prior_param_2),
                         src_vocab_size=vocab_src.size(),
@@ -19,101 +32,155 @@ def create_model(hparams, vocab_src, vocab_tgt):
                         bidirectional=hparams.bidirectional,
                         num_layers=hparams.num_layers,
                         cell_type=hparams.cell_type,
+                        encoder_type=hparams.encoder_type,
+                        num_heads=hparams.num_heads,
+                        checkpoint_activations=hparams.checkpoint_activations,
                         max_sentence_length=hparams.max_sentence_length,
                         use_mean_cv=hparams.cv_running_avg,
                         use_std_cv=hparams.cv_running_std,
-                        use_self_critic_cv=hparams.cv_self_critic)
+                        use_self_critic_cv=hparams.cv_self_critic,
+                        validate_args=hparams.debug,
+                        lexical_table=hparams.num_candidates > 0,
+                        output_layer=hparams.output_layer,
+                        adaptive_cutoffs=[int(cutoff) for cutoff in
+                                          hparams.adaptive_cutoffs.split(",") if cutoff.strip()],
+                        num_sampled=hparams.num_sampled,
+                        sparse_embeddings=hparams.sparse_embeddings)
 
 def train_step(model, x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y, hparams, step,
                summary_dict, summary_writer=None):
-    qa = model.approximate_posterior(x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y)
-    pa = model.prior(seq_mask_x, seq_len_x, seq_mask_y)
-    A = qa.rsample()
-    logits = model(x, A)
-
     if hparams.KL_annealing_steps > 0:
         KL_multiplier = min(1.0, float(step) / hparams.KL_annealing_steps)
     else:
         KL_multiplier = 1.0
 
-    output_dict = model.loss(logits=logits, x=x, y=y, A=A, seq_mask_x=seq_mask_x,
+    # Compute the loss block-wise over the target positions or only for candidate source
+    # positions, the full qa is never materialized.
+    if hparams.chunk_size > 0 or hparams.band_width >= 0 or hparams.num_candidates > 0:
+        if hparams.num_candidates > 0:
+            output_dict, A = model.candidate_loss(x, seq_mask_x, seq_len_x, y, seq_mask_y,
+                                                  seq_len_y, hparams.num_candidates,
+                                                  KL_multiplier=KL_multiplier, reduction="mean")
+        else:
+            output_dict, A = model.chunked_loss(x, seq_mask_x, seq_len_x, y, seq_mask_y,
+                                                seq_len_y, chunk_size=hparams.chunk_size,
+                                                band_width=hparams.band_width,
+                                                KL_multiplier=KL_multiplier, reduction="mean")
+        output_dict["A"] = BitPackedAlignments.pack(A)
+        output_dict["KL_multiplier"] = KL_multiplier
+        return summarize_train_step(model, output_dict, x, step, summary_dict, summary_writer)
+
+    qa = model.approximate_posterior(x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y)
+    pa = model.prior(seq_mask_x, seq_len_x, seq_mask_y)
+
+    # For REINFORCE, optionally draw multiple samples of A at once: [K, B, T_y, T_x].
+    num_samples = hparams.RF_num_samples if hparams.model_type == "bernoulli-RF" else 1
+    if num_samples > 1:
+        A = qa.sample((num_samples,))
+    else:
+        A = qa.rsample()
+
+    # Never align to padding positions.
+    cell_mask = (seq_mask_y.unsqueeze(-1) & seq_mask_x.unsqueeze(1)).type_as(A) # [B, T_y, T_x]
+    A = A * cell_mask
+
+    # The self-critic baseline shares the generative pass with the sampled alignments.
+    if hparams.model_type == "bernoulli-RF" and hparams.cv_self_critic and num_samples == 1:
+        pooled_x, critic_pooled_x = model.pool(x, A, A_critic=qa.mean.round() * cell_mask)
+    else:
+        pooled_x = model.pool(x, A)
+        critic_pooled_x = None
+
+    output_dict = model.loss(pooled_x=pooled_x, x=x, y=y, A=A, seq_mask_x=seq_mask_x,
                              seq_mask_y=seq_mask_y, pa=pa, qa=qa,
-                             KL_multiplier=KL_multiplier, reduction="mean")
-    output_dict["A"] = A
+                             KL_multiplier=KL_multiplier, reduction="mean",
+                             critic_pooled_x=critic_pooled_x)
+
+    # Only keep a bit-packed copy of the sampled alignments for PPO and the summaries.
+    output_dict["A"] = BitPackedAlignments.pack(A)
     output_dict["qa"] = qa
     output_dict["pa"] = qa
     output_dict["KL_multiplier"] = KL_multiplier
+    output_dict["num_samples"] = num_samples
+    return summarize_train_step(model, output_dict, x, step, summary_dict, summary_writer)
+
+def summarize_train_step(model, output_dict, x, step, summary_dict, summary_writer=None):
+    num_samples = output_dict.get("num_samples", 1)
 
-    # Keep track of training summary statistics.
+    # Keep track of training summary statistics. These are accumulated as tensors on the
+    # device and are only copied to the host when writing summaries.
     summary_dict["num_sentences"] += x.size(0)
-    summary_dict["KL"] += output_dict["KL"].sum().item()
-    summary_dict["ELBO"] += output_dict["ELBO"].sum().item()
+    summary_dict["KL"] += output_dict["KL"].detach().sum()
+    summary_dict["ELBO"] += output_dict["ELBO"].detach().sum()
     if "reward" in output_dict:
-        summary_dict["reward"] += output_dict["reward"].sum().item()
-        summary_dict["normalized_reward"] += output_dict["normalized_reward"].sum().item()
-        summary_dict["reward_var"] += output_dict["reward"].var().item()
-        summary_dict["normalized_reward_var"] += output_dict["normalized_reward"].var().item()
+        reward = output_dict["reward"].detach()
+        normalized_reward = output_dict["normalized_reward"].detach()
+        summary_dict["reward"] += reward.sum() / num_samples
+        summary_dict["normalized_reward"] += normalized_reward.sum() / num_samples
+        summary_dict["reward_var"] += reward.var()
+        summary_dict["normalized_reward_var"] += normalized_reward.var()
     if "reward_sc" in output_dict:
-        summary_dict["reward_sc"] += output_dict["reward_sc"].sum().item()
+        summary_dict["reward_sc"] += output_dict["reward_sc"].detach().sum()
 
     # Summarize if the summary writer is given.
     if summary_writer is not None:
-        summary_writer.add_scalar("train/KL", summary_dict["KL"] / summary_dict["num_sentences"], step)
-        summary_writer.add_scalar("train/ELBO", summary_dict["ELBO"] / summary_dict["num_sentences"], step)
-        summary_writer.add_scalar("train/reward", summary_dict["reward"] / summary_dict["num_sentences"], step)
-        summary_writer.add_scalar("train/reward_var", summary_dict["reward_var"] /\
-                summary_dict["num_sentences"], step)
-        summary_writer.add_scalar("train/normalized_reward", summary_dict["normalized_reward"] /\
-                summary_dict["num_sentences"], step)
-        summary_writer.add_scalar("train/normalized_reward_var", summary_dict["normalized_reward_var"] /\
-                summary_dict["num_sentences"], step)
+        num_sentences = summary_dict["num_sentences"]
+        for name in ["KL", "ELBO", "reward", "reward_var", "normalized_reward",
+                     "normalized_reward_var"]:
+            summary_writer.add_scalar(f"train/{name}", float(summary_dict[name]) / num_sentences,
+                                      step)
 
         if "reward" in output_dict:
             summary_writer.add_scalar("train/reward_mean_ma", model.avg_reward, step)
             summary_writer.add_scalar("train/reward_std_ma", model.std_reward, step)
-        summary_writer.add_histogram("train/p(A)", pa.probs, step)
-        summary_writer.add_histogram("train/q(A|x,y)", qa.probs, step)
-        summary_writer.add_histogram("train/sampled_A", A, step)
+        if "qa" in output_dict:
+            summary_writer.add_histogram("train/p(A)", output_dict["pa"].probs, step)
+            summary_writer.add_histogram("train/q(A|x,y)", output_dict["qa"].probs, step)
+        summary_writer.add_histogram("train/sampled_A", output_dict["A"].unpack(torch.float),
+                                     step)
         if "reward_sc" in output_dict:
-            summary_writer.add_scalar("train/reward_self_critic", summary_dict["reward_sc"] /\
-                    summary_dict["num_sentences"], step)
+            summary_writer.add_scalar("train/reward_self_critic",
+                                      float(summary_dict["reward_sc"]) / num_sentences, step)
 
     return output_dict
 
-def validate(model, val_data, gold_alignments, vocab_src, vocab_tgt, device,
-             hparams, step, summary_writer=None):
-
-    model.eval()
-
-    # Load the validation data.
-    val_dl = DataLoader(val_data, shuffle=False, batch_size=hparams.batch_size,
-                        num_workers=4)
-
-    total_correct_predictions = 0
-    total_predictions = 0.
-    num_sentences = 0
-    total_ELBO = 0.
-    total_KL = 0.
+def validation_statistics(model, val_data, hparams, fast=False):
+    """
+    Aligns the sentence pairs of a ValidationCache and sums the validation metrics. Returns
+    the ValidationStatistics and the alignments in the order of the validation batches. With
+    fast = True only the alignments and their AER statistics are computed.
+    """
+    statistics = ValidationStatistics()
     alignments = []
     with torch.no_grad():
-        for sen_x, sen_y in val_dl:
+        for x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y in val_data.batches:
 
             # Infer the mean A | x, y.
-            x, seq_mask_x, seq_len_x = create_batch(sen_x, vocab_src, device, include_null=False)
-            y, seq_mask_y, seq_len_y = create_batch(sen_y, vocab_tgt, device)
-            qa = model.approximate_posterior(x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y)
-            if "bernoulli" in hparams.model_type:
-                A = qa.mean.round() # [B, T_y, T_x]
-            elif hparams.model_type == "hardkuma":
-                zeros = torch.zeros_like(qa.base.a)
-                ones = torch.ones_like(qa.base.a)
-                p0 = qa.log_prob(zeros)
-                p1 = qa.log_prob(ones)
-                # pc = ones - p0 - p1
-                A = torch.where(p0 > p1, zeros, ones)
-                # A = torch.where(p0 > pc, A, ones) # only 0 if argmax(p0, p1, pc) = p0
+            if hparams.num_candidates > 0:
+
+                # Only the candidate source positions can be aligned.
+                qa, candidates, candidate_mask = model.candidate_posterior(
+                        x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y, hparams.num_candidates)
+                A = x.new_zeros(y.size(1), x.size(1), dtype=torch.float).repeat(x.size(0), 1, 1)
+                A.scatter_(2, candidates, qa.mean.round() * candidate_mask.type_as(A)) # [B, T_y, T_x]
             else:
-                raise NotImplementedError()
+                qa = model.approximate_posterior(x, seq_mask_x, seq_len_x, y, seq_mask_y,
+                                                 seq_len_y)
+                if "bernoulli" in hparams.model_type:
+                    A = qa.mean.round() # [B, T_y, T_x]
+                elif hparams.model_type == "hardkuma":
+                    zeros = torch.zeros_like(qa.base.a)
+                    ones = torch.ones_like(qa.base.a)
+                    p0 = qa.log_prob(zeros)
+                    p1 = qa.log_prob(ones)
+                    # pc = ones - p0 - p1
+                    A = torch.where(p0 > p1, zeros, ones)
+                    # A = torch.where(p0 > pc, A, ones) # only 0 if argmax(p0, p1, pc) = p0
+                else:
+                    raise NotImplementedError()
+            cell_mask = model.alignment_mask(seq_mask_x, seq_len_x, seq_mask_y, seq_len_y,
+                                             hparams.band_width).type_as(A)
+            A = A * cell_mask
 
             # Store the alignment links. A link is (src_word, tgt_word), don't store null alignments. Sentences
             # start at 1 (1-indexed).
@@ -124,34 +191,51 @@ def validate(model, val_data, gold_alignments, vocab_src, vocab_tgt, device,
                         if aji > 0:
                             links.add((i, j))
                 alignments.append(links)
+            if fast:
+                continue
 
             # Compute validation ELBO and KL.
-            logits = model(x, qa.sample())
-            pa = model.prior(seq_mask_x, seq_len_x, seq_mask_y)
-            output_dict = model.loss(logits=logits, x=x, y=y, A=A, seq_mask_x=seq_mask_x,
-                                     seq_mask_y=seq_mask_y, pa=pa, qa=qa)
-            total_ELBO += output_dict["ELBO"].sum().item()
-            total_KL += output_dict["KL"].sum().item()
-            num_sentences += x.size(0)
+            if hparams.num_candidates > 0:
+                output_dict, _ = model.candidate_loss(x, seq_mask_x, seq_len_x, y, seq_mask_y,
+                                                      seq_len_y, hparams.num_candidates)
+            elif hparams.chunk_size > 0 or hparams.band_width >= 0:
+                output_dict, _ = model.chunked_loss(x, seq_mask_x, seq_len_x, y, seq_mask_y,
+                                                    seq_len_y, chunk_size=hparams.chunk_size,
+                                                    band_width=hparams.band_width)
+            else:
+                pooled_x = model.pool(x, qa.sample() * cell_mask)
+                pa = model.prior(seq_mask_x, seq_len_x, seq_mask_y)
+                output_dict = model.loss(pooled_x=pooled_x, x=x, y=y, A=A, seq_mask_x=seq_mask_x,
+                                         seq_mask_y=seq_mask_y, pa=pa, qa=qa)
+            statistics.total_ELBO += output_dict["ELBO"].sum().item()
+            statistics.total_KL += output_dict["KL"].sum().item()
+            statistics.num_sentences += x.size(0)
 
             # Compute statistics for validation accuracy.
             logits = model(x, A)
             predictions = torch.argmax(logits, dim=-1, keepdim=False)
             correct_predictions = (predictions == y) * seq_mask_y
-            total_correct_predictions += correct_predictions.sum().item()
-            total_predictions += seq_len_y.sum().item()
+            statistics.num_correct_predictions += correct_predictions.sum().item()
+            statistics.num_predictions += seq_len_y.sum().item()
 
-    val_ELBO = total_ELBO / num_sentences
-    val_KL = total_KL / num_sentences
+    # Compute the AER statistics, the alignments are in the order of the validation batches.
+    for a, gold_a in zip(alignments, val_data.gold_alignments):
+        if gold_a is not None:
+            statistics.aer_statistics.update(sure=gold_a[0], probable=gold_a[1], predicted=a)
+    return statistics, alignments
 
-    # Compute AER.
-    metric = AERSufficientStatistics()
-    for a, gold_a in zip(alignments, gold_alignments):
-        metric.update(sure=gold_a[0], probable=gold_a[1], predicted=a)
-    val_aer = metric.aer()
+def report_validation(statistics, example, hparams, step, summary_writer=None):
+    """
+    Prints the validation metrics and an example alignment (a source sentence, target
+    sentence and alignment links triple, or None), writes validation summaries if a summary
+    writer is given and returns the validation AER.
+    """
+    val_ELBO = statistics.total_ELBO / statistics.num_sentences
+    val_KL = statistics.total_KL / statistics.num_sentences
+    val_aer = statistics.aer_statistics.aer()
 
     # Compute translation accuracy.
-    val_accuracy = total_correct_predictions / total_predictions
+    val_accuracy = statistics.num_correct_predictions / statistics.num_predictions
 
     # Write validation summaries if a summary writer is given.
     if summary_writer is not None:
@@ -167,18 +251,27 @@ def validate(model, val_data, gold_alignments, vocab_src, vocab_tgt, device,
           f" -- validation ELBO = {val_ELBO:,.2f} -- validation KL = {val_KL:,.2f}")
 
     # Print / plot a sample alignment.
-    sen_idx = hparams.example_sentence_idx
-    sen_x, sen_y = val_data[sen_idx]
-    sen_a = list(sorted(alignments[sen_idx], key=lambda link: link[1]))
-    tokens_x = sen_x.split()
-    tokens_y = sen_y.split()
-    print(f"Source sentence: {sen_x}\nTarget sentence: {sen_y}")
-    if len(sen_a) == 0:
-        print(" - no alignments")
-    else:
-        for link in sen_a:
-            print(f" - {tokens_y[link[1]-1]} is aligned to {tokens_x[link[0]-1]}")
-    if summary_writer is not None:
-        alignment_summary(tokens_x, tokens_y, sen_a, summary_writer, "validation/alignment", step)
+    if example is not None:
+        print_example_alignment(*example, step, summary_writer)
 
     return val_aer
+
+def validate(model, val_data, gold_alignments, vocab_src, vocab_tgt, device,
+             hparams, step, summary_writer=None, fast=False):
+    """
+    Returns the validation AER. With fast = True only the alignments are computed, and the
+    AER and the bounds of its bootstrap confidence interval are returned, see
+    fast_validation.
+    """
+    model.eval()
+
+    # Create the validation batches, unless they are cached already.
+    if not isinstance(val_data, ValidationCache):
+        val_data = create_validation_cache(val_data, gold_alignments, vocab_src, vocab_tgt,
+                                           device, hparams)
+
+    statistics, alignments = validation_statistics(model, val_data, hparams, fast=fast)
+    if fast:
+        return fast_validation(alignments, val_data, hparams, step, summary_writer)
+    example = example_alignment(val_data, alignments, hparams.example_sentence_idx)
+    return report_validation(statistics, example, hparams, step, summary_writer)
@@ -1 +1,2 @@
-from .encoders import RNNEncoder
+from .encoders import RNNEncoder, ConvEncoder, SelfAttentionEncoder, create_encoder
+from .lexical_table import LexicalTable
@@ -1,5 +1,7 @@
+import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from .utils import rnn_creation_fn
@@ -39,7 +41,11 @@ class RNNEncoder(nn.Module):
 
         return output, final_combined
 
-    def unsorted_forward(self, x_embed, hidden=None):
+    def unsorted_forward(self, x_embed, seq_mask=None, hidden=None):
+        """
+        Runs the RNN one time step at a time, the padding positions at the end of each
+        sentence do not influence the outputs of the words, so seq_mask is not used.
+        """
 
         outputs = []
         max_time = x_embed.size(1)
@@ -49,3 +55,115 @@ class RNNEncoder(nn.Module):
             outputs.append(out)
 
         return torch.cat(outputs, dim=1), hidden
+
+class ConvEncoder(nn.Module):
+    """
+    A stack of 1-dimensional gated convolutions with residual connections, that encodes all
+    positions in parallel. Each layer sees kernel_size // 2 words to either side, padding
+    positions are set to zero before every convolution so they do not leak into the
+    encodings of the words.
+    """
+
+    def __init__(self, emb_size, hidden_size, dropout=0., num_layers=1, kernel_size=3):
+        super().__init__()
+        if kernel_size % 2 == 0:
+            raise Exception(f"kernel_size must be odd, got {kernel_size}")
+        self.hidden_size = hidden_size
+        self.input_layer = nn.Linear(emb_size, hidden_size)
+        self.conv_layers = nn.ModuleList([nn.Conv1d(hidden_size, 2 * hidden_size, kernel_size,
+                                                    padding=kernel_size // 2)
+                                          for _ in range(num_layers)])
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, x_embed, seq_mask):
+        """
+        :param x_embed: [B, T, emb_size]
+        :param seq_mask: [B, T]
+        :returns: the encodings [B, T, hidden_size] and their masked average [B, hidden_size].
+        """
+        mask = seq_mask.unsqueeze(-1).type_as(x_embed) # [B, T, 1]
+        h = self.input_layer(x_embed)
+        for conv in self.conv_layers:
+            conv_input = self.dropout(h * mask).transpose(1, 2) # [B, hidden_size, T]
+            h = h + F.glu(conv(conv_input), dim=1).transpose(1, 2)
+        h = h * mask
+        final = h.sum(dim=1) / mask.sum(dim=1).clamp(min=1.)
+        return h, final
+
+    def unsorted_forward(self, x_embed, seq_mask):
+        return self(x_embed, seq_mask)
+
+class SelfAttentionEncoder(nn.Module):
+    """
+    A small Transformer encoder with sinusoidal position encodings, padding positions are
+    masked out of the self-attention.
+    """
+
+    def __init__(self, emb_size, hidden_size, dropout=0., num_layers=1, num_heads=4):
+        super().__init__()
+        if hidden_size % num_heads != 0:
+            raise Exception(f"hidden_size {hidden_size} must be divisible by num_heads"
+                            f" {num_heads}")
+        self.hidden_size = hidden_size
+        self.input_layer = nn.Linear(emb_size, hidden_size)
+        self.layers = nn.ModuleList([nn.TransformerEncoderLayer(hidden_size, num_heads,
+                                                                dim_feedforward=2 * hidden_size,
+                                                                dropout=dropout,
+                                                                batch_first=True,
+                                                                norm_first=True)
+                                     for _ in range(num_layers)])
+        self.final_norm = nn.LayerNorm(hidden_size)
+
+    def position_encodings(self, max_time, device):
+        """
+        Returns the sinusoidal position encodings [max_time, hidden_size].
+        """
+        positions = torch.arange(max_time, device=device, dtype=torch.float).unsqueeze(1)
+        frequencies = torch.exp(torch.arange(0, self.hidden_size, 2, device=device,
+                                             dtype=torch.float) *
+                                (-math.log(10000.) / self.hidden_size))
+        encodings = torch.zeros(max_time, self.hidden_size, device=device)
+        encodings[:, 0::2] = torch.sin(positions * frequencies)
+        encodings[:, 1::2] = torch.cos(positions * frequencies[:self.hidden_size // 2])
+        return encodings
+
+    def forward(self, x_embed, seq_mask):
+        """
+        :param x_embed: [B, T, emb_size]
+        :param seq_mask: [B, T]
+        :returns: the encodings [B, T, hidden_size] and their masked average [B, hidden_size].
+        """
+        h = self.input_layer(x_embed) + self.position_encodings(x_embed.size(1), x_embed.device)
+        padding_mask = ~seq_mask
+        for layer in self.layers:
+            h = layer(h, src_key_padding_mask=padding_mask)
+        mask = seq_mask.unsqueeze(-1).type_as(h)
+        h = self.final_norm(h) * mask
+        final = h.sum(dim=1) / mask.sum(dim=1).clamp(min=1.)
+        return h, final
+
+    def unsorted_forward(self, x_embed, seq_mask):
+        return self(x_embed, seq_mask)
+
+def create_encoder(encoder_type, emb_size, hidden_size, bidirectional=False, dropout=0.,
+                   num_layers=1, cell_type="lstm", num_heads=4, kernel_size=3):
+    """
+    Creates an encoder of the given type: rnn|conv|attention, returns the encoder
+    and the size of its encodings.
+    """
+    encoder_type = encoder_type.lower()
+    if encoder_type == "rnn":
+        encoder = RNNEncoder(emb_size=emb_size, hidden_size=hidden_size,
+                             bidirectional=bidirectional, dropout=dropout,
+                             num_layers=num_layers, cell_type=cell_type)
+        return encoder, hidden_size * 2 if bidirectional else hidden_size
+    elif encoder_type == "conv":
+        encoder = ConvEncoder(emb_size=emb_size, hidden_size=hidden_size, dropout=dropout,
+                              num_layers=num_layers, kernel_size=kernel_size)
+    elif encoder_type == "attention":
+        encoder = SelfAttentionEncoder(emb_size=emb_size, hidden_size=hidden_size,
+                                       dropout=dropout, num_layers=num_layers,
+                                       num_heads=num_heads)
+    else:
+        raise Exception(f"Unknown encoder_type option: {encoder_type}")
+    return encoder, hidden_size
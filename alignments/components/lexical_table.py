@@ -0,0 +1,166 @@
+import torch
+import torch.nn as nn
+import numpy as np
+
+from alignments.data import sentence_to_ids
+
+class LexicalTable(nn.Module):
+    """
+    Sparse table of lexical association scores in [0, 1] between source and target words,
+    that keeps the table_size highest scoring target words of each source word. It is
+    used to select candidate source positions for each target word.
+
+    The entries are stored as buffers sorted by the key src_id * tgt_vocab_size + tgt_id,
+    such that they can be looked up for a batch with searchsorted.
+    """
+
+    def __init__(self, src_vocab_size, tgt_vocab_size):
+        super().__init__()
+        self.src_vocab_size = src_vocab_size
+        self.tgt_vocab_size = tgt_vocab_size
+        self.register_buffer("keys", torch.zeros(0, dtype=torch.long))
+        self.register_buffer("scores", torch.zeros(0))
+
+    def set_entries(self, src_ids, tgt_ids, scores):
+        """
+        Replaces the table entries, all arguments are 1-dimensional arrays.
+        """
+        keys = torch.as_tensor(src_ids, dtype=torch.long) * self.tgt_vocab_size + \
+                torch.as_tensor(tgt_ids, dtype=torch.long)
+        keys, order = torch.sort(keys)
+        self.keys = keys.to(self.keys.device)
+        self.scores = torch.as_tensor(scores, dtype=torch.float)[order].to(self.scores.device)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # The number of entries is only known once the table is loaded.
+        for name in ["keys", "scores"]:
+            if prefix + name in state_dict:
+                buffer = getattr(self, name)
+                setattr(self, name, buffer.new_empty(state_dict[prefix + name].size()))
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, y):
+        """
+        :param x: source word ids [B, T_x]
+        :param y: target word ids [B, T_y]
+        :returns: the scores of all word pairs [B, T_y, T_x], 0 if not in the table.
+        """
+        keys = x.unsqueeze(1) * self.tgt_vocab_size + y.unsqueeze(-1) # [B, T_y, T_x]
+        if self.keys.numel() == 0:
+            return torch.zeros(keys.size(), device=keys.device)
+        idx = torch.searchsorted(self.keys, keys).clamp(max=self.keys.numel() - 1)
+        return torch.where(self.keys[idx] == keys, self.scores[idx], self.scores.new([0.]))
+
+    def candidates(self, x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y, num_candidates):
+        """
+        Selects the num_candidates highest scoring source positions for each target
+        position, ties are broken in favour of positions close to the diagonal.
+
+        :returns: the candidate source positions [B, T_y, k] and a mask of the valid
+                  candidates [B, T_y, k], with k = min(num_candidates, T_x).
+        """
+        with torch.no_grad():
+            scores = self(x, y)
+
+            # Relative distance to the diagonal in [0, 1].
+            i = (torch.arange(x.size(1), device=x.device).float() + 0.5).view(1, 1, -1)
+            j = (torch.arange(y.size(1), device=y.device).float() + 0.5).view(1, -1, 1)
+            distance = (i / seq_len_x.view(-1, 1, 1).float() - \
+                        j / seq_len_y.view(-1, 1, 1).float()).abs().clamp(max=1.)
+            scores = scores - 1e-6 * distance
+            scores = scores.masked_fill(~seq_mask_x.unsqueeze(1), -float("inf"))
+
+            values, candidates = torch.topk(scores, min(num_candidates, x.size(1)), dim=-1)
+            candidate_mask = (values > -float("inf")) & seq_mask_y.unsqueeze(-1)
+        return candidates, candidate_mask
+
+    @staticmethod
+    def from_cooccurrences(data, vocab_src, vocab_tgt, table_size, merge_every=10000):
+        """
+        Creates a table of Dice coefficients 2 * c(x, y) / (c(x) + c(y)) where c counts the
+        number of sentence pairs words (and word pairs) occur in.
+
+        :param data: a ParallelDataset or TokenizedParallelDataset.
+        """
+        src_vocab_size = vocab_src.size()
+        tgt_vocab_size = vocab_tgt.size()
+        src_counts = np.zeros(src_vocab_size)
+        tgt_counts = np.zeros(tgt_vocab_size)
+        pair_keys = np.zeros(0, dtype=np.int64)
+        pair_counts = np.zeros(0)
+
+        def merge(pair_keys, pair_counts, new_keys):
+            keys = np.concatenate([pair_keys] + new_keys)
+            counts = np.concatenate([pair_counts, np.ones(len(keys) - len(pair_keys))])
+            keys, inverse = np.unique(keys, return_inverse=True)
+            return keys, np.bincount(inverse, weights=counts)
+
+        new_keys = []
+        for idx in range(len(data)):
+            sen_x, sen_y = data[idx]
+            x = np.unique(sentence_to_ids(sen_x, vocab_src)).astype(np.int64)
+            y = np.unique(sentence_to_ids(sen_y, vocab_tgt)).astype(np.int64)
+            src_counts[x] += 1
+            tgt_counts[y] += 1
+            new_keys.append((x[:, np.newaxis] * tgt_vocab_size + y).ravel())
+            if len(new_keys) == merge_every:
+                pair_keys, pair_counts = merge(pair_keys, pair_counts, new_keys)
+                new_keys = []
+        pair_keys, pair_counts = merge(pair_keys, pair_counts, new_keys)
+
+        src_ids = pair_keys // tgt_vocab_size
+        tgt_ids = pair_keys % tgt_vocab_size
+        dice = 2. * pair_counts / (src_counts[src_ids] + tgt_counts[tgt_ids])
+
+        table = LexicalTable(src_vocab_size, tgt_vocab_size)
+        keep = LexicalTable._top_entries(src_ids, dice, table_size)
+        table.set_entries(src_ids[keep], tgt_ids[keep], dice[keep])
+        return table
+
+    @staticmethod
+    def from_neuralibm1(model, vocab_src, vocab_tgt, model_vocab_src, model_vocab_tgt,
+                        table_size, batch_size=1024):
+        """
+        Creates a table of the translation probabilities P(y|x) of a trained NeuralIBM1. The
+        model can use different vocabularies, words are mapped between them.
+        """
+        table = LexicalTable(vocab_src.size(), vocab_tgt.size())
+
+        # Map model target ids to target ids, -1 if not in the vocabulary.
+        tgt_map = np.full(model_vocab_tgt.size(), -1, dtype=np.int64)
+        for idx in range(model_vocab_tgt.size()):
+            word = model_vocab_tgt.word(idx)
+            if word in vocab_tgt.word_to_idx:
+                tgt_map[idx] = vocab_tgt.word_to_idx[word]
+
+        src_ids, tgt_ids, scores = [], [], []
+        device = next(model.parameters()).device
+        with torch.no_grad():
+            for start in range(0, vocab_src.size(), batch_size):
+                src_batch = np.arange(start, min(start + batch_size, vocab_src.size()))
+                model_src = torch.tensor([model_vocab_src[vocab_src.word(idx)]
+                                          for idx in src_batch], device=device)
+                probs = model.translation_layer(model.src_embedder(model_src)) # [b, V_y']
+                probs, model_tgt = torch.topk(probs, min(table_size, probs.size(-1)), dim=-1)
+                tgt = tgt_map[model_tgt.cpu().numpy()]
+                valid = tgt >= 0
+                src_ids.append(np.repeat(src_batch[:, np.newaxis], tgt.shape[1], axis=1)[valid])
+                tgt_ids.append(tgt[valid])
+                scores.append(probs.cpu().numpy()[valid])
+
+        table.set_entries(np.concatenate(src_ids), np.concatenate(tgt_ids),
+                          np.concatenate(scores))
+        return table
+
+    @staticmethod
+    def _top_entries(src_ids, scores, table_size):
+        """
+        Returns a mask of the table_size highest scoring entries of each source word.
+        """
+        order = np.lexsort((-scores, src_ids))
+        sorted_src = src_ids[order]
+        group_start = np.searchsorted(sorted_src, sorted_src, side="left")
+        rank = np.arange(len(order)) - group_start
+        keep = np.zeros(len(order), dtype=bool)
+        keep[order[rank < table_size]] = True
+        return keep
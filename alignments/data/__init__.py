@@ -1,10 +1,16 @@
 from .constants import UNK_TOKEN, PAD_TOKEN, NULL_TOKEN
 
 from .vocabulary import Vocabulary
-from .datasets import ParallelDataset
+from .datasets import ParallelDataset, TokenizedParallelDataset
 from .bucketing import BucketingParallelDataLoader, BucketingTextDataLoader
+from .prefetch import BatchPrefetcher
+from .validation import ValidationCache
 from .utils import create_batch, batch_to_sentences, remove_subword_tokens
+from .utils import sentence_to_ids, sentence_length, collate_sentences
 
 __all__ = ["UNK_TOKEN", "PAD_TOKEN", "SOS_TOKEN", "EOS_TOKEN", "Vocabulary", "ParallelDataset",
-           "TextDataset", "BucketingParallelDataLoader", "BucketingTextDataLoader",
-           "create_batch", "batch_to_sentences", "remove_subword_tokens"]
+           "TokenizedParallelDataset", "TextDataset", "BucketingParallelDataLoader",
+           "BucketingTextDataLoader", "BatchPrefetcher",
+           "ValidationCache",
+           "create_batch", "batch_to_sentences", "remove_subword_tokens",
+           "sentence_to_ids", "sentence_length", "collate_sentences"]
@@ -1,5 +1,19 @@
 import numpy as np
 
+from .utils import sentence_length
+
+def _to_array(sentences):
+    """
+    Sentences given as tensors of word ids are stored as objects, as numpy would try to
+    stack them otherwise.
+    """
+    if len(sentences) > 0 and isinstance(sentences[0], str):
+        return np.array(sentences)
+    array = np.empty(len(sentences), dtype=object)
+    for idx, sentence in enumerate(sentences):
+        array[idx] = sentence
+    return array
+
 class BucketingParallelDataLoader:
 
     def __init__(self, dataloader, n=20):
@@ -30,11 +44,11 @@ class BucketingParallelDataLoader:
             raise StopIteration
 
         sort_keys = sorted(range(len(src_batches)),
-                            key=lambda idx: (len(src_batches[idx].split()),
-                                            len(tgt_batches[idx].split())),
+                            key=lambda idx: (sentence_length(src_batches[idx]),
+                                            sentence_length(tgt_batches[idx])),
                             reverse=True)
-        src_batches = np.array(src_batches)
-        tgt_batches = np.array(tgt_batches)
+        src_batches = _to_array(src_batches)
+        tgt_batches = _to_array(tgt_batches)
 
         self.sorted_src_batches = src_batches[sort_keys]
         self.sorted_tgt_batches = tgt_batches[sort_keys]
@@ -1,9 +1,56 @@
+import array
+import torch
+
 from torch.utils.data import Dataset
 
+class SentencePairBuffer:
+    """
+    List-like store of sentence pairs that keeps the UTF-8 encoded sentences in two
+    contiguous byte buffers with an array of offsets, rather than as one tuple of two
+    strings per pair. Sentences are decoded from a slice of the buffer when they are
+    accessed. As the buffers are single objects, forked DataLoader workers do not touch the
+    pages that hold the sentences when they update reference counts, so those pages are not
+    copied into each worker.
+    """
+
+    def __init__(self):
+        self.src_bytes = bytearray()
+        self.tgt_bytes = bytearray()
+        self.src_offsets = array.array("q", [0])
+        self.tgt_offsets = array.array("q", [0])
+
+    def append(self, pair):
+        src, tgt = pair
+        self.src_bytes += src.encode("utf-8")
+        self.tgt_bytes += tgt.encode("utf-8")
+        self.src_offsets.append(len(self.src_bytes))
+        self.tgt_offsets.append(len(self.tgt_bytes))
+
+    def __len__(self):
+        return len(self.src_offsets) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("SentencePairBuffer index out of range")
+        src = self.src_bytes[self.src_offsets[idx]:self.src_offsets[idx + 1]]
+        tgt = self.tgt_bytes[self.tgt_offsets[idx]:self.tgt_offsets[idx + 1]]
+        return src.decode("utf-8"), tgt.decode("utf-8")
+
 class ParallelDataset(Dataset):
 
-    def __init__(self, src_file, tgt_file, max_length=-1, min_length=0):
-        self.data = []
+    def __init__(self, src_file, tgt_file, max_length=-1, min_length=0, storage="list"):
+        """
+        :param storage: how the sentences are kept in memory, list for a list of string
+                        pairs or buffer for a SentencePairBuffer.
+        """
+        if storage == "list":
+            self.data = []
+        elif storage == "buffer":
+            self.data = SentencePairBuffer()
+        else:
+            raise Exception(f"Unknown storage option: {storage}")
         with open(src_file) as sf, open(tgt_file) as tf:
             for src, tgt in zip(sf, tf):
                 src = src.strip()
@@ -19,3 +66,42 @@ class ParallelDataset(Dataset):
 
     def __getitem__(self, idx):
         return self.data[idx]
+
+class TokenizedParallelDataset(Dataset):
+    """
+    A parallel dataset of which the sentences are encoded as word ids once, and stored in
+    two flat tensors with the offset of each sentence. It can be moved to shared memory with
+    share_memory_ and then used by several processes without copying it. Sentence pairs are
+    returned as two tensors of word ids, which create_batch accepts in place of strings.
+    """
+
+    def __init__(self, dataset, vocab_src, vocab_tgt):
+        """
+        :param dataset: a ParallelDataset.
+        """
+        src_ids, tgt_ids = [], []
+        src_lengths, tgt_lengths = [0], [0]
+        for idx in range(len(dataset)):
+            src, tgt = dataset[idx]
+            src = [vocab_src[word] for word in src.split()]
+            tgt = [vocab_tgt[word] for word in tgt.split()]
+            src_ids += src
+            tgt_ids += tgt
+            src_lengths.append(len(src))
+            tgt_lengths.append(len(tgt))
+        self.src_ids = torch.tensor(src_ids, dtype=torch.int32)
+        self.tgt_ids = torch.tensor(tgt_ids, dtype=torch.int32)
+        self.src_offsets = torch.tensor(src_lengths).cumsum(dim=0)
+        self.tgt_offsets = torch.tensor(tgt_lengths).cumsum(dim=0)
+
+    def share_memory_(self):
+        for tensor in [self.src_ids, self.tgt_ids, self.src_offsets, self.tgt_offsets]:
+            tensor.share_memory_()
+        return self
+
+    def __len__(self):
+        return len(self.src_offsets) - 1
+
+    def __getitem__(self, idx):
+        return (self.src_ids[self.src_offsets[idx]:self.src_offsets[idx + 1]],
+                self.tgt_ids[self.tgt_offsets[idx]:self.tgt_offsets[idx + 1]])
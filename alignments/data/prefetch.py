@@ -0,0 +1,72 @@
+import queue
+import threading
+
+from .utils import create_batch
+
+class BatchPrefetcher:
+    """
+    Iterates over the padded batches of word ids of an iterator over sentence batches, such
+    as a BucketingParallelDataLoader, for one epoch. With num_batches > 0 a background thread
+    tokenizes, pads and tensorizes up to num_batches batches ahead while the model trains on
+    the current batch, and only the copy to the device is left for the training loop. Most
+    of the time of a training step is spent in PyTorch operators that release the GIL, so the
+    thread overlaps with it. With num_batches = 0 batches are created when they are needed.
+    """
+
+    # Marks the end of the epoch in the queue.
+    _end_of_epoch = object()
+
+    def __init__(self, batches, vocab_src, vocab_tgt, device, num_batches=0, include_null=False,
+                 word_dropout=0., length_buckets=None):
+        """
+        :param include_null, word_dropout, length_buckets: see create_batch, word_dropout
+                                                            only applies to the source side.
+        """
+        self.batches = iter(batches)
+        self.vocab_src = vocab_src
+        self.vocab_tgt = vocab_tgt
+        self.device = device
+        self.include_null = include_null
+        self.word_dropout = word_dropout
+        self.length_buckets = length_buckets
+        self.queue = None
+        if num_batches > 0:
+            self.queue = queue.Queue(maxsize=num_batches)
+            self.thread = threading.Thread(target=self._prefetch, daemon=True)
+            self.thread.start()
+
+    def _create_batch(self, sentences_x, sentences_y, device):
+        x, seq_mask_x, seq_len_x = create_batch(sentences_x, self.vocab_src, device,
+                                                include_null=self.include_null,
+                                                word_dropout=self.word_dropout,
+                                                length_buckets=self.length_buckets)
+        y, seq_mask_y, seq_len_y = create_batch(sentences_y, self.vocab_tgt, device,
+                                                length_buckets=self.length_buckets)
+        return x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y
+
+    def _prefetch(self):
+        try:
+            for sentences_x, sentences_y in self.batches:
+                batch = self._create_batch(sentences_x, sentences_y, "cpu")
+                if self.device.type == "cuda":
+                    batch = tuple(tensor.pin_memory() for tensor in batch)
+                self.queue.put(batch)
+            self.queue.put(self._end_of_epoch)
+        except Exception as e:
+            self.queue.put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.queue is None:
+            sentences_x, sentences_y = next(self.batches)
+            return self._create_batch(sentences_x, sentences_y, self.device)
+
+        batch = self.queue.get()
+        if batch is self._end_of_epoch:
+            self.queue.put(batch)
+            raise StopIteration
+        if isinstance(batch, Exception):
+            raise batch
+        return tuple(tensor.to(self.device, non_blocking=True) for tensor in batch)
@@ -4,25 +4,29 @@ import numpy as np
 
 from .constants import UNK_TOKEN, PAD_TOKEN, NULL_TOKEN
 
-def create_batch(sentences, vocab, device, include_null=False, word_dropout=0.):
+def create_batch(sentences, vocab, device, include_null=False, word_dropout=0.,
+                 length_buckets=None):
     """
     Converts a list of sentences to a padded batch of word ids. Returns
     a batch of word ids, a sequence mask and a tensor containing the
     sequence length of each batch element.
-    :param sentences: a list of sentences, each a list of token ids
+    :param sentences: a list of sentences, each a string or a tensor of word ids
     :param vocab: a Vocabulary object for this dataset
     :param device: 
     :param word_dropout: rate at which we omit words from the context (input)
+    :param length_buckets: optional sorted list of lengths, the batch is padded to the
+                           smallest of these that fits the longest sentence, such that
+                           batches only come in a few shapes.
     :returns: a padded batch of word ids, mask, lengths
     """
-    null_token = [NULL_TOKEN] if include_null else []
-    tok = np.array([null_token + sen.split() for sen in sentences])
-    seq_lengths = [len(sen) for sen in tok]
+    null_token = [vocab[NULL_TOKEN]] if include_null else []
+    word_ids = [null_token + sentence_to_ids(sen, vocab) for sen in sentences]
+    seq_lengths = [len(sen) for sen in word_ids]
     max_len = max(seq_lengths)
+    if length_buckets:
+        max_len = next((length for length in length_buckets if length >= max_len), max_len)
     pad_id = vocab[PAD_TOKEN]
-    batch = [
-        [vocab[sen[t]] if t < seq_lengths[idx] else pad_id for t in range(max_len)]
-            for idx, sen in enumerate(tok)]
+    batch = [sen + [pad_id] * (max_len - len(sen)) for sen in word_ids]
 
     # Replace words of the input with <unk> with p = word_dropout.
     if word_dropout > 0.:
@@ -43,6 +47,29 @@ def create_batch(sentences, vocab, device, include_null=False, word_dropout=0.):
 
     return batch, seq_mask, seq_length
 
+def sentence_to_ids(sentence, vocab):
+    """
+    Returns the word ids of a sentence given as a string or as a tensor of word ids.
+    """
+    if isinstance(sentence, str):
+        return [vocab[word] for word in sentence.split()]
+    return sentence.tolist()
+
+def sentence_length(sentence):
+    """
+    Returns the number of words in a sentence given as a string or as a tensor of word ids.
+    """
+    return len(sentence.split()) if isinstance(sentence, str) else len(sentence)
+
+def collate_sentences(batch):
+    """
+    Collates a list of sentence pairs into a list of source and a list of target sentences,
+    without stacking the sentences, for DataLoaders over a ParallelDataset or
+    TokenizedParallelDataset.
+    """
+    sentences_x, sentences_y = zip(*batch)
+    return list(sentences_x), list(sentences_y)
+
 def batch_to_sentences(tensors, vocab, no_filter=False):
     """
     Converts a batch of word ids back to sentences.
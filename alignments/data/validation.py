@@ -0,0 +1,66 @@
+import numpy as np
+
+from torch.utils.data import Subset
+
+from .utils import create_batch, sentence_length
+
+class ValidationCache:
+    """
+    The validation data as padded batches of word ids on the device, created once and reused
+    for every evaluation. The sentence pairs are sorted by length before they are batched to
+    reduce padding, and the gold alignments are put in the same order. Indexing returns the
+    sentence pairs in their original order, positions maps an original index to its position
+    in the batches.
+    """
+
+    def __init__(self, dataset, gold_alignments, vocab_src, vocab_tgt, device, batch_size,
+                 include_null=False):
+        """
+        :param dataset: a ParallelDataset.
+        :param gold_alignments: the gold alignments of the sentence pairs in dataset, as read
+                                by read_naacl_alignments. Sentence pairs without gold
+                                alignments (None or past the end) get None.
+        """
+        self.dataset = dataset
+        self.vocab_src = vocab_src
+        self.vocab_tgt = vocab_tgt
+        self.device = device
+        self.batch_size = batch_size
+        self.include_null = include_null
+        lengths = [(sentence_length(sen_x), sentence_length(sen_y)) for sen_x, sen_y in
+                   (dataset[idx] for idx in range(len(dataset)))]
+        self.order = sorted(range(len(dataset)), key=lambda idx: lengths[idx], reverse=True)
+        self.positions = [0] * len(dataset)
+        for position, idx in enumerate(self.order):
+            self.positions[idx] = position
+        self.gold_alignments = [gold_alignments[idx] if idx < len(gold_alignments) else None
+                                for idx in self.order]
+
+        self.batches = []
+        for start in range(0, len(self.order), batch_size):
+            pairs = [dataset[idx] for idx in self.order[start:start + batch_size]]
+            x, seq_mask_x, seq_len_x = create_batch([pair[0] for pair in pairs], vocab_src,
+                                                    device, include_null=include_null)
+            y, seq_mask_y, seq_len_y = create_batch([pair[1] for pair in pairs], vocab_tgt,
+                                                    device)
+            self.batches.append((x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y))
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return self.dataset[idx]
+
+    def subsample(self, num_sentences, seed=0):
+        """
+        Returns a ValidationCache of a fixed subsample of num_sentences sentence pairs that is
+        stratified by length: the length-sorted sentence pairs are split into num_sentences
+        strata of consecutive pairs and one pair is drawn from every stratum.
+        """
+        rng = np.random.RandomState(seed)
+        strata = np.array_split(np.array(self.order), min(num_sentences, len(self)))
+        indices = sorted(int(rng.choice(stratum)) for stratum in strata)
+        gold_alignments = [self.gold_alignments[self.positions[idx]] for idx in indices]
+        return ValidationCache(Subset(self.dataset, indices), gold_alignments, self.vocab_src,
+                               self.vocab_tgt, self.device, self.batch_size,
+                               include_null=self.include_null)
@@ -1 +1,3 @@
-from .bernoulli import BernoulliREINFORCE, BernoulliStraightThrough
+from .bernoulli import PackedBernoulli, BernoulliREINFORCE, BernoulliStraightThrough
+from .bernoulli import bernoulli_log_prob, bernoulli_kl
+from .cells import AlignmentCells, DenseAlignmentCells, BitPackedAlignments, alignment_cells
@@ -1,12 +1,64 @@
 import torch
+import torch.nn.functional as F
 
-class BernoulliStraightThrough(torch.distributions.Bernoulli):
+from torch.distributions.kl import register_kl
+
+def bernoulli_log_prob(logits, value):
+    """
+    Closed-form log-probability of value under Bernoulli(logits=logits).
+    """
+    return value * logits - F.softplus(logits)
+
+def bernoulli_kl(q_logits, p_logits):
+    """
+    Closed-form KL(q||p) between Bernoulli distributions given by their logits, the
+    parameters are broadcast against each other.
+    """
+    q_probs = torch.sigmoid(q_logits)
+    return q_probs * (F.softplus(-p_logits) - F.softplus(-q_logits)) + \
+            (1. - q_probs) * (F.softplus(p_logits) - F.softplus(q_logits))
+
+class PackedBernoulli(torch.distributions.Bernoulli):
+    """
+    Bernoulli distribution over alignment matrices with closed-form log-probabilities and
+    KL divergences that are only computed for the valid cells of an AlignmentCells index (or
+    for all cells of a DenseAlignmentCells, whose sums mask out the invalid ones).
+    """
+
+    def packed_log_prob(self, value, cells):
+        """
+        :param value: [..., B, T_y, T_x]
+        :param cells: AlignmentCells
+        :returns: log-probabilities of the valid cells [..., N]
+        """
+        return bernoulli_log_prob(cells.gather(self.logits), cells.gather(value))
+
+    def packed_kl(self, p, cells):
+        """
+        :param p: Bernoulli distribution, its parameters are broadcast to [B, T_y, T_x].
+        :param cells: AlignmentCells
+        :returns: KL(self||p) for the valid cells [N]
+        """
+        return bernoulli_kl(cells.gather(self.logits), cells.gather(p.logits))
+
+class BernoulliStraightThrough(PackedBernoulli):
 
     def rsample(self, sample_shape=torch.Size()):
         return (super(BernoulliStraightThrough, self).sample(sample_shape) - self.probs).detach() + self.probs
 
 
-class BernoulliREINFORCE(torch.distributions.Bernoulli):
+class BernoulliREINFORCE(PackedBernoulli):
 
     def rsample(self, sample_shape=torch.Size()):
         return self.sample(sample_shape)
+
+
+@register_kl(torch.distributions.Bernoulli, BernoulliREINFORCE)
+def kl_bernoulli_bernoulli(q, p):
+    """
+    Closed-form KL(q||p) between Bernoulli distributions. Unlike the default implementation
+    this broadcasts the parameters of p, such that p can be given with singleton dimensions
+    (e.g. a prior of shape [B, 1, T_x] against a posterior of shape [B, T_y, T_x]) without
+    materializing it at the full size.
+    """
+    return bernoulli_kl(q.logits, p.logits)
@@ -0,0 +1,151 @@
+import torch
+
+class AlignmentCells:
+    """
+    A packed index of the valid (b, j, i) cells of a batch of [B, T_y, T_x] alignment
+    matrices, i.e. the cells where both target position j and source position i are not
+    padding. Used to compute per-cell quantities only for the N valid cells and to reduce
+    them back to per target position or per sentence sums.
+    """
+
+    def __init__(self, seq_mask_x, seq_mask_y):
+        """
+        :param seq_mask_x: [B, T_x]
+        :param seq_mask_y: [B, T_y]
+        """
+        self.mask = seq_mask_y.unsqueeze(-1) & seq_mask_x.unsqueeze(1) # [B, T_y, T_x]
+        self.shape = self.mask.shape
+        self.b, self.j, self.i = self.mask.nonzero(as_tuple=True) # [N] each
+        self.rows = self.b * self.shape[1] + self.j # [N]
+
+    def __len__(self):
+        return self.b.size(0)
+
+    def gather(self, tensor):
+        """
+        :param tensor: [..., B, T_y, T_x], singleton dimensions are broadcast, e.g. a
+                       prior of shape [B, 1, T_x]. Can also be BitPackedAlignments.
+        :returns: the values at the valid cells [..., N]
+        """
+        if isinstance(tensor, BitPackedAlignments):
+            return tensor.gather(self)
+        tensor = tensor.expand(*tensor.shape[:-3], *self.shape)
+        return tensor[..., self.b, self.j, self.i]
+
+    def sum_rows(self, values):
+        """
+        :param values: [..., N]
+        :returns: sums over the source positions of each target position [..., B, T_y]
+        """
+        B, T_y, _ = self.shape
+        sums = values.new_zeros(*values.shape[:-1], B * T_y)
+        sums = sums.index_add(-1, self.rows, values)
+        return sums.view(*values.shape[:-1], B, T_y)
+
+    def sum_batch(self, values):
+        """
+        :param values: [..., N]
+        :returns: sums over all cells of each batch element [..., B]
+        """
+        sums = values.new_zeros(*values.shape[:-1], self.shape[0])
+        return sums.index_add(-1, self.b, values)
+
+class DenseAlignmentCells:
+    """
+    The same interface as AlignmentCells on the padded [B, T_y, T_x] grid: gather returns
+    the full grid and the invalid cells are masked out when values are summed. Unlike the
+    packed index this does not depend on the number of valid cells, so it does not
+    synchronize with an accelerator.
+    """
+
+    def __init__(self, seq_mask_x, seq_mask_y):
+        """
+        :param seq_mask_x: [B, T_x]
+        :param seq_mask_y: [B, T_y]
+        """
+        self.mask = seq_mask_y.unsqueeze(-1) & seq_mask_x.unsqueeze(1) # [B, T_y, T_x]
+        self.shape = self.mask.shape
+
+    def gather(self, tensor):
+        """
+        :param tensor: [..., B, T_y, T_x], singleton dimensions are broadcast. Can also be
+                       BitPackedAlignments.
+        :returns: the values at all cells [..., B, T_y, T_x]
+        """
+        if isinstance(tensor, BitPackedAlignments):
+            return tensor.unpack(torch.float)
+        return tensor.expand(*tensor.shape[:-3], *self.shape)
+
+    def sum_rows(self, values):
+        """
+        :param values: [..., B, T_y, T_x]
+        :returns: sums over the valid source positions of each target position [..., B, T_y]
+        """
+        return torch.where(self.mask, values, values.new_zeros([1])).sum(dim=-1)
+
+    def sum_batch(self, values):
+        """
+        :param values: [..., B, T_y, T_x]
+        :returns: sums over the valid cells of each batch element [..., B]
+        """
+        return self.sum_rows(values).sum(dim=-1)
+
+def alignment_cells(seq_mask_x, seq_mask_y):
+    """
+    Returns a packed AlignmentCells index on the CPU. On accelerators the packed index would
+    synchronize with the device, as its size depends on the data, so a DenseAlignmentCells
+    is returned instead.
+    """
+    if seq_mask_x.device.type == "cpu":
+        return AlignmentCells(seq_mask_x, seq_mask_y)
+    return DenseAlignmentCells(seq_mask_x, seq_mask_y)
+
+class BitPackedAlignments:
+    """
+    Compact storage of binary alignment matrices [..., T_y, T_x] that packs 8 source
+    positions into each byte, i.e. [..., T_y, ceil(T_x / 8)] uint8. This is 32 times smaller
+    than a float matrix, and the valid cells can be read without unpacking the full matrix.
+    """
+
+    def __init__(self, bits, num_cols):
+        """
+        :param bits: [..., T_y, ceil(T_x / 8)] uint8, bit k of byte c holds column 8c + k.
+        :param num_cols: T_x
+        """
+        self.bits = bits
+        self.num_cols = num_cols
+
+    @staticmethod
+    def pack(A):
+        """
+        :param A: [..., T_y, T_x], non-zero entries are alignments.
+        """
+        T_x = A.size(-1)
+        A = A.detach() != 0
+        padding = -T_x % 8
+        if padding > 0:
+            A = torch.cat([A, A.new_zeros(*A.shape[:-1], padding)], dim=-1)
+        A = A.view(*A.shape[:-1], -1, 8).to(torch.uint8)
+        shifts = torch.arange(8, dtype=torch.uint8, device=A.device)
+        return BitPackedAlignments((A << shifts).sum(dim=-1, dtype=torch.uint8), T_x)
+
+    @property
+    def shape(self):
+        return torch.Size([*self.bits.shape[:-1], self.num_cols])
+
+    def unpack(self, dtype=torch.bool):
+        """
+        :returns: the alignment matrices [..., T_y, T_x] of the given dtype.
+        """
+        shifts = torch.arange(8, dtype=torch.uint8, device=self.bits.device)
+        A = (self.bits.unsqueeze(-1) >> shifts) & 1 # [..., T_y, ceil(T_x / 8), 8]
+        A = A.view(*self.bits.shape[:-1], -1)[..., :self.num_cols]
+        return A.to(dtype)
+
+    def gather(self, cells):
+        """
+        :param cells: AlignmentCells
+        :returns: the alignments at the valid cells as floats [..., N]
+        """
+        byte = self.bits[..., cells.b, cells.j, cells.i // 8]
+        return ((byte >> (cells.i % 8).to(torch.uint8)) & 1).float()
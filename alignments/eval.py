@@ -1,13 +1,88 @@
+import os
 import torch
+import torch.multiprocessing as multiprocessing
 
 from pathlib import Path
 
-from alignments.aer import read_naacl_alignments
+import alignments.neuralibm1_helper as neuralibm1_helper
+import alignments.alignmentvae_helper as alignmentvae_helper
+
+from alignments.aer import read_naacl_alignments, ValidationStatistics
 from alignments.hparams import Hyperparameters
 from alignments.train import create_model
-from alignments.train_utils import load_vocabularies
+from alignments.train_utils import load_vocabularies, create_validation_cache, core_sets
+from alignments.train_utils import example_alignment
 from alignments.data import ParallelDataset
 
+def validation_helper(hparams):
+    """
+    Returns the helper module with the validation functions of the model.
+    """
+    return neuralibm1_helper if hparams.model_type == "neuralibm1" else alignmentvae_helper
+
+def evaluate_shard(hparams, vocab_src, vocab_tgt, model_checkpoint, sentence_pairs,
+                   gold_alignments, example_idx, cores):
+    """
+    Aligns and scores a shard of the validation data on the given cores. Returns the
+    ValidationStatistics of the shard, and the example alignment if example_idx is the index
+    of the example sentence pair in the shard (otherwise None).
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    device = torch.device("cuda:0") if hparams.use_gpu else torch.device("cpu")
+    model, _, _ = create_model(hparams, vocab_src, vocab_tgt)
+    model.load_state_dict(torch.load(model_checkpoint, map_location=device))
+    model = model.to(device)
+    model.eval()
+
+    shard = create_validation_cache(sentence_pairs, gold_alignments, vocab_src, vocab_tgt,
+                                    device, hparams)
+    statistics, alignments = validation_helper(hparams).validation_statistics(model, shard,
+                                                                              hparams)
+    example = None
+    if example_idx is not None:
+        example = example_alignment(shard, alignments, example_idx)
+    return statistics, example
+
+def sharded_evaluation(hparams, vocab_src, vocab_tgt, model_checkpoint, val_data,
+                       gold_alignments):
+    """
+    Splits the validation data over eval_shards processes, each pinned to its own set of
+    cores, and merges the statistics of the shards. Sentence pairs are dealt round-robin, such
+    that all shards get a similar mix of sentence lengths. Returns the validation AER.
+    """
+    if hparams.num_replicas > 1:
+        raise Exception("eval_shards > 1 is not supported for num_replicas > 1")
+    shard_cores = core_sets(hparams.eval_shards)
+    num_shards = len(shard_cores)
+    print(f"Evaluating {len(val_data):,} sentence pairs in {num_shards} shards\n")
+    # Only the shard that holds the example sentence pair, if it exists, returns its alignment.
+    example_sentence_idx = hparams.example_sentence_idx
+    has_example = 0 <= example_sentence_idx < len(val_data)
+    shards = []
+    for shard_idx, cores in enumerate(shard_cores):
+        indices = range(shard_idx, len(val_data), num_shards)
+        example_idx = example_sentence_idx // num_shards \
+                if has_example and example_sentence_idx % num_shards == shard_idx else None
+        shards.append((hparams, vocab_src, vocab_tgt, model_checkpoint,
+                       [val_data[idx] for idx in indices],
+                       [gold_alignments[idx] if idx < len(gold_alignments) else None
+                        for idx in indices], example_idx, cores))
+
+    # Spawn fresh processes, such that the number of threads can be set for each of them.
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(num_shards, maxtasksperchild=1) as pool:
+        results = pool.starmap(evaluate_shard, shards, chunksize=1)
+
+    statistics = ValidationStatistics()
+    example = None
+    for shard_statistics, shard_example in results:
+        statistics.merge(shard_statistics)
+        if shard_example is not None:
+            example = shard_example
+    return validation_helper(hparams).report_validation(statistics, example, hparams, 0)
+
 def main():
 
     # Load command line hyperparameters (and if provided from an hparams_file).
@@ -41,22 +116,28 @@ def main():
     # Select the correct device (GPU or CPU).
     device = torch.device("cuda:0") if hparams.use_gpu else torch.device("cpu")
 
-    # Restore the model from output_dir/model.pt.
-    model_checkpoint = output_dir / "model.pt"
-    print(f"\nRestoring model from {model_checkpoint}\n")
-    model, _, eval_fn = create_model(hparams, vocab_src, vocab_tgt)
-    model.load_state_dict(torch.load(model_checkpoint))
-    model = model.to(device)
-    model.eval()
-
     # Load the data.
     val_src = f"{hparams.validation_prefix}.{hparams.src}"
     val_tgt = f"{hparams.validation_prefix}.{hparams.tgt}"
-    val_data = ParallelDataset(val_src, val_tgt)
+    val_data = ParallelDataset(val_src, val_tgt, storage=hparams.dataset_storage)
     gold_alignments = read_naacl_alignments(f"{hparams.validation_prefix}.wa.nonullalign")
 
-    aer = eval_fn(model, val_data, gold_alignments, vocab_src, vocab_tgt, device,
-                   hparams, 0, summary_writer=None)
+    # Restore the model from output_dir/model.pt, the shards each restore their own model.
+    model_checkpoint = output_dir / "model.pt"
+    print(f"\nRestoring model from {model_checkpoint}\n")
+    if hparams.eval_shards > 1:
+        aer = sharded_evaluation(hparams, vocab_src, vocab_tgt, model_checkpoint, val_data,
+                                 gold_alignments)
+    else:
+        model, _, eval_fn = create_model(hparams, vocab_src, vocab_tgt)
+        model.load_state_dict(torch.load(model_checkpoint))
+        model = model.to(device)
+        model.eval()
+
+        val_data = create_validation_cache(val_data, gold_alignments, vocab_src, vocab_tgt,
+                                           device, hparams)
+        aer = eval_fn(model, val_data, gold_alignments, vocab_src, vocab_tgt, device,
+                       hparams, 0, summary_writer=None)
 
 if __name__ == "__main__":
     main()
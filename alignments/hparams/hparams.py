@@ -28,11 +28,34 @@ options = {
                                       " to be included in the vocabulary.", 0),
     "model_checkpoint": (str, None, False, "A model checkpoint to load.", 0),
     "example_sentence_idx": (int, 0, False, "Example alignment to print and plot", 0),
+    "debug": (bool, False, False, "Validate the arguments of all distributions, this"
+                                  " slows down training.", 0),
+    "num_workers": (int, 4, False, "The number of DataLoader worker processes.", 0),
+    "eval_shards": (int, 1, False, "The number of processes alignments.eval splits the"
+                                   " validation data over, each aligning and scoring its own"
+                                   " shard on its own set of cores. The statistics of the"
+                                   " shards are merged afterwards.", 0),
+    "prefetch_batches": (int, 0, False, "Create up to this many training batches of word ids"
+                                        " ahead in a background thread, overlapping the"
+                                        " tokenization with training. Disabled if <= 0.", 0),
+    "dataset_storage": (str, "list", False, "How the sentences are kept in memory: list|buffer."
+                                            " buffer stores them in contiguous byte buffers,"
+                                            " such that the memory of forked DataLoader"
+                                            " workers does not grow over an epoch.", 0),
+    "num_threads": (int, -1, False, "The number of intra-op threads of PyTorch, if <= 0 the"
+                                    " PyTorch default is used.", 0),
+    "num_interop_threads": (int, -1, False, "The number of inter-op threads of PyTorch, if"
+                                            " <= 0 the PyTorch default is used.", 0),
 
     # Model hyperparameters
     "model_type": (str, "neuralibm1", False, "The type of model to train:"
                                              " neuralibm1|bernoulli-RF|bernoulli-ST|hardkuma", 1),
     "cell_type": (str, "lstm", False, "The RNN cell type. rnn|gru|lstm", 1),
+    "encoder_type": (str, "rnn", False, "The encoder of the bit-vector inference network:"
+                                        " rnn|conv|attention. conv and attention encode all"
+                                        " positions in parallel.", 1),
+    "num_heads": (int, 4, False, "The number of attention heads for encoder_type"
+                                 " attention.", 1),
     "emb_size": (int, 32, False, "The source / target embedding size.", 1),
     "hidden_size": (int, 32, False, "The size of the hidden layers.", 1),
     "num_layers": (int, 1, False, "The number of encoder layers.", 1),
@@ -42,9 +65,45 @@ options = {
     "pooling": (str, "avg", False, "Pooling to use: avg|sum", 1),
     "prior_param_1": (float, 0., False, "Prior parameter 1", 1),
     "prior_param_2": (float, 0., False, "Prior parameter 2", 1),
+    "num_replicas": (int, 1, False, "Train this many independent replicas of the model as one"
+                                    " stacked model, vectorized with vmap. Supports"
+                                    " neuralibm1 and bernoulli-RF|bernoulli-ST with"
+                                    " encoder_type conv|attention.", 1),
+    "replica_prior_param_1": (str, None, False, "Comma-separated prior_param_1 of each"
+                                                " replica, defaults to prior_param_1.", 1),
+    "replica_prior_param_2": (str, None, False, "Comma-separated prior_param_2 of each"
+                                                " replica, defaults to prior_param_2.", 1),
     "cv_running_avg": (bool, True, False, "Center the reward", 1),
     "cv_running_std": (bool, False, False, "Reward to unit variance", 1),
     "cv_self_critic": (bool, False, False, "Use a self-critic to control variance", 1),
+    "RF_num_samples": (int, 1, False, "Number of samples of A per sentence pair for bernoulli-RF."
+                                      " If > 1 the leave-one-out average reward is used as"
+                                      " baseline instead of cv_running_avg and cv_self_critic.", 1),
+    "chunk_size": (int, -1, False, "Process this many target positions at a time during"
+                                   " training for bernoulli-RF|bernoulli-ST, recomputing"
+                                   " each block in the backward pass, this bounds memory for"
+                                   " long sentences. Disabled if <= 0.", 1),
+    "band_width": (int, -1, False, "Only align target positions to source positions within"
+                                   " this distance of the diagonal, for bernoulli-RF|"
+                                   "bernoulli-ST. Disabled if < 0.", 1),
+    "num_candidates": (int, -1, False, "Only let each target word align to the k source"
+                                       " words with the highest lexical table scores, for"
+                                       " bernoulli-RF|bernoulli-ST. Disabled if <= 0.", 1),
+    "lexical_table": (str, "dice", False, "The lexical table used to select candidates: dice"
+                                          " for Dice coefficients on the training data, or the"
+                                          " output directory of a trained neuralibm1 model.", 1),
+    "lexical_table_size": (int, 50, False, "The number of target words kept in the lexical"
+                                           " table per source word.", 1),
+    "output_layer": (str, "full", False, "The output layer of the bit-vector models:"
+                                         " full|adaptive|sampled. adaptive uses an adaptive"
+                                         " softmax, sampled a sampled softmax during training"
+                                         " and the full softmax for evaluation. Both rely on"
+                                         " target word ids being sorted by frequency.", 1),
+    "adaptive_cutoffs": (str, "2000,10000", False, "Comma-separated cluster cutoffs for the"
+                                                   " adaptive softmax, cutoffs larger than the"
+                                                   " vocabulary are ignored.", 1),
+    "num_sampled": (int, 1024, False, "The number of negative words for the sampled"
+                                      " softmax.", 1),
     "PPO_steps": (int, 0, False, "Number of PPO steps after the first update.", 1),
     "PPO_eps": (float, 0.2, False, "Epsilon used for clipping in PPO.", 1),
     "PPO_reuse_sc": (bool, True, False, "Re-use the self-critic score for PPO updates.", 1),
@@ -54,6 +113,28 @@ options = {
     "learning_rate": (float, 1e-3, False, "The learning rate.", 2),
     "batch_size": (int, 64, False, "The batch size.", 2),
     "print_every": (int, 100, False, "Print training statistics every x steps.", 2),
+    "sparse_embeddings": (bool, False, False, "Use sparse gradients for the embeddings, and an"
+                                              " Adam optimizer that only updates the rows"
+                                              " of the embeddings that occur in a batch.", 2),
+    "checkpoint_activations": (bool, False, False, "Recompute the activations of the encoders"
+                                                   " and alignment logits of the inference"
+                                                   " network in the backward pass instead of"
+                                                   " storing them, to save memory on long"
+                                                   " sentences.", 2),
+    "compile": (bool, False, False, "Compile the training computations of the model with"
+                                    " torch.compile. Each batch shape is compiled"
+                                    " separately, so batches are padded to length_buckets.", 2),
+    "length_buckets": (str, "16,32,64,128,256", False, "Comma-separated lengths that training"
+                                                       " batches are padded to if compile is"
+                                                       " set.", 2),
+    "compile_cache_size": (int, 64, False, "The maximum number of shapes that are compiled"
+                                           " per function, other shapes run uncompiled.", 2),
+    "memory_profile": (bool, False, False, "Record the peak memory of each phase of the"
+                                           " training steps per batch shape, log the largest"
+                                           " allocations of the steps with the highest peak"
+                                           " and save a model of the memory use to"
+                                           " output_dir/memory_profile.json. Slows down"
+                                           " training on the CPU.", 2),
     "max_gradient_norm": (float, -1.0, False, "The maximum gradient norm to clip the"
                                              " gradients to, to disable"
                                              " set <= 0.", 2),
@@ -74,8 +155,51 @@ options = {
     "evaluate_every": (int, -1, False, "The number of batches after which to run"
                                        " evaluation. If <= 0, evaluation will happen"
                                        " after every epoch.", 2),
+    "fast_eval_size": (int, 0, False, "If > 0, every evaluation first scores a fixed"
+                                      " subsample of this many validation sentence pairs,"
+                                      " stratified by length, and only runs the full"
+                                      " evaluation (saving the best model and updating the"
+                                      " learning rate scheduler) if the lower bound of the"
+                                      " confidence interval of its AER is below the best"
+                                      " AER so far.", 2),
+    "fast_eval_confidence": (float, 0.95, False, "The confidence level of the bootstrap"
+                                                 " confidence interval of the subsample AER.", 2),
+    "fast_eval_bootstrap_samples": (int, 1000, False, "The number of bootstrap samples to"
+                                                      " estimate the confidence interval of"
+                                                      " the subsample AER with.", 2),
     "KL_annealing_steps": (int, -1, False, "The number of steps to anneal the KL multiplier over,"
                                            " which goes from 0 to 1.", 2),
+
+    # Throughput tuning with alignments.tune
+    "tune_batch_sizes": (str, "16,32,64,128,256", False, "Comma-separated batch sizes to"
+                                                         " try.", 3),
+    "tune_num_threads": (str, None, False, "Comma-separated numbers of intra-op threads to"
+                                           " try, by default powers of 2 up to the number"
+                                           " of CPUs.", 3),
+    "tune_num_interop_threads": (str, "1,2,4", False, "Comma-separated numbers of inter-op"
+                                                      " threads to try.", 3),
+    "tune_num_workers": (str, "0,1,2,4", False, "Comma-separated numbers of DataLoader"
+                                                " workers to try.", 3),
+    "tune_warmup_steps": (int, 5, False, "The number of training steps of a trial before"
+                                         " throughput is measured.", 3),
+    "tune_steps": (int, 20, False, "The number of training steps over which the throughput"
+                                   " of a trial is measured.", 3),
+    "tune_max_memory": (int, -1, False, "Reject configurations whose peak memory, including"
+                                        " DataLoader workers, exceeds this many MB. Disabled"
+                                        " if <= 0.", 3),
+    "tune_trial_timeout": (int, 600, False, "The maximum number of seconds a trial can take.", 3),
+    "sweep_file": (str, None, False, "JSON file with the configurations of a sweep, a \"grid\""
+                                     " of hyperparameter values of which all combinations"
+                                     " are tried and/or a list of \"configs\".", 3),
+    "sweep_parallel": (int, -1, False, "The number of configurations that are trained at the"
+                                       " same time, each on its own set of cores. Defaults"
+                                       " to the number of CPUs if <= 0.", 3),
+    "sweep_min_epochs": (int, 1, False, "The number of epochs all configurations are trained"
+                                        " for before the first halving.", 3),
+    "sweep_halving_rate": (int, 3, False, "Keep the best 1/sweep_halving_rate of the"
+                                          " configurations by validation AER at every"
+                                          " halving, and train them for sweep_halving_rate"
+                                          " times as many epochs, up to num_epochs.", 3),
 }
 
 class Hyperparameters:
@@ -113,6 +237,18 @@ class Hyperparameters:
         self._hparams.update(json_hparams)
         self._create_hparams(False)
 
+    def update(self, values):
+        """
+        Overrides the values of the hyperparameters in a dictionary.
+        """
+        for key in values:
+            if key not in options:
+                raise Exception(f"Error: unknown hyperparameter `{key}`.")
+            if key in self._defaulted_values:
+                self._defaulted_values.remove(key)
+        self._hparams.update(values)
+        self._create_hparams(False)
+
     def _load_from_command_line(self):
         parser = argparse.ArgumentParser()
         for option in options.keys():
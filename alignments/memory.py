@@ -0,0 +1,286 @@
+"""
+Memory accounting for training. MemoryTracker records the process RSS and the peak tensor
+memory of each phase of a training step (batch creation, forward pass, backward pass,
+optimizer step, PPO updates) per batch shape, logs the largest allocations of the steps that
+reach a new peak, and fits a MemoryModel that predicts the peak memory of a step from the
+batch size, sentence lengths and target vocabulary size.
+"""
+import heapq
+import json
+import resource
+import weakref
+import numpy as np
+import torch
+
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+MB = 1024. ** 2
+
+def current_rss_mb():
+    return _read_proc_status("VmRSS")
+
+def peak_rss_mb():
+    """
+    Returns the peak RSS since the last reset_peak_rss call, or since the start of the
+    process if it cannot be reset.
+    """
+    peak = _read_proc_status("VmHWM")
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024. # In kilobytes.
+    return peak
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def _read_proc_status(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024. # In kilobytes.
+    except OSError:
+        pass
+    return None
+
+class AllocationTracker(TorchDispatchMode):
+    """
+    Keeps track of the memory of the tensors created by PyTorch operators while it is
+    active. A storage is counted when the first tensor using it is created, until that
+    tensor is freed, which makes this an approximation for views that outlive their base.
+    peak_bytes is the peak since the last phase started, and peak_allocations are the top_k
+    largest allocations that were live at the peak since the last call to reset.
+    """
+
+    def __init__(self, top_k=10):
+        super().__init__()
+        self.top_k = top_k
+        self.live_bytes = 0
+        self.peak_bytes = 0
+        self.phase = None
+        self.live = {}
+        self.reset()
+
+    def reset(self):
+        self.step_peak_bytes = self.live_bytes
+        self.peak_allocations = heapq.nlargest(self.top_k, self.live.values())
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        output = func(*args, **(kwargs or {}))
+        for tensor in tree_flatten(output)[0]:
+            if isinstance(tensor, torch.Tensor) and tensor.layout == torch.strided:
+                self._track(func, tensor)
+        return output
+
+    def _track(self, func, tensor):
+        storage = tensor.untyped_storage()
+        key = (storage.device, storage.data_ptr())
+        if storage.data_ptr() == 0 or key in self.live:
+            return
+
+        # A new storage, i.e. not the output of a view or in-place operation.
+        nbytes = storage.nbytes()
+        self.live[key] = (nbytes, str(func), tuple(tensor.shape), str(tensor.dtype),
+                          self.phase)
+        self.live_bytes += nbytes
+        self.peak_bytes = max(self.peak_bytes, self.live_bytes)
+        weakref.finalize(tensor, self._release, key)
+
+        # Remember what was live at the peak of the step.
+        if self.live_bytes > self.step_peak_bytes:
+            self.step_peak_bytes = self.live_bytes
+            self.peak_allocations = heapq.nlargest(self.top_k, self.live.values())
+
+    def _release(self, key):
+        allocation = self.live.pop(key, None)
+        if allocation is not None:
+            self.live_bytes -= allocation[0]
+
+class MemoryModel:
+    """
+    Linear model of the peak memory (in MB) of a training step as a function of the batch
+    size B, the source and target lengths T_x and T_y and the target vocabulary size V:
+
+        c_0 + c_1 B T_x T_y + c_2 B T_x V + c_3 B T_y V + c_4 B (T_x + T_y)
+
+    covering the alignment matrices, the output distributions over the source (neural
+    IBM1) and target positions, and the per-word activations. All coefficients are
+    non-negative.
+    """
+
+    def __init__(self, coefficients):
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        if np.any(self.coefficients < 0.):
+            raise Exception(f"Memory model coefficients should be non-negative, got"
+                            f" {self.coefficients.tolist()}")
+
+    @staticmethod
+    def features(batch_size, T_x, T_y, vocab_size):
+        return np.array([1., batch_size * T_x * T_y, batch_size * T_x * vocab_size,
+                         batch_size * T_y * vocab_size, batch_size * (T_x + T_y)])
+
+    @staticmethod
+    def fit(shapes, peaks):
+        """
+        Fits the coefficients by least squares, constrained to be non-negative by dropping
+        the term with the most negative coefficient and refitting until none is left. With a
+        single vocabulary size the V terms are proportional to B T_x and B T_y, so the
+        B (T_x + T_y) term is dropped and the per-word activations are absorbed by them.
+
+        :param shapes: a list of (B, T_x, T_y, V)
+        :param peaks: the measured peak memory of each shape in MB.
+        """
+        features = np.stack([MemoryModel.features(*shape) for shape in shapes])
+        peaks = np.asarray(peaks, dtype=float)
+        terms = [0, 1, 2, 3] if len(set(shape[3] for shape in shapes)) == 1 else \
+                [0, 1, 2, 3, 4]
+        coefficients = np.zeros(features.shape[1])
+        while len(terms) > 0:
+            fitted, _, _, _ = np.linalg.lstsq(features[:, terms], peaks, rcond=None)
+            if np.all(fitted >= 0.):
+                coefficients[terms] = fitted
+                break
+            del terms[int(np.argmin(fitted))]
+        return MemoryModel(coefficients)
+
+    def predict(self, batch_size, T_x, T_y, vocab_size):
+        return float(self.features(batch_size, T_x, T_y, vocab_size) @ self.coefficients)
+
+    def max_batch_size(self, T_x, T_y, vocab_size, budget_mb):
+        """
+        Returns the largest batch size of sentences of lengths T_x and T_y whose predicted
+        peak memory fits in budget_mb, or 0 if none does.
+        """
+        per_sentence = self.predict(1, T_x, T_y, vocab_size) - self.coefficients[0]
+        if per_sentence == 0.:
+            raise Exception("The memory model does not grow with the batch size.")
+        return max(0, int((budget_mb - self.coefficients[0]) // per_sentence))
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"coefficients": self.coefficients.tolist()}, f, indent=4)
+
+    @staticmethod
+    def load(filename):
+        with open(filename) as f:
+            return MemoryModel(json.load(f)["coefficients"])
+
+class MemoryTracker:
+    """
+    Records the peak RSS and peak tensor memory of the phases of training steps. A step
+    starts with start_step, which starts the "batch" phase, every call to phase ends the
+    current phase and starts a new one, and end_step ends the step. Tensor memory is
+    measured by the CUDA allocator on the GPU and by an AllocationTracker otherwise, which
+    slows down training. If not enabled all methods do nothing.
+    """
+
+    def __init__(self, vocab_size, device, enabled=True, top_k=10):
+        self.vocab_size = vocab_size
+        self.device = device
+        self.enabled = enabled
+        self.allocations = AllocationTracker(top_k)
+        self.shapes = {}
+        self.worst_peak_mb = 0.
+        self.cur_phase = None
+
+    def start_step(self, step):
+        if not self.enabled:
+            return
+        self.step = step
+        self.phases = {}
+        self.allocations.reset()
+        self.allocations.__enter__()
+        self.phase("batch")
+
+    def phase(self, name):
+        if not self.enabled:
+            return
+        self._end_phase()
+        self.cur_phase = name
+        self.allocations.phase = name
+        self.allocations.peak_bytes = self.allocations.live_bytes
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        reset_peak_rss()
+
+    def _end_phase(self):
+        if self.cur_phase is None:
+            return
+        if self.device.type == "cuda":
+            tensor_peak = torch.cuda.max_memory_allocated(self.device) / MB
+        else:
+            tensor_peak = self.allocations.peak_bytes / MB
+        self.phases[self.cur_phase] = {"rss_peak_mb": peak_rss_mb(),
+                                       "tensor_peak_mb": tensor_peak,
+                                       "tensor_live_mb": self.allocations.live_bytes / MB}
+        self.cur_phase = None
+
+    def abort_step(self):
+        """
+        Ends a step without recording it, e.g. if there was no batch left to train on.
+        """
+        if not self.enabled:
+            return
+        self.cur_phase = None
+        self.allocations.__exit__(None, None, None)
+
+    def end_step(self, batch_size, T_x, T_y):
+        """
+        Ends the step, the batch shape is given as the batch size and source and target
+        lengths.
+        """
+        if not self.enabled:
+            return
+        self._end_phase()
+        self.allocations.__exit__(None, None, None)
+
+        peak_mb = max(phase["tensor_peak_mb"] for phase in self.phases.values())
+        shape = (batch_size, T_x, T_y)
+        if shape not in self.shapes or peak_mb > self.shapes[shape]["tensor_peak_mb"]:
+            self.shapes[shape] = {"step": self.step, "tensor_peak_mb": peak_mb,
+                                  "rss_peak_mb": max(phase["rss_peak_mb"] for phase in
+                                                     self.phases.values()),
+                                  "phases": self.phases}
+
+        # Log the largest allocations of steps that reach a new peak.
+        if peak_mb > self.worst_peak_mb:
+            self.worst_peak_mb = peak_mb
+            print(f"New peak tensor memory at step {self.step} (B = {batch_size}, T_x = {T_x},"
+                  f" T_y = {T_y}): {peak_mb:,.1f} MB")
+            for phase_name, phase in self.phases.items():
+                print(f"  {phase_name}: tensor peak = {phase['tensor_peak_mb']:,.1f} MB --"
+                      f" live after = {phase['tensor_live_mb']:,.1f} MB --"
+                      f" RSS peak = {phase['rss_peak_mb']:,.1f} MB")
+            print("  Largest allocations live at the peak:")
+            for nbytes, op, size, dtype, phase_name in self.allocations.peak_allocations:
+                print(f"    {nbytes / MB:,.1f} MB {op} {list(size)} {dtype} ({phase_name})")
+
+    def fit(self):
+        """
+        Fits a MemoryModel to the peak tensor memory of each batch shape seen so far.
+        """
+        shapes = [shape + (self.vocab_size,) for shape in self.shapes]
+        peaks = [record["tensor_peak_mb"] for record in self.shapes.values()]
+        return MemoryModel.fit(shapes, peaks)
+
+    def save(self, filename):
+        """
+        Saves the measurements per batch shape together with the memory predicted for them
+        by a fitted MemoryModel, returns the MemoryModel.
+        """
+        if not self.enabled or len(self.shapes) == 0:
+            return None
+        memory_model = self.fit()
+        records = []
+        for (batch_size, T_x, T_y), record in sorted(self.shapes.items()):
+            predicted = memory_model.predict(batch_size, T_x, T_y, self.vocab_size)
+            records.append(dict(record, batch_size=batch_size, T_x=T_x, T_y=T_y,
+                                vocab_size=self.vocab_size, predicted_mb=predicted))
+        with open(filename, "w") as f:
+            json.dump({"coefficients": memory_model.coefficients.tolist(),
+                       "shapes": records}, f, indent=4)
+        return memory_model
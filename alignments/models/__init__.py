@@ -1,3 +1,4 @@
 from .neuralibm1 import NeuralIBM1
 from .vae import AlignmentVAE
 from .initialization import initialize_model
+from .replicas import Replicas
@@ -4,6 +4,8 @@ import torch.nn as nn
 
 from torch.nn.init import _calculate_fan_in_and_fan_out
 
+from .replicas import Replicas
+
 def xavier_uniform_n_(w, gain=1., n=4):
     """
     From: https://github.com/joeynmt/joeynmt/blob/master/joeynmt/initialization.py
@@ -29,6 +31,13 @@ def initialize_model(model, pad_idx, cell_type, emb_init_scale, verbose=False):
     that all models in aevnmt.models should follow.
     """
 
+    # Initialize every replica of stacked replicas as a model of its own.
+    if isinstance(model, Replicas):
+        for idx, replica in enumerate(model.replicas):
+            initialize_model(replica, pad_idx, cell_type, emb_init_scale,
+                             verbose=(verbose and idx == 0))
+        return
+
     xavier_gain = 1.
 
     with torch.no_grad():
@@ -57,6 +66,19 @@ def initialize_model(model, pad_idx, cell_type, emb_init_scale, verbose=False):
                 n = 4 if cell_type == "lstm" else 3
                 xavier_uniform_n_(param.data, gain=xavier_gain, n=n)
 
+            # Initialize layer normalization scales to ones.
+            elif "norm" in name:
+                if verbose:
+                    print(f"Initializing {name} to 1")
+                nn.init.ones_(param)
+
+            # The query, key and value projections of self-attention are stored in 1 matrix.
+            elif "in_proj_weight" in name:
+                if verbose:
+                    print(f"Initializing {name} with xavier_uniform(gain={xavier_gain:.1f})"
+                          f" for attention")
+                xavier_uniform_n_(param.data, gain=xavier_gain, n=3)
+
             # For all other matrices just use Xavier uniform initialization.
             elif len(param) > 1:
                 if verbose:
@@ -7,14 +7,19 @@ from alignments.constants import epsilon
 
 class NeuralIBM1(nn.Module):
 
-    def __init__(self, src_vocab_size, tgt_vocab_size, emb_size, hidden_size, pad_idx):
+    # The methods that are compiled for training by train_utils.compile_model.
+    compiled_methods = ["forward", "loss"]
+
+    def __init__(self, src_vocab_size, tgt_vocab_size, emb_size, hidden_size, pad_idx,
+                 sparse_embeddings=False):
         super().__init__()
         self.src_vocab_size = src_vocab_size
         self.tgt_vocab_size = tgt_vocab_size
         self.emb_size = emb_size
         self.hidden_size = hidden_size
         self.pad_idx = pad_idx
-        self.src_embedder = nn.Embedding(src_vocab_size, emb_size, padding_idx=pad_idx)
+        self.src_embedder = nn.Embedding(src_vocab_size, emb_size, padding_idx=pad_idx,
+                                         sparse=sparse_embeddings)
         self.translation_layer = nn.Sequential(nn.Linear(emb_size, hidden_size),
                                                nn.ReLU(),
                                                nn.Linear(hidden_size, tgt_vocab_size),
@@ -43,10 +48,13 @@ class NeuralIBM1(nn.Module):
 
         return p_marginal
 
-    def loss(self, p_marginal, y, reduction="mean"):
+    def loss(self, p_marginal, y, seq_mask_y, reduction="mean"):
         p_observed = torch.gather(p_marginal, -1, y.unsqueeze(-1))
         p_observed = p_observed.squeeze(-1)
-        log_likelihood = torch.log(p_observed + epsilon).sum(dim=1)
+
+        # Only count the target words, not the padding. # [B]
+        log_likelihood = torch.where(seq_mask_y, torch.log(p_observed + epsilon),
+                                     p_observed.new_zeros([1])).sum(dim=1)
 
         loss = -log_likelihood
 
@@ -0,0 +1,143 @@
+import copy
+import torch
+import torch.nn as nn
+
+from torch.func import functional_call, vmap
+
+class _Call(nn.Module):
+    """
+    Calls a function with the wrapped model, such that functional_call can substitute the
+    parameters and buffers of the model in arbitrary functions rather than only forward.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, function, args, kwargs):
+        return function(self.model, *args, **kwargs)
+
+def _set_tensors(module, parameters, buffers, idx=None):
+    """
+    Replaces the parameters and buffers of module, and of its submodules, by the tensors with
+    the same name, or by their idx-th slice if idx is given. Parameters that are shared
+    under several names are replaced everywhere.
+    """
+    for name, submodule in module.named_modules(remove_duplicate=False):
+        prefix = f"{name}." if name else ""
+        for param_name in list(submodule._parameters):
+            param = parameters[prefix + param_name]
+            if idx is not None:
+                param = nn.Parameter(param.detach()[idx], requires_grad=False)
+            submodule._parameters[param_name] = param
+        for buffer_name in list(submodule._buffers):
+            buffer = buffers[prefix + buffer_name]
+            submodule._buffers[buffer_name] = buffer if idx is None else buffer[idx]
+
+class Replicas(nn.Module):
+    """
+    N independent replicas of a model that are trained as one stacked model. The parameters
+    and buffers of the replicas are stored stacked in tensors of shape [N, ...], and vmap
+    vectorizes a function over the replicas with torch.func.vmap. The replicas keep their
+    own parameters, buffers (e.g. baselines and prior parameters) and optimizer state, as
+    an optimizer over the stacked parameters updates each of them independently, and random
+    numbers differ between replicas. replicas gives a view of each replica as a model of
+    its own, e.g. for initialization, validation and checkpointing, that shares its memory
+    with the stacked tensors.
+    """
+
+    def __init__(self, replicas):
+        super().__init__()
+        self.num_replicas = len(replicas)
+
+        # The best and the last validation AER of every replica.
+        self.register_buffer("best_aer", torch.full([self.num_replicas], 2.))
+        self.register_buffer("val_aer", torch.full([self.num_replicas], 2.), persistent=False)
+
+        # A copy of the first replica whose parameters and buffers are replaced by those of
+        # all replicas stacked, with their names as parameters of the model of a _Call.
+        named_tensors = [(dict(replica.named_parameters(remove_duplicate=False)),
+                          dict(replica.named_buffers(remove_duplicate=False)))
+                         for replica in replicas]
+        parameters = {name: nn.Parameter(torch.stack([params[name].detach() for params, _
+                                                      in named_tensors]))
+                      for name in named_tensors[0][0]}
+        buffers = {name: torch.stack([buffers_[name] for _, buffers_ in named_tensors])
+                   for name in named_tensors[0][1]}
+        for name, param in replicas[0].named_parameters(remove_duplicate=False):
+            for alias, other in replicas[0].named_parameters(remove_duplicate=False):
+                if other is param:
+                    parameters[alias] = parameters[name]
+        self.stacked = _Call(copy.deepcopy(replicas[0]).to("meta"))
+        _set_tensors(self.stacked.model, parameters, buffers)
+
+        # A copy of the first replica without data that is called with the stacked parameters
+        # and buffers. It is kept in a list so that it is not registered as a submodule.
+        self._base = [_Call(copy.deepcopy(replicas[0]).to("meta"))]
+        self._views = None
+
+    @property
+    def replicas(self):
+        """
+        The replicas as models of their own, their parameters and buffers are views of the
+        idx-th slice of the stacked tensors that do not require gradients.
+        """
+        if self._views is None:
+            parameters = dict(self.stacked.model.named_parameters(remove_duplicate=False))
+            buffers = dict(self.stacked.model.named_buffers(remove_duplicate=False))
+            self._views = []
+            for idx in range(self.num_replicas):
+                view = copy.deepcopy(self._base[0].model)
+                _set_tensors(view, parameters, buffers, idx)
+                self._views.append(view)
+        for view in self._views:
+            view.train(self.training)
+        return self._views
+
+    def _apply(self, fn, *args, **kwargs):
+        # Moving the stacked tensors, e.g. to another device, replaces them, so the views
+        # are recreated when needed.
+        self._views = None
+        return super()._apply(fn, *args, **kwargs)
+
+    def stacked_state(self):
+        """
+        Returns the stacked parameters and buffers of all replicas by their names in the
+        replicated model.
+        """
+        return dict(self.stacked.named_parameters(), **dict(self.stacked.named_buffers()))
+
+    def vmap(self, function, *args, **kwargs):
+        """
+        Computes function(replica, *args, **kwargs) for all replicas at once, the arguments
+        are shared by all replicas. function should return a tensor or a dictionary of
+        tensors, which are stacked over the replicas in the first dimension.
+        """
+        return vmap(lambda stacked: functional_call(self._base[0], stacked,
+                                                    (function, args, kwargs)),
+                    randomness="different")(self.stacked_state())
+
+    def clip_gradient_norm_(self, max_norm):
+        """
+        Clips the gradient norm of every replica separately to max_norm.
+        """
+        grads = [p.grad for p in self.stacked.parameters() if p.grad is not None]
+        if len(grads) == 0:
+            return
+        norms = torch.stack([grad.reshape(self.num_replicas, -1).pow(2).sum(dim=1)
+                             for grad in grads]).sum(dim=0).sqrt() # [N]
+        clip_coef = torch.clamp(max_norm / (norms + 1e-6), max=1.0)
+        for grad in grads:
+            grad.mul_(clip_coef.view([self.num_replicas] + [1] * (grad.dim() - 1)))
+
+    def update_baselines(self, new_reward, seq_len_y): # [N, B, T_y], [B]
+        parameters = dict(self.stacked.model.named_parameters(remove_duplicate=False))
+        buffers = dict(self.stacked.model.named_buffers(remove_duplicate=False))
+        for idx, (replica, replica_reward) in enumerate(zip(self.replicas, new_reward)):
+            replica.update_baselines(replica_reward, seq_len_y)
+
+            # update_baselines assigns new baselines, copy them into the stacked buffers and
+            # make the replica a view of them again.
+            for name, buffer in replica.named_buffers(remove_duplicate=False):
+                buffers[name][idx] = buffer
+            _set_tensors(replica, parameters, buffers, idx)
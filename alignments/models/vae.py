@@ -4,36 +4,82 @@ import torch.nn.functional as F
 import torch.distributions as torchdist
 import numpy as np
 
+from torch.utils.checkpoint import checkpoint
+
 from alignments.constants import epsilon
-from alignments.dist import BernoulliREINFORCE, BernoulliStraightThrough
+from alignments.dist import BernoulliREINFORCE, BernoulliStraightThrough, PackedBernoulli
+from alignments.dist import alignment_cells
+from alignments.dist import bernoulli_log_prob, bernoulli_kl
 from probabll.distributions import BinaryConcrete, Kumaraswamy, Stretched, Rectified01
-from alignments.components import RNNEncoder
+from alignments.components import create_encoder, LexicalTable
+
+class _SharedCriticMatmul(torch.autograd.Function):
+    """
+    Computes a @ b and a_critic @ b in a single batched matmul, where only a @ b is
+    differentiable: the critic product is not recorded for the backward pass, which only
+    computes the gradients of a @ b.
+    """
+
+    generate_vmap_rule = True
+
+    @staticmethod
+    def forward(a, a_critic, b):
+        out = torch.matmul(torch.stack([a, a_critic]), b)
+        return out[0], out[1]
+
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        a, _, b = inputs
+        ctx.save_for_backward(a, b)
+        ctx.mark_non_differentiable(output[1])
+
+    @staticmethod
+    def backward(ctx, grad, grad_critic):
+        a, b = ctx.saved_tensors
+        grad_a = grad_b = None
+        if ctx.needs_input_grad[0]:
+            grad_a = torch.matmul(grad, b.transpose(-1, -2))
+        if ctx.needs_input_grad[2]:
+            if b.dim() == 2:
+                # b is shared by all leading dimensions of a, e.g. an output layer weight.
+                grad_b = a.reshape(-1, a.size(-1)).t() @ grad.reshape(-1, grad.size(-1))
+            else:
+                grad_b = torch.matmul(a.transpose(-1, -2), grad)
+        return grad_a, None, grad_b
 
 class InferenceNetwork(nn.Module):
 
     def __init__(self, dist, src_vocab_size, tgt_vocab_size, emb_size, hidden_size, pad_idx,
-                 bidirectional, num_layers, cell_type):
+                 bidirectional, num_layers, cell_type, validate_args=False, sparse_embeddings=False,
+                 encoder_type="rnn", num_heads=4, checkpoint_activations=False):
         super().__init__()
         self.src_vocab_size = src_vocab_size
         self.tgt_vocab_size = tgt_vocab_size
         self.pad_idx = pad_idx
         self.dist = dist
-        self.src_embedder = nn.Embedding(src_vocab_size, emb_size, padding_idx=pad_idx)
-        self.tgt_embedder = nn.Embedding(tgt_vocab_size, emb_size, padding_idx=pad_idx)
-        self.src_encoder = RNNEncoder(emb_size=emb_size,
-                                      hidden_size=hidden_size,
-                                      bidirectional=bidirectional,
-                                      dropout=0.,
-                                      num_layers=num_layers,
-                                      cell_type=cell_type)
-        self.tgt_encoder = RNNEncoder(emb_size=emb_size,
-                                      hidden_size=hidden_size,
-                                      bidirectional=bidirectional,
-                                      dropout=0.,
-                                      num_layers=num_layers,
-                                      cell_type=cell_type)
-
-        encoding_size = hidden_size * 2 if bidirectional else hidden_size
+        self.validate_args = validate_args
+        self.checkpoint_activations = checkpoint_activations
+        self.src_embedder = nn.Embedding(src_vocab_size, emb_size, padding_idx=pad_idx,
+                                         sparse=sparse_embeddings)
+        self.tgt_embedder = nn.Embedding(tgt_vocab_size, emb_size, padding_idx=pad_idx,
+                                         sparse=sparse_embeddings)
+        self.src_encoder, encoding_size = create_encoder(encoder_type,
+                                                         emb_size=emb_size,
+                                                         hidden_size=hidden_size,
+                                                         bidirectional=bidirectional,
+                                                         dropout=0.,
+                                                         num_layers=num_layers,
+                                                         cell_type=cell_type,
+                                                         num_heads=num_heads)
+        self.tgt_encoder, _ = create_encoder(encoder_type,
+                                             emb_size=emb_size,
+                                             hidden_size=hidden_size,
+                                             bidirectional=bidirectional,
+                                             dropout=0.,
+                                             num_layers=num_layers,
+                                             cell_type=cell_type,
+                                             num_heads=num_heads)
+
         # encoding_size = emb_size
         if self.dist in ["kuma", "hardkuma"]:
             self.kuma_a_key_layer = nn.Linear(encoding_size, hidden_size)
@@ -46,34 +92,15 @@ class InferenceNetwork(nn.Module):
 
     def forward(self, x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y):
 
-        # Embed the source and target words.
-        x_embed = self.src_embedder(x) # [B, T_x, emb_size]
-        y_embed = self.tgt_embedder(y) # [B, T_y, emb_size]
-
-        # Encode both sentences.
-        x_enc, _ = self.src_encoder.unsorted_forward(x_embed) # [B, T_x, enc_size]
-        y_enc, _ = self.tgt_encoder.unsorted_forward(y_embed)  # [B, T_y, enc_size]
-        # x_enc = x_embed
-        # y_enc = y_embed
-
         if self.dist in ["bernoulli-RF", "bernoulli-ST", "concrete"]:
 
-            # compute keys and queries.
-            keys = self.key_layer(x_enc) # [B, T_x, hidden_size]
-            queries = self.query_layer(y_enc) # [B, T_y, hidden_size]
-
             # Compute the scores as dot attention between source and target.
-            logits = torch.bmm(queries, keys.transpose(1, 2)) # [B, T_y, T_x]
-
-            if self.dist == "bernoulli-RF":
-                return BernoulliREINFORCE(logits=logits, validate_args=True)
-            elif self.dist == "bernoulli-ST":
-                return BernoulliStraightThrough(logits=logits, validate_args=True)
-            elif self.dist == "concrete":
-                logits = torch.clamp(logits, -5., 5.)
-                return BinaryConcrete(temperature=logits.new([1.0]), logits=logits, validate_args=True) # TODO
+            x_enc, y_enc = self.encode(x, y)
+            logits = self._maybe_checkpoint(self._attention_logits, x_enc, y_enc) # [B, T_y, T_x]
+            return self.distribution(logits)
 
-        elif self.dist in ["kuma", "hardkuma"]:
+        x_enc, y_enc = self.encode(x, y)
+        if self.dist in ["kuma", "hardkuma"]:
 
             # Not supported at the moment.
             raise NotImplementedError()
@@ -102,11 +129,114 @@ class InferenceNetwork(nn.Module):
         else:
             raise Exception(f"Unknown dist option: {self.dist}")
 
+    def encode(self, x, y):
+        """
+        Returns the encodings of the source [B, T_x, enc_size] and target [B, T_y, enc_size]
+        sentences.
+        """
+
+        # Embed the source and target words.
+        x_embed = self.src_embedder(x) # [B, T_x, emb_size]
+        y_embed = self.tgt_embedder(y) # [B, T_y, emb_size]
+
+        # Encode both sentences, the padding masks are used by the conv and attention encoders.
+        seq_mask_x = x != self.pad_idx
+        seq_mask_y = y != self.pad_idx
+        x_enc, _ = self._maybe_checkpoint(self.src_encoder.unsorted_forward, x_embed,
+                                          seq_mask_x) # [B, T_x, enc_size]
+        y_enc, _ = self._maybe_checkpoint(self.tgt_encoder.unsorted_forward, y_embed,
+                                          seq_mask_y) # [B, T_y, enc_size]
+        # x_enc = x_embed
+        # y_enc = y_embed
+        return x_enc, y_enc
+
+    def keys_and_queries(self, x, y):
+        """
+        Returns the keys [B, T_x, hidden_size] and queries [B, T_y, hidden_size] whose dot
+        products are the alignment logits.
+        """
+        x_enc, y_enc = self.encode(x, y)
+        return self.key_layer(x_enc), self.query_layer(y_enc)
+
+    def _attention_logits(self, x_enc, y_enc):
+        keys = self.key_layer(x_enc) # [B, T_x, hidden_size]
+        queries = self.query_layer(y_enc) # [B, T_y, hidden_size]
+        return torch.bmm(queries, keys.transpose(1, 2)) # [B, T_y, T_x]
+
+    def _maybe_checkpoint(self, function, *args):
+        """
+        Calls function, if checkpoint_activations is set its intermediate activations are
+        not stored but recomputed in the backward pass.
+        """
+        if self.checkpoint_activations and torch.is_grad_enabled():
+            return checkpoint(function, *args, use_reentrant=False)
+        return function(*args)
+
+    def distribution(self, logits):
+        """
+        Returns the distribution over alignments given (a block of) the alignment logits.
+        """
+        if self.dist == "bernoulli-RF":
+            return BernoulliREINFORCE(logits=logits, validate_args=self.validate_args)
+        elif self.dist == "bernoulli-ST":
+            return BernoulliStraightThrough(logits=logits, validate_args=self.validate_args)
+        elif self.dist == "concrete":
+            logits = torch.clamp(logits, -5., 5.)
+            return BinaryConcrete(temperature=logits.new([1.0]), logits=logits,
+                                  validate_args=self.validate_args) # TODO
+        else:
+            raise Exception(f"Unknown dist option: {self.dist}")
+
+def band_mask(seq_len_x, seq_len_y, band_width, j0, j1, i0, i1):
+    """
+    Returns a [B, j1-j0, i1-i0] mask of the cells (j, i) for which source position i is
+    within band_width of the diagonal position of target position j, which is
+    (j + 0.5) * len_x / len_y - 0.5.
+    """
+    scale = (seq_len_x.float() / seq_len_y.float().clamp(min=1.)).view(-1, 1, 1) # [B, 1, 1]
+    j = torch.arange(j0, j1, device=seq_len_x.device, dtype=torch.float).view(1, -1, 1)
+    i = torch.arange(i0, i1, device=seq_len_x.device, dtype=torch.float).view(1, 1, -1)
+    center = (j + 0.5) * scale - 0.5 # [B, c, 1]
+    return (i - center).abs() <= band_width
+
+def gather_candidates(values, candidates):
+    """
+    Gathers the values [B, T_x, D] of the candidate source positions [B, T_y, k] of each
+    target position, returns [B, T_y, k, D].
+    """
+    batch_size, T_y, k = candidates.size()
+    idx = candidates.view(batch_size, T_y * k, 1).expand(-1, -1, values.size(-1))
+    return values.gather(1, idx).view(batch_size, T_y, k, values.size(-1))
+
 class AlignmentVAE(nn.Module):
 
+    # The methods that are compiled for training by train_utils.compile_model, these only
+    # compute on tensors whose shapes are fixed by the batch shape.
+    compiled_methods = ["inf_network._attention_logits", "_pool", "output_neg_log_likelihood",
+                        "_loss_from_terms"]
+
     def __init__(self, dist, prior_params, src_vocab_size, tgt_vocab_size, emb_size, hidden_size,
                  pad_idx, pooling, bidirectional, num_layers, cell_type, max_sentence_length,
-                 use_mean_cv=False, use_std_cv=False, use_self_critic_cv=False):
+                 use_mean_cv=False, use_std_cv=False, use_self_critic_cv=False, validate_args=False,
+                 lexical_table=False, output_layer="full", adaptive_cutoffs=(), num_sampled=1024,
+                 sparse_embeddings=False, encoder_type="rnn", num_heads=4,
+                 checkpoint_activations=False):
+        """
+        :param validate_args: validate the arguments of all distributions, for debugging.
+        :param output_layer: full|adaptive|sampled. adaptive uses an adaptive softmax with
+                             clusters at adaptive_cutoffs, sampled estimates the softmax
+                             during training with num_sampled negative words drawn from a
+                             log-uniform distribution, and uses the full softmax otherwise.
+                             Both assume that target word ids are sorted by frequency.
+        :param lexical_table: create a LexicalTable to select candidate source positions
+                              for candidate_loss.
+        :param encoder_type: rnn|conv|attention, the encoders of the inference network. conv
+                             and attention encode all positions in parallel, attention uses
+                             num_heads attention heads.
+        :param checkpoint_activations: recompute the activations of the encoders and the
+                                       alignment logits of the inference network in the
+                                       backward pass instead of storing them.
+        """
         super().__init__()
         self.src_vocab_size = src_vocab_size
         self.tgt_vocab_size = tgt_vocab_size
@@ -115,8 +245,23 @@ class AlignmentVAE(nn.Module):
         self.dist = dist
         self.pooling = pooling
         self.prior_params = prior_params
-        self.src_embedder = nn.Embedding(src_vocab_size, emb_size, padding_idx=pad_idx)
-        self.categorical_layer = nn.Linear(emb_size, tgt_vocab_size)
+        self.validate_args = validate_args
+        self.output_layer = output_layer
+        self.num_sampled = num_sampled
+        self.src_embedder = nn.Embedding(src_vocab_size, emb_size, padding_idx=pad_idx,
+                                         sparse=sparse_embeddings)
+        if output_layer in ["full", "sampled"]:
+            self.categorical_layer = nn.Linear(emb_size, tgt_vocab_size)
+        elif output_layer == "adaptive":
+            cutoffs = [cutoff for cutoff in adaptive_cutoffs if cutoff < tgt_vocab_size - 1]
+            if len(cutoffs) == 0:
+                raise Exception(f"No adaptive softmax cutoffs {adaptive_cutoffs} are smaller"
+                                f" than the target vocabulary size {tgt_vocab_size}")
+            self.categorical_layer = nn.AdaptiveLogSoftmaxWithLoss(emb_size, tgt_vocab_size,
+                                                                   cutoffs=cutoffs,
+                                                                   div_value=4.)
+        else:
+            raise Exception(f"Unknown output_layer option: {output_layer}")
         self.inf_network = InferenceNetwork(dist=dist,
                                             src_vocab_size=src_vocab_size,
                                             tgt_vocab_size=tgt_vocab_size,
@@ -125,7 +270,12 @@ class AlignmentVAE(nn.Module):
                                             pad_idx=pad_idx,
                                             bidirectional=bidirectional,
                                             num_layers=num_layers,
-                                            cell_type=cell_type)
+                                            cell_type=cell_type,
+                                            validate_args=validate_args,
+                                            sparse_embeddings=sparse_embeddings,
+                                            encoder_type=encoder_type,
+                                            num_heads=num_heads,
+                                            checkpoint_activations=checkpoint_activations)
 
         if dist == "bernoulli-RF":
             self.register_buffer("avg_reward", torch.Tensor([0.]))
@@ -135,12 +285,27 @@ class AlignmentVAE(nn.Module):
             self.use_std_cv = use_std_cv
             self.use_self_critic_cv = use_self_critic_cv
 
+        if lexical_table:
+            self.lexical_table = LexicalTable(src_vocab_size, tgt_vocab_size)
+
+        # The prior parameters are also kept in a buffer, such that they follow the model to
+        # its device and can differ between replicas that are trained as one stacked model
+        # (see Replicas).
+        self.register_buffer("prior_param_values", torch.tensor(prior_params).float(),
+                             persistent=False)
+
+        if "bernoulli" in dist:
+            self._create_bernoulli_prior_table(max_sentence_length)
         if dist == "hardkuma":
                 self._create_hardkuma_prior_table(prior_params[0], max_sentence_length)
 
     def prior(self, seq_mask_x, seq_len_x, seq_mask_y):
         """
             Prior 1 / src_length.
+
+            The prior only depends on the source sentence, so its parameters are of shape
+            [B, 1, T_x] (or [1, 1, 1] for a fixed prior) and broadcast over the target
+            positions, rather than being tiled to [B, T_y, T_x].
         """
 
         prior_param_1, prior_param_2 = self.prior_params
@@ -148,29 +313,32 @@ class AlignmentVAE(nn.Module):
 
         if "bernoulli" in self.dist:
             if prior_param_1 > 0:
-                # prior_param_1 words per sentence
-                probs = prior_param_1 * (seq_mask_x.float() + epsilon) / (seq_len_x.unsqueeze(-1).float() + 1)
-                probs = torch.clamp(probs, max=(1-0.01))
-                probs = probs.unsqueeze(1).repeat(1, seq_mask_y.size(1), 1)
+                # prior_param_1 words per sentence, the probabilities per source length are
+                # tabulated up to max_sentence_length.
+                if seq_mask_x.size(1) <= self.bernoulli_prior_table.size(1):
+                    probs = self.bernoulli_prior_table[seq_len_x, :seq_mask_x.size(1)]
+                else:
+                    probs = (seq_mask_x.float() + epsilon) / (seq_len_x.unsqueeze(-1).float() + 1)
+                probs = torch.clamp(self.prior_param_values[0] * probs, max=(1-0.01))
+                probs = probs.unsqueeze(1) # [B, 1, T_x]
             elif prior_param_2 > 0:
                 # fixed prior_param_2 probability of an alignment
-                probs = seq_mask_x.float().new_full(prior_shape, fill_value=prior_param_2)
+                probs = self.prior_param_values[1].view(1, 1, 1) # [1, 1, 1]
             else:
                 raise Exception(f"Invalid prior params for Bernoulli ({prior_param_1}, {prior_param_2})")
 
-            return BernoulliREINFORCE(probs=probs, validate_args=True) # [B, T_y, T_x]
+            return BernoulliREINFORCE(probs=probs, validate_args=self.validate_args) # broadcasts to [B, T_y, T_x]
         elif self.dist == "concrete":
             raise NotImplementedError()
         elif self.dist in ["kuma", "hardkuma"]:
 
             if prior_param_1 > 0 and prior_param_2 > 0:
-                p = Kumaraswamy(seq_mask_x.float().new_full(prior_shape, fill_value=prior_param_1),
-                                seq_mask_x.float().new_full(prior_shape, fill_value=prior_param_2))
+                p = Kumaraswamy(self.prior_param_values[0].view(1, 1, 1).expand(prior_shape),
+                                self.prior_param_values[1].view(1, 1, 1).expand(prior_shape))
             elif self.dist == "hardkuma" and prior_param_1 > 0:
-                seq_len_numpy = seq_len_x.cpu().numpy()
-                a = seq_len_x.float().new_tensor([self.hardkuma_prior_table[length][0] for length in seq_len_numpy]) # [B]
-                a = a.unsqueeze(-1).unsqueeze(-1).repeat(1, seq_mask_y.size(1), seq_mask_x.size(1))
-                b = torch.ones_like(a)
+                a = self.hardkuma_prior_a[seq_len_x] # [B]
+                a = a.view(-1, 1, 1).expand(prior_shape)
+                b = a.new_ones([1, 1, 1]).expand(prior_shape)
                 p = Kumaraswamy(a, b)
             else:
                 raise Exception(f"Invalid Kumaraswamy parameters a={prior_param_1}, b={prior_param_2}")
@@ -180,36 +348,42 @@ class AlignmentVAE(nn.Module):
             else:
                 return Rectified01(Stretched(p, lower=-0.1, upper=1.1))
 
+    def _create_bernoulli_prior_table(self, max_sentence_length):
+        """
+        Creates a table of the Bernoulli prior probabilities for prior_param_1 = 1, indexed by
+        source length and source position, such that the prior of a batch of source lengths
+        is gathered from it rather than computed.
+        """
+        lengths = torch.arange(max(max_sentence_length, 0) + 1, dtype=torch.float)
+        positions = torch.arange(max(max_sentence_length, 0), dtype=torch.float)
+        mask = (positions.unsqueeze(0) < lengths.unsqueeze(-1)).float()
+        table = (mask + epsilon) / (lengths.unsqueeze(-1) + 1) # [max_length + 1, max_length]
+        self.register_buffer("bernoulli_prior_table", table, persistent=False)
+
     def _create_hardkuma_prior_table(self, prior_param_1, max_sentence_length, l=-0.1, r=1.1, N=10000):
         """
         Creates a prior table for the HardKuma. Fixes b=1.0
-        """
-        kuma_priors = []
-        l = torch.Tensor([l])
-        r = torch.Tensor([r])
 
-        # Create a list of (a, 1.0, CDF(0))
+        The table is a buffer of a parameters indexed by sentence length, such that the
+        prior can be gathered for a batch of sentence lengths.
+        """
         with torch.no_grad():
-            b = torch.Tensor([1.0])
-            for a in torch.linspace(start=epsilon, end=1., steps=N):
-                pk = Kumaraswamy(a, b)
-
-                # Compute the position of 0 in the stretched distribution.
-                k0 = -l / (r - l)
-                kuma_priors.append((a.item(), b.item(), pk.cdf(k0).item()))
-        kuma_priors = sorted(kuma_priors, key=lambda elem: elem[0])
-
-        # Tabulate priors for every possible sentence length.
-        # P(0) = 1 - (prior_param_1 / (l+1))
-        self.hardkuma_prior_table = {}
-        for length in range(1, max_sentence_length+1):
-            p0 = 1.0 - min(((1.0 + epsilon) / (length + 1.0)), 1.0 - epsilon)
-            idx = 0
-            cdf0 = float("inf")
-            while cdf0 > p0 and idx != len(kuma_priors):
-                a, b, cdf0 = kuma_priors[idx]
-                idx += 1
-            self.hardkuma_prior_table[length] = (a, b)
+            a = torch.linspace(start=epsilon, end=1., steps=N)
+            b = 1.0
+
+            # Compute CDF(0) for all a at once: the position of 0 in the stretched
+            # distribution is k0, and the Kumaraswamy CDF is 1 - (1 - x^a)^b. CDF(0)
+            # decreases with a.
+            k0 = -l / (r - l)
+            cdf0 = 1. - (1. - k0 ** a) ** b
+
+            # Tabulate priors for every possible sentence length: take the smallest a with
+            # CDF(0) <= P(0), or the largest a if there is none.
+            # P(0) = 1 - (prior_param_1 / (l+1))
+            lengths = torch.arange(max(max_sentence_length, 0) + 1, dtype=torch.float)
+            p0 = 1.0 - torch.clamp((1.0 + epsilon) / (lengths + 1.0), max=1.0 - epsilon)
+            idx = torch.searchsorted(-cdf0, -p0).clamp(max=N-1)
+        self.register_buffer("hardkuma_prior_a", a[idx], persistent=False)
 
     # def _get_hardkuma_prior_a(self, p0):
     #     """
@@ -227,35 +401,187 @@ class AlignmentVAE(nn.Module):
         return self.inf_network(x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y)
 
     def forward(self, x, A):
+        """
+        Returns the logits of the full target vocabulary [B, T_y, vocab_size_y] given the
+        alignments.
 
-        # Tile the embeddings.
+        :param A: alignments of shape [B, T_y, T_x].
+        """
+        return self.output_logits(self.pool(x, A))
+
+    def pool(self, x, A, A_critic=None):
+        """
+        Returns the source embeddings pooled according to the alignments, the input to the
+        output layer.
+
+        :param A: alignments of shape [..., B, T_y, T_x].
+        :param A_critic: optional alignments of shape [B, T_y, T_x] for the self-critic
+                         baseline. If given, A and A_critic are pooled in a single batched
+                         matmul over the shared source embeddings in which only A is recorded
+                         for the backward pass, and (pooled_x, critic_pooled_x) is returned.
+        """
         x_embed = self.src_embedder(x)  # [B, T_x, emb_size]
-        x_embed = x_embed.unsqueeze(1).repeat(1, A.size(1), 1, 1) # [B, T_y, T_x, emb_size]
 
-        # Perform average pooling of the embeddings according to A.
-        pooled_x = x_embed * A.unsqueeze(-1) # [B, T_y, T_x, emb_size] * [B, T_y, T_x, 1]
+        if A_critic is None:
+            return self._pool(x_embed, A)
+
+        pooled_x, critic_pooled_x = _SharedCriticMatmul.apply(A, A_critic.detach(), x_embed)
+        with torch.no_grad():
+            critic_pooled_x = self._average(critic_pooled_x, A_critic)
+        return self._average(pooled_x, A), critic_pooled_x
 
+    def _pool(self, x_embed, A):
+        """
+        Pools the source embeddings [B, T_x, emb_size] according to the alignments
+        [..., B, T_y, T_x], any leading dimensions of A are broadcast. The source embeddings
+        can also be given per target position [B, T_y, k, emb_size], for alignments
+        [B, T_y, k] to candidate source positions.
+        """
+
+        # Sum the embeddings of the aligned source words for each target word.
+        if x_embed.dim() == 4:
+            pooled_x = torch.matmul(A.unsqueeze(-2), x_embed).squeeze(-2) # [B, T_y, emb_size]
+        else:
+            pooled_x = torch.matmul(A, x_embed) # [..., B, T_y, emb_size]
+
+        return self._average(pooled_x, A)
+
+    def _average(self, pooled_x, A):
+        """
+        Turns the summed source embeddings into averages for average pooling.
+        """
         if self.pooling == "avg":
             # Average pooling
-            pooled_x = pooled_x.sum(dim=2) / \
-                    (A.unsqueeze(-1).sum(dim=2) + epsilon) # [B, T_y, emb_size]
+            pooled_x = pooled_x / (A.sum(dim=-1, keepdim=True) + epsilon) # [..., B, T_y, emb_size]
+
+        return pooled_x
+
+    def output_logits(self, pooled_x):
+        """
+        Returns the logits of the full target vocabulary [..., vocab_size_y] (log-probabilities
+        for the adaptive softmax) given the pooled source embeddings [..., emb_size].
+        """
+        if self.output_layer == "adaptive":
+            log_probs = self.categorical_layer.log_prob(pooled_x.reshape(-1, pooled_x.size(-1)))
+            return log_probs.view(pooled_x.shape[:-1] + (-1,))
+        return self.categorical_layer(pooled_x)
+
+    def output_neg_log_likelihood(self, pooled_x, y, negatives=None):
+        """
+        Computes -log P(y_j|x, a_j) with the output layer, without computing the full
+        vocabulary logits for the adaptive softmax, or for the sampled softmax during
+        training.
+
+        :param pooled_x: [..., B, T_y, emb_size], leading dimensions are broadcast over y.
+        :param y: [B, T_y]
+        :param negatives: the negative words for the sampled softmax, if not given they are
+                          sampled.
+        :returns: -log P(y_j|x, a_j) of shape [..., B, T_y], 0 at padding positions.
+        """
+        if self.output_layer == "full" or (self.output_layer == "sampled" and not self.training):
+            return self.neg_log_likelihood(self.categorical_layer(pooled_x), y)
+
+        shape = pooled_x.shape[:-1]
+        hidden = pooled_x.reshape(-1, pooled_x.size(-1)) # [N, emb_size]
+        target = y.expand(shape).reshape(-1) # [N]
+        if self.output_layer == "adaptive":
+            neg_log_py_xa = -self.categorical_layer(hidden, target).output
         else:
-            # Sum pooling
-            pooled_x = pooled_x.sum(dim=2) # [B, T_y, emb_size]
-
-        # Compute the categorical logits.
-        logits = self.categorical_layer(pooled_x)
-        return logits
-
-    def cv_self_critic(self, x, y, qa):
-        # TODO check with no_gradient if faster
-        A_argmax = qa.mean.round()
-        logits = self.forward(x, A_argmax)
-        logits = logits.permute(0, 2, 1)
-        self_critic_score = -F.cross_entropy(logits, y, ignore_index=self.pad_idx,
-                                             reduction="none") # [B, T_y]
+            if negatives is None:
+                negatives = self.sample_negatives(y.device)
+            neg_log_py_xa = self._sampled_softmax_loss(hidden, target, negatives)
+        neg_log_py_xa = neg_log_py_xa.masked_fill(target == self.pad_idx, 0.)
+        return neg_log_py_xa.view(shape)
+
+    def output_neg_log_likelihood_with_critic(self, pooled_x, critic_pooled_x, y,
+                                              negatives=None):
+        """
+        Computes -log P(y_j|x, a_j) [B, T_y] for the pooled source embeddings of the sampled
+        and of the self-critic alignments, the latter without gradients. With the full output
+        layer the logits of both are computed in a single batched matmul in which only the
+        sampled alignments are recorded for the backward pass.
+        """
+        if self.output_layer == "full" or (self.output_layer == "sampled" and not self.training):
+            weight = self.categorical_layer.weight
+            bias = self.categorical_layer.bias
+            logits, critic_logits = _SharedCriticMatmul.apply(pooled_x, critic_pooled_x,
+                                                              weight.t())
+            neg_log_py_xa = self.neg_log_likelihood(logits + bias, y)
+            with torch.no_grad():
+                critic_neg_log_py_xa = self.neg_log_likelihood(critic_logits + bias, y)
+            return neg_log_py_xa, critic_neg_log_py_xa
+
+        neg_log_py_xa = self.output_neg_log_likelihood(pooled_x, y, negatives)
+        with torch.no_grad():
+            critic_neg_log_py_xa = self.output_neg_log_likelihood(critic_pooled_x, y, negatives)
+        return neg_log_py_xa, critic_neg_log_py_xa
+
+    def sample_negatives(self, device):
+        """
+        Samples num_sampled negative word ids (with replacement) from the log-uniform
+        distribution Q(w) = log((w + 2) / (w + 1)) / log(V + 1), which approximates a
+        Zipfian distribution over frequency-sorted ids.
+        """
+        u = torch.rand(self.num_sampled, device=device)
+        negatives = torch.exp(u * np.log(self.tgt_vocab_size + 1.)).long() - 1
+        return negatives.clamp(0, self.tgt_vocab_size - 1)
+
+    def _log_expected_count(self, ids):
+        ids = ids.float()
+        log_q = torch.log(torch.log((ids + 2.) / (ids + 1.)) / np.log(self.tgt_vocab_size + 1.))
+        return log_q + np.log(self.num_sampled)
+
+    def _sampled_softmax_loss(self, hidden, target, negatives):
+        """
+        Sampled softmax estimate of -log P(target|hidden). The logits of the negatives are
+        corrected for the expected number of times each word is sampled, which makes the sum
+        of their exponents an importance sampling estimate of the partition function over
+        the other words, such that the estimate can be used as a reward. Negatives equal to
+        the target are ignored.
+
+        :param hidden: [N, emb_size]
+        :param target: [N]
+        :param negatives: [S]
+        :returns: [N]
+        """
+        weight = self.categorical_layer.weight
+        bias = self.categorical_layer.bias
+        true_logits = (hidden * weight[target]).sum(dim=-1) + bias[target] # [N]
+        sampled_logits = F.linear(hidden, weight[negatives], bias[negatives]) - \
+                self._log_expected_count(negatives) # [N, S]
+        sampled_logits = sampled_logits.masked_fill(target.unsqueeze(-1) == negatives,
+                                                    -float("inf"))
+        logits = torch.cat([true_logits.unsqueeze(-1), sampled_logits], dim=-1) # [N, 1 + S]
+        return -F.log_softmax(logits, dim=-1)[:, 0]
+
+    def cv_self_critic(self, x, y, qa, cell_mask, negatives=None):
+        """
+        Self-critic score of the argmax alignment, computed without gradients.
+
+        :param cell_mask: [B, T_y, T_x] mask of the cells that can be aligned.
+        """
+        with torch.no_grad():
+            A_argmax = qa.mean.round() * cell_mask.type_as(qa.mean)
+            pooled_x = self.pool(x, A_argmax)
+        return self.self_critic_score(pooled_x, y, negatives)
+
+    def self_critic_score(self, critic_pooled_x, y, negatives=None):
+        with torch.no_grad():
+            self_critic_score = -self.output_neg_log_likelihood(critic_pooled_x, y,
+                                                                negatives) # [B, T_y]
         return self_critic_score.detach()
 
+    def neg_log_likelihood(self, logits, y):
+        """
+        :param logits: [..., B, T_y, vocab_size_y], leading dimensions are broadcast over y.
+        :param y: [B, T_y]
+        :returns: -log P(y_j|x, a_j) of shape [..., B, T_y], 0 at padding positions.
+        """
+        neg_log_py_xa = F.cross_entropy(logits.reshape(-1, logits.size(-1)),
+                                        y.expand(logits.shape[:-1]).reshape(-1),
+                                        ignore_index=self.pad_idx, reduction="none")
+        return neg_log_py_xa.view(logits.shape[:-1])
+
     def update_baselines(self, new_reward, seq_len_y): # [B, T_y], [B]
         seq_len_y = seq_len_y.type_as(new_reward)
         new_reward = new_reward.sum(dim=-1) / seq_len_y # [B]
@@ -265,59 +591,101 @@ class AlignmentVAE(nn.Module):
         self.std_reward = self.alpha * new_reward.std() \
                                    + (1.0 - self.alpha) * self.std_reward
 
-    def loss(self, logits, x, y, A, seq_mask_x, seq_mask_y, pa, qa, KL_multiplier=1.0, reduction="mean"):
+    def loss(self, pooled_x, x, y, A, seq_mask_x, seq_mask_y, pa, qa, KL_multiplier=1.0,
+             reduction="mean", critic_pooled_x=None):
         """
+        :param pooled_x: the pooled source embeddings as returned by pool, [B, T_y, emb_size]
+                         or [K, B, T_y, emb_size] for K samples.
+        :param A: the alignments pooled_x was computed for, [B, T_y, T_x] or
+                  [K, B, T_y, T_x] for K samples of A. For K > 1 samples the REINFORCE
+                  baseline is the leave-one-out average reward of the other samples.
         :param pa: prior distribution.
         :param qa: distribution used to sample a.
+        :param critic_pooled_x: the pooled source embeddings for the argmax alignment as
+                                returned by pool, if not given they are recomputed for the
+                                self-critic.
         """
-        output_dict = {}
-
-        # Compute the negative complete data log-likelihood for each batch element.
-        # Logits are of the form [B, T_y, vocab_size_y], whereas the cross-entropy
-        # function wants a loss of the form [B, vocab_size_y, T_y].
-        logits = logits.permute(0, 2, 1)
-        neg_log_py_xa = F.cross_entropy(logits, y, ignore_index=self.pad_idx,
-                                        reduction="none") # [B, T_y]
+        multi_sample = A.dim() == 4
+
+        # Compute the negative complete data log-likelihood for each batch element. The
+        # self-critic uses the same negative words for the sampled softmax.
+        negatives = self.sample_negatives(y.device) \
+                if self.output_layer == "sampled" and self.training else None
+        with_critic = self.dist == "bernoulli-RF" and self.use_self_critic_cv and not multi_sample
+        if with_critic and critic_pooled_x is not None:
+            neg_log_py_xa, critic_neg_log_py_xa = self.output_neg_log_likelihood_with_critic(
+                    pooled_x, critic_pooled_x, y, negatives) # [B, T_y]
+        else:
+            neg_log_py_xa = self.output_neg_log_likelihood(pooled_x, y, negatives) # [(K), B, T_y]
         # neg_log_py_xa = neg_log_py_xa.sum(dim=1) # [B]
-        output_dict["log_py_xa"] = -neg_log_py_xa
 
-        # Compute the KL between the prior and the posterior distributions.
-        KL = torchdist.kl.kl_divergence(qa, pa)
+        # Compute the KL between the prior and the posterior distributions, summed over all
+        # independent latent alignment variables.
+        # The valid cells are packed on the CPU only, see alignment_cells.
+        cells = alignment_cells(seq_mask_x, seq_mask_y) if isinstance(qa, PackedBernoulli) \
+                else None
+        KL = self.kl_divergence(qa, pa, seq_mask_x, seq_mask_y, cells) # [B]
 
-        # Mask out padding positions.
-        KL = torch.where(seq_mask_x.unsqueeze(-1).transpose(1, 2), KL, KL.new([0.]))
-        KL = torch.where(seq_mask_y.unsqueeze(-1), KL, KL.new([0.]))
-
-        # Sum for all independent latent alignment variables.
-        KL = KL.sum(dim=-1).sum(dim=-1) # [B]
+        log_qa_sample = None
+        self_critic_score = None
+        if self.dist == "bernoulli-RF":
+            log_qa_sample = cells.sum_rows(qa.packed_log_prob(A, cells)) # [(K), B, T_y]
+            if with_critic:
+                if critic_pooled_x is not None:
+                    self_critic_score = -critic_neg_log_py_xa
+                else:
+                    self_critic_score = self.cv_self_critic(x, y, qa, cells.mask, negatives)
+
+        return self._loss_from_terms(neg_log_py_xa, KL, log_qa_sample, self_critic_score,
+                                     KL_multiplier, reduction)
+
+    def _loss_from_terms(self, neg_log_py_xa, KL, log_qa_sample, self_critic_score,
+                         KL_multiplier, reduction):
+        """
+        Computes the loss from -log P(y|x, a) [(K), B, T_y], the KL [B], and for REINFORCE
+        log q(a|x, y) of the sampled alignments [(K), B, T_y] and the self-critic score
+        [B, T_y] (or None).
+        """
+        output_dict = {}
+        multi_sample = neg_log_py_xa.dim() == 3
+        output_dict["log_py_xa"] = -neg_log_py_xa
         output_dict["KL"] = KL
 
         # The loss is the negative ELBO, where ELBO = E_qa[log P(y|x, a)] - KL(qa||pa)
-        loss = neg_log_py_xa.sum(dim=-1) + KL_multiplier * KL
-        output_dict["ELBO"] = -loss + KL_multiplier * KL - KL
+        loss = neg_log_py_xa.sum(dim=-1) + KL_multiplier * KL # [(K), B]
+        ELBO = -loss + KL_multiplier * KL - KL
+        output_dict["ELBO"] = ELBO.mean(dim=0) if multi_sample else ELBO
 
         # For REINFORCE, compute a surrogate term for the REINFORCE estimator for d/d lambda.
         if self.dist == "bernoulli-RF":
-            reward = -neg_log_py_xa.detach() # [B, T_y]
+            reward = -neg_log_py_xa.detach() # [(K), B, T_y]
 
             normalized_reward = reward
-            if self.use_self_critic_cv:
-                self_critic_score = self.cv_self_critic(x, y, qa)
-                normalized_reward = normalized_reward - self_critic_score
-                output_dict["reward_sc"] = normalized_reward
-            if self.use_mean_cv:
-                normalized_reward = normalized_reward - \
-                        self.avg_reward
+            if multi_sample:
+                # Leave-one-out baseline: the average reward of the other K-1 samples.
+                num_samples = reward.size(0)
+                baseline = (reward.sum(dim=0, keepdim=True) - reward) / (num_samples - 1)
+                normalized_reward = normalized_reward - baseline
+            else:
+                if self_critic_score is not None:
+                    normalized_reward = normalized_reward - self_critic_score
+                    output_dict["reward_sc"] = normalized_reward
+                if self.use_mean_cv:
+                    normalized_reward = normalized_reward - \
+                            self.avg_reward
             if self.use_std_cv:
                 normalized_reward = normalized_reward /\
                          self.std_reward.clamp(min=1.0)
 
-            log_qa_sample = qa.log_prob(A).sum(dim=-1) # [B, T_y]
-            loss = loss - (normalized_reward * log_qa_sample).sum(dim=-1) # [B]
+            loss = loss - (normalized_reward * log_qa_sample).sum(dim=-1) # [(K), B]
 
             output_dict["reward"] = reward
             output_dict["normalized_reward"] = normalized_reward
 
+        # Average the loss over samples of A.
+        if multi_sample:
+            loss = loss.mean(dim=0) # [B]
+
         # Do sum over the time dimension if reduction is none.
         if reduction == "mean":
             output_dict["loss"] = loss.mean()
@@ -330,14 +698,230 @@ class AlignmentVAE(nn.Module):
 
         return output_dict
 
+    def chunked_loss(self, x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y, chunk_size,
+                     band_width=-1, KL_multiplier=1.0, reduction="mean"):
+        """
+        Computes the same loss as loss() for bernoulli-RF and bernoulli-ST, without ever
+        materializing the [B, T_y, T_x] logits or pooling over the full alignment matrix.
+
+        Target positions are processed in blocks of chunk_size: the scores, sample, log
+        q(a|x, y), KL and generative pass of a block are computed together and recomputed in
+        the backward pass, so only one block of activations is alive at a time. If
+        band_width >= 0 target position j can only align to the source positions within
+        band_width of the diagonal, and each block only scores the source window covering
+        its band. Alignments outside the band are 0 under q, their KL to the prior is added
+        in closed form.
+
+        :returns: the output dict of loss(), and the sampled alignments as a [B, T_y, T_x]
+                  bool tensor.
+        """
+        if self.dist not in ["bernoulli-RF", "bernoulli-ST"]:
+            raise Exception(f"Chunked training is not supported for {self.dist}")
+
+        batch_size, T_x = x.size()
+        T_y = y.size(1)
+        keys, queries = self.inf_network.keys_and_queries(x, y)
+        x_embed = self.src_embedder(x) # [B, T_x, emb_size]
+        prior_logits = self.prior(seq_mask_x, seq_len_x, seq_mask_y).logits
+        prior_logits = prior_logits.expand(batch_size, 1, T_x) # [B, 1, T_x]
+        with_critic = self.dist == "bernoulli-RF" and self.use_self_critic_cv
+
+        KL = self._zero_alignment_kl(prior_logits, seq_mask_x, seq_len_y) # [B]
+
+        A = torch.zeros(batch_size, T_y, T_x, dtype=torch.bool, device=x.device)
+        neg_log_py_xa, log_qa_sample, self_critic_score = [], [], []
+        for j0, j1, i0, i1 in self._chunk_windows(seq_len_x, seq_len_y, T_x, T_y, chunk_size,
+                                                  band_width):
+            cell_mask = seq_mask_y[:, j0:j1].unsqueeze(-1) & seq_mask_x[:, i0:i1].unsqueeze(1)
+            if band_width >= 0:
+                cell_mask = cell_mask & band_mask(seq_len_x, seq_len_y, band_width, j0, j1,
+                                                  i0, i1)
+            block = checkpoint(self._chunk_terms, queries[:, j0:j1], keys[:, i0:i1],
+                               x_embed[:, i0:i1], y[:, j0:j1], cell_mask,
+                               prior_logits[:, :, i0:i1], with_critic, use_reentrant=False)
+            neg_log_py_xa_c, log_qa_c, KL_c, critic_c, A_c = block
+            neg_log_py_xa.append(neg_log_py_xa_c)
+            log_qa_sample.append(log_qa_c)
+            self_critic_score.append(critic_c)
+            KL = KL + KL_c
+            A[:, j0:j1, i0:i1] = A_c.detach() > 0.
+
+        neg_log_py_xa = torch.cat(neg_log_py_xa, dim=-1) # [B, T_y]
+        log_qa_sample = torch.cat(log_qa_sample, dim=-1) if self.dist == "bernoulli-RF" else None
+        self_critic_score = torch.cat(self_critic_score, dim=-1) if with_critic else None
+        output_dict = self._loss_from_terms(neg_log_py_xa, KL, log_qa_sample, self_critic_score,
+                                            KL_multiplier, reduction)
+        return output_dict, A
+
+    def candidate_posterior(self, x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y,
+                            num_candidates):
+        """
+        Approximate posterior over the alignments of each target position to its
+        num_candidates highest scoring source positions according to the lexical table.
+
+        :returns: q(a|x, y) with parameters of shape [B, T_y, k], the candidate source
+                  positions [B, T_y, k] and a mask of the valid candidates [B, T_y, k].
+        """
+        candidates, candidate_mask = self.lexical_table.candidates(x, seq_mask_x, seq_len_x, y,
+                                                                   seq_mask_y, seq_len_y,
+                                                                   num_candidates)
+        keys, queries = self.inf_network.keys_and_queries(x, y)
+        keys = gather_candidates(keys, candidates) # [B, T_y, k, hidden_size]
+        logits = torch.matmul(keys, queries.unsqueeze(-1)).squeeze(-1) # [B, T_y, k]
+        return self.inf_network.distribution(logits), candidates, candidate_mask
+
+    def candidate_loss(self, x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y, num_candidates,
+                       KL_multiplier=1.0, reduction="mean"):
+        """
+        Computes the same loss as loss() for bernoulli-RF and bernoulli-ST, but only the
+        alignments to the candidate source positions of each target position are latent,
+        all others are 0. The scores, samples, log q(a|x, y), KL and pooling are computed
+        on the [B, T_y, k] candidates, the KL of the other alignments is added in closed
+        form.
+
+        :returns: the output dict of loss(), and the sampled alignments as a [B, T_y, T_x]
+                  bool tensor.
+        """
+        if self.dist not in ["bernoulli-RF", "bernoulli-ST"]:
+            raise Exception(f"Candidate alignments are not supported for {self.dist}")
+
+        batch_size, T_x = x.size()
+        T_y = y.size(1)
+        qa, candidates, candidate_mask = self.candidate_posterior(x, seq_mask_x, seq_len_x, y,
+                                                                  seq_mask_y, seq_len_y,
+                                                                  num_candidates)
+        x_embed = gather_candidates(self.src_embedder(x), candidates) # [B, T_y, k, emb_size]
+        prior_logits = self.prior(seq_mask_x, seq_len_x, seq_mask_y).logits
+        prior_logits = prior_logits.expand(batch_size, 1, T_x) # [B, 1, T_x]
+        KL = self._zero_alignment_kl(prior_logits, seq_mask_x, seq_len_y) # [B]
+        prior_logits = prior_logits.expand(batch_size, T_y, T_x).gather(2, candidates) # [B, T_y, k]
+
+        with_critic = self.dist == "bernoulli-RF" and self.use_self_critic_cv
+        neg_log_py_xa, log_qa_sample, KL_c, self_critic_score, A_c = self._sparse_terms(
+                qa.logits, x_embed, y, candidate_mask, prior_logits, with_critic)
+        KL = KL + KL_c
+
+        A = torch.zeros(batch_size, T_y, T_x, dtype=torch.bool, device=x.device)
+        A.scatter_(2, candidates, A_c.detach() > 0.)
+        if self.dist != "bernoulli-RF":
+            log_qa_sample = None
+        output_dict = self._loss_from_terms(neg_log_py_xa, KL, log_qa_sample, self_critic_score,
+                                            KL_multiplier, reduction)
+        return output_dict, A
+
+    def _zero_alignment_kl(self, prior_logits, seq_mask_x, seq_len_y):
+        """
+        Returns the KL [B] of all valid alignment variables if they are 0 under q. This is
+        -log(1 - p) = softplus(logit_p) for each variable.
+
+        :param prior_logits: [B, 1, T_x]
+        """
+        KL_zero = torch.where(seq_mask_x, F.softplus(prior_logits.squeeze(1)),
+                              prior_logits.new([0.])) # [B, T_x]
+        return KL_zero.sum(dim=-1) * seq_len_y.type_as(KL_zero) # [B]
+
+    def _chunk_terms(self, queries, keys, x_embed, y, cell_mask, prior_logits, with_critic):
+        """
+        Computes the loss terms for a block of c target positions and a window of w source
+        positions.
+        """
+        logits = torch.bmm(queries, keys.transpose(1, 2)) # [B, c, w]
+        return self._sparse_terms(logits, x_embed, y, cell_mask, prior_logits, with_critic)
+
+    def _sparse_terms(self, logits, x_embed, y, cell_mask, prior_logits, with_critic):
+        """
+        Computes the loss terms for a subset of n alignment variables per target position.
+
+        :param logits: [B, c, n]
+        :param x_embed: the source embeddings [B, n, emb_size], or [B, c, n, emb_size] if
+                        each target position has its own source positions.
+        :param cell_mask: [B, c, n]
+        :param prior_logits: [B, 1 or c, n]
+        :returns: -log P(y_j|x, a_j) [B, c], log q(a_j|x, y) [B, c], the KL of the given
+                  alignment variables minus their KL if they were 0 [B], the self-critic
+                  score [B, c] (or None) and the sampled alignments [B, c, n].
+        """
+        qa = self.inf_network.distribution(logits)
+        mask = cell_mask.type_as(logits)
+        A = qa.rsample() * mask
+
+        negatives = self.sample_negatives(y.device) \
+                if self.output_layer == "sampled" and self.training else None
+        neg_log_py_xa = self.output_neg_log_likelihood(self._pool(x_embed, A), y, negatives)
+        log_qa = (bernoulli_log_prob(logits, A.detach()) * mask).sum(dim=-1) # [B, c]
+        KL = (bernoulli_kl(logits, prior_logits) - F.softplus(prior_logits)) * mask
+        KL = KL.sum(dim=-1).sum(dim=-1) # [B]
+
+        self_critic_score = None
+        if with_critic:
+            with torch.no_grad():
+                A_argmax = (logits > 0.).type_as(logits) * mask
+                critic_pooled_x = self._pool(x_embed, A_argmax)
+            self_critic_score = self.self_critic_score(critic_pooled_x, y, negatives)
+        return neg_log_py_xa, log_qa, KL, self_critic_score, A
+
+    def _chunk_windows(self, seq_len_x, seq_len_y, T_x, T_y, chunk_size, band_width):
+        """
+        Returns the (j0, j1, i0, i1) target blocks and source windows to score.
+        """
+        chunk_size = chunk_size if chunk_size > 0 else T_y
+        if band_width < 0:
+            return [(j0, min(j0 + chunk_size, T_y), 0, T_x) for j0 in range(0, T_y, chunk_size)]
+
+        # The window of a block spans the bands of its first and last valid target position
+        # in any sentence pair, the band centers increase with j.
+        len_x = seq_len_x.cpu().numpy().astype(np.float64)
+        len_y = seq_len_y.cpu().numpy().astype(np.float64)
+        windows = []
+        for j0 in range(0, T_y, chunk_size):
+            j1 = min(j0 + chunk_size, T_y)
+            valid = len_y > j0
+            first = (j0 + 0.5) * len_x[valid] / len_y[valid] - 0.5 - band_width
+            last = (np.minimum(j1, len_y[valid]) - 0.5) * len_x[valid] / len_y[valid] - 0.5 + band_width
+            # Allow for rounding differences with band_mask, which masks the window exactly.
+            i0 = max(0, int(np.ceil(first.min() - 1e-3)))
+            i1 = min(T_x, int(np.floor(last.max() + 1e-3)) + 1)
+            windows.append((j0, j1, i0, max(i1, i0 + 1)))
+        return windows
+
+    def alignment_mask(self, seq_mask_x, seq_len_x, seq_mask_y, seq_len_y, band_width=-1):
+        """
+        Returns the [B, T_y, T_x] mask of alignment variables that can be 1: non-padding
+        positions, within band_width of the diagonal if band_width >= 0.
+        """
+        cell_mask = seq_mask_y.unsqueeze(-1) & seq_mask_x.unsqueeze(1)
+        if band_width >= 0:
+            cell_mask = cell_mask & band_mask(seq_len_x, seq_len_y, band_width, 0,
+                                              seq_mask_y.size(1), 0, seq_mask_x.size(1))
+        return cell_mask
+
+    def kl_divergence(self, qa, pa, seq_mask_x, seq_mask_y, cells=None):
+        """
+        Returns KL(qa||pa) summed over all valid alignment variables of each sentence
+        pair [B]. If a cell index from alignment_cells is given (qa must be a PackedBernoulli)
+        the KL is computed through it, otherwise over the padded [B, T_y, T_x] grid.
+        """
+        if cells is not None:
+            return cells.sum_batch(qa.packed_kl(pa, cells))
+
+        KL = torchdist.kl.kl_divergence(qa, pa)
+
+        # Mask out padding positions.
+        KL = torch.where(seq_mask_x.unsqueeze(-1).transpose(1, 2), KL, KL.new([0.]))
+        KL = torch.where(seq_mask_y.unsqueeze(-1), KL, KL.new([0.]))
+
+        # Sum for all independent latent alignment variables.
+        return KL.sum(dim=-1).sum(dim=-1) # [B]
+
     def ppo_loss(self, x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y, A, pa, qa_init,
                  log_py_xa, eps, KL_multiplier=1., reward=None):
         output_dict = {}
 
         # Compute the ratio for IS and clip it.
-        log_qa_init = qa_init.log_prob(A).sum(dim=-1)
+        cells = alignment_cells(seq_mask_x, seq_mask_y)
+        log_qa_init = cells.sum_rows(qa_init.packed_log_prob(A, cells))
         qa_new = self.approximate_posterior(x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y)
-        log_qa_new = qa_new.log_prob(A).sum(dim=-1) # [B, T_y]
+        log_qa_new = cells.sum_rows(qa_new.packed_log_prob(A, cells)) # [B, T_y]
         ratio = torch.exp(log_qa_new - log_qa_init.detach())
         ratio_c = ratio.clamp(min=1.0-eps, max=1.0+eps)
 
@@ -348,7 +932,7 @@ class AlignmentVAE(nn.Module):
         if reward is None:
             reward = log_py_xa.detach()
             if self.use_self_critic_cv:
-                self_critic_score = self.cv_self_critic(x, y, qa_new)
+                self_critic_score = self.cv_self_critic(x, y, qa_new, cells.mask)
                 reward = reward - self_critic_score
                 output_dict["reward_sc"] = reward
             if self.use_mean_cv:
@@ -357,14 +941,7 @@ class AlignmentVAE(nn.Module):
                 reward = reward / self.std_reward.clamp(min=1.0)
 
         # Compute the KL between the prior and the posterior distributions.
-        KL = torchdist.kl.kl_divergence(qa_new, pa)
-
-        # Mask out padding positions.
-        KL = torch.where(seq_mask_x.unsqueeze(-1).transpose(1, 2), KL, KL.new([0.]))
-        KL = torch.where(seq_mask_y.unsqueeze(-1), KL, KL.new([0.]))
-
-        # Sum for all independent latent alignment variables.
-        KL = KL.sum(dim=-1).sum(dim=-1) # [B]
+        KL = self.kl_divergence(qa_new, pa, seq_mask_x, seq_mask_y, cells) # [B]
 
         # Compute the surrogate loss.
         ppo_loss = torch.max(-reward * ratio, -reward * ratio_c).mean() + KL * KL_multiplier
@@ -1,11 +1,10 @@
 import torch
 import numpy as np
 
-from torch.utils.data import DataLoader
-
-from alignments.train_utils import alignment_summary
-from alignments.aer import AERSufficientStatistics
-from alignments.data import PAD_TOKEN, create_batch
+from alignments.train_utils import create_validation_cache, fast_validation
+from alignments.train_utils import example_alignment, print_example_alignment
+from alignments.aer import ValidationStatistics
+from alignments.data import PAD_TOKEN, ValidationCache
 from alignments.models import NeuralIBM1
 
 def create_model(hparams, vocab_src, vocab_tgt):
@@ -13,39 +12,27 @@ def create_model(hparams, vocab_src, vocab_tgt):
                        tgt_vocab_size=vocab_tgt.size(),
                        emb_size=hparams.emb_size,
                        hidden_size=hparams.hidden_size,
-                       pad_idx=vocab_src[PAD_TOKEN])
+                       pad_idx=vocab_src[PAD_TOKEN],
+                       sparse_embeddings=hparams.sparse_embeddings)
 
     return model
 
 def train_step(model, x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y, hparams, step,
                summary_dict, summary_writer=None):
     py_given_x = model(x, seq_mask_x, seq_len_x, y)
-    loss = model.loss(py_given_x, y, reduction="mean")
+    loss = model.loss(py_given_x, y, seq_mask_y, reduction="mean")
     return {"loss": loss}
 
-def validate(model, val_data, gold_alignments, vocab_src, vocab_tgt, device,
-             hparams, step, summary_writer=None):
-    model.eval()
-
-    # Load the validation data.
-    val_dl = DataLoader(val_data, shuffle=False, batch_size=hparams.batch_size,
-                        num_workers=4)
-
-    num_sentences = 0
-    num_predictions = 0
-    total_NLL = 0.
-    total_correct_predictions = 0
+def validation_statistics(model, val_data, hparams, fast=False):
+    """
+    Aligns the sentence pairs of a ValidationCache and sums the validation metrics. Returns
+    the ValidationStatistics and the alignments in the order of the validation batches. With
+    fast = True only the alignments and their AER statistics are computed.
+    """
+    statistics = ValidationStatistics()
     alignments = []
     with torch.no_grad():
-        for sen_x, sen_y in val_dl:
-            x, seq_mask_x, seq_len_x = create_batch(sen_x, vocab_src, device, include_null=True)
-            y, seq_mask_y, seq_len_y = create_batch(sen_y, vocab_tgt, device)
-
-            py_given_x = model(x, seq_mask_x, seq_len_x, y)
-            batch_NLL = model.loss(py_given_x, y, reduction="sum")
-            total_NLL += batch_NLL.item()
-            num_sentences += x.size(0)
-            num_predictions += seq_len_y.sum().item()
+        for x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y in val_data.batches:
 
             # Compute the alignments.
             batch_alignments = model.align(x, y)
@@ -55,24 +42,40 @@ def validate(model, val_data, gold_alignments, vocab_src, vocab_tgt, device,
                     if aj > 0:
                         links.add((aj, j)) # TODO this only works for 1 direction now.
                 alignments.append(links)
+            if fast:
+                continue
+
+            py_given_x = model(x, seq_mask_x, seq_len_x, y)
+            batch_NLL = model.loss(py_given_x, y, seq_mask_y, reduction="sum")
+            statistics.total_NLL += batch_NLL.item()
+            statistics.num_sentences += x.size(0)
+            statistics.num_predictions += seq_len_y.sum().item()
 
             # Statistics for accuracy tracking.
             predictions = torch.argmax(py_given_x, dim=-1, keepdim=False)
             correct_predictions = (predictions == y) * seq_mask_y
-            total_correct_predictions += correct_predictions.sum().item()
-
-    # Compute AER.
-    metric = AERSufficientStatistics()
-    for a, gold_a in zip(alignments, gold_alignments):
-        metric.update(sure=gold_a[0], probable=gold_a[1], predicted=a)
-    val_aer = metric.aer()
+            statistics.num_correct_predictions += correct_predictions.sum().item()
+
+    # Compute the AER statistics, the alignments are in the order of the validation batches.
+    for a, gold_a in zip(alignments, val_data.gold_alignments):
+        if gold_a is not None:
+            statistics.aer_statistics.update(sure=gold_a[0], probable=gold_a[1], predicted=a)
+    return statistics, alignments
+
+def report_validation(statistics, example, hparams, step, summary_writer=None):
+    """
+    Prints the validation metrics and an example alignment (a source sentence, target
+    sentence and alignment links triple, or None), writes validation summaries if a summary
+    writer is given and returns the validation AER.
+    """
+    val_aer = statistics.aer_statistics.aer()
 
     # Compute translation accuracy.
-    val_accuracy = float(total_correct_predictions) / num_predictions
+    val_accuracy = float(statistics.num_correct_predictions) / statistics.num_predictions
 
     # Compute NLL and perplexity.
-    val_NLL = total_NLL / num_sentences
-    val_ppl  = np.exp(total_NLL / num_predictions)
+    val_NLL = statistics.total_NLL / statistics.num_sentences
+    val_ppl  = np.exp(statistics.total_NLL / statistics.num_predictions)
 
     # Write validation summaries if a summary writer is given.
     if summary_writer is not None:
@@ -86,18 +89,27 @@ def validate(model, val_data, gold_alignments, vocab_src, vocab_tgt, device,
           f" -- validation ppl = {val_ppl:,.2f} -- validation AER = {val_aer:,.2f}")
 
     # Print / plot a sample alignment.
-    sen_idx = hparams.example_sentence_idx
-    sen_x, sen_y = val_data[sen_idx]
-    sen_a = list(sorted(alignments[sen_idx], key=lambda link: link[1]))
-    tokens_x = sen_x.split()
-    tokens_y = sen_y.split()
-    print(f"Source sentence: {sen_x}\nTarget sentence: {sen_y}")
-    if len(sen_a) == 0:
-        print(" - no alignments")
-    else:
-        for link in sen_a:
-            print(f" - {tokens_y[link[1]-1]} is aligned to {tokens_x[link[0]-1]}")
-    if summary_writer is not None:
-        alignment_summary(tokens_x, tokens_y, sen_a, summary_writer, "validation/alignment", step)
+    if example is not None:
+        print_example_alignment(*example, step, summary_writer)
 
     return val_aer
+
+def validate(model, val_data, gold_alignments, vocab_src, vocab_tgt, device,
+             hparams, step, summary_writer=None, fast=False):
+    """
+    Returns the validation AER. With fast = True only the alignments are computed, and the
+    AER and the bounds of its bootstrap confidence interval are returned, see
+    fast_validation.
+    """
+    model.eval()
+
+    # Create the validation batches, unless they are cached already.
+    if not isinstance(val_data, ValidationCache):
+        val_data = create_validation_cache(val_data, gold_alignments, vocab_src, vocab_tgt,
+                                           device, hparams)
+
+    statistics, alignments = validation_statistics(model, val_data, hparams, fast=fast)
+    if fast:
+        return fast_validation(alignments, val_data, hparams, step, summary_writer)
+    example = example_alignment(val_data, alignments, hparams.example_sentence_idx)
+    return report_validation(statistics, example, hparams, step, summary_writer)
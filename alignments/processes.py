@@ -0,0 +1,19 @@
+import os
+
+def process_tree(pid):
+    """
+    Returns the ids of a process and all of its live descendants, which are found through
+    /proc/<pid>/task/<tid>/children. Raises an OSError if /proc is not available or the
+    process has exited.
+    """
+    pids = []
+    pending = [pid]
+    while pending:
+        cur_pid = pending.pop()
+        pids.append(cur_pid)
+        for task in os.listdir(f"/proc/{cur_pid}/task"):
+            children_file = f"/proc/{cur_pid}/task/{task}/children"
+            if os.path.exists(children_file):
+                with open(children_file) as f:
+                    pending += [int(child) for child in f.read().split()]
+    return pids
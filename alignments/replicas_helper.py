@@ -0,0 +1,158 @@
+import copy
+import torch
+import numpy as np
+
+from collections import defaultdict
+from pathlib import Path
+
+import alignments.neuralibm1_helper as neuralibm1_helper
+import alignments.alignmentvae_helper as alignmentvae_helper
+
+from alignments.models import Replicas
+
+def replica_helper(hparams):
+    """
+    Returns the helper module of the model that is replicated.
+    """
+    return neuralibm1_helper if hparams.model_type == "neuralibm1" else alignmentvae_helper
+
+def replica_values(values, default, num_replicas, name):
+    """
+    Parses a comma-separated value for each replica, or returns default for all replicas.
+    """
+    if values is None:
+        return [default] * num_replicas
+    values = [float(value) for value in values.split(",") if value.strip()]
+    if len(values) != num_replicas:
+        raise Exception(f"{name} should have a value for each of the {num_replicas} replicas")
+    return values
+
+def create_model(hparams, vocab_src, vocab_tgt):
+    if hparams.model_type not in ["neuralibm1", "bernoulli-RF", "bernoulli-ST"]:
+        raise Exception(f"num_replicas > 1 is not supported for {hparams.model_type}")
+    if hparams.model_type != "neuralibm1" and hparams.encoder_type == "rnn":
+        raise Exception("num_replicas > 1 requires encoder_type conv or attention, RNN encoders"
+                        " cannot be vectorized with vmap")
+    if hparams.PPO_steps > 0 or hparams.chunk_size > 0 or hparams.band_width >= 0 or \
+            hparams.num_candidates > 0 or hparams.compile or hparams.sparse_embeddings or \
+            hparams.checkpoint_activations or hparams.fast_eval_size > 0:
+        raise Exception("num_replicas > 1 cannot be combined with PPO_steps, chunk_size,"
+                        " band_width, num_candidates, compile, sparse_embeddings,"
+                        " checkpoint_activations or fast_eval_size")
+
+    # The replicas share all non-tensor attributes of the first replica, so the prior
+    # parameters can differ in value but not in which of them is used.
+    prior_params_1 = replica_values(hparams.replica_prior_param_1, hparams.prior_param_1,
+                                    hparams.num_replicas, "replica_prior_param_1")
+    prior_params_2 = replica_values(hparams.replica_prior_param_2, hparams.prior_param_2,
+                                    hparams.num_replicas, "replica_prior_param_2")
+    for prior_params in [prior_params_1, prior_params_2]:
+        if len(set(value > 0 for value in prior_params)) > 1:
+            raise Exception("The prior parameters of all replicas should either all be > 0 or"
+                            " all be <= 0")
+
+    replicas = []
+    for prior_param_1, prior_param_2 in zip(prior_params_1, prior_params_2):
+        replica_hparams = copy.copy(hparams)
+        replica_hparams.prior_param_1 = prior_param_1
+        replica_hparams.prior_param_2 = prior_param_2
+        replicas.append(replica_helper(hparams).create_model(replica_hparams, vocab_src,
+                                                             vocab_tgt))
+    return Replicas(replicas)
+
+def train_step(model, x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y, hparams, step,
+               summary_dict, summary_writer=None):
+    helper = replica_helper(hparams)
+
+    # Run the training step of all replicas at once, the summaries of each replica are kept
+    # below instead.
+    def replica_step(replica):
+        output_dict = helper.train_step(replica, x, seq_mask_x, seq_len_x, y, seq_mask_y,
+                                        seq_len_y, hparams, step, defaultdict(lambda: 0.))
+        return {name: output_dict[name] for name in ["loss", "KL", "ELBO", "reward",
+                                                     "reward_sc"] if name in output_dict}
+    output_dict = model.vmap(replica_step)
+
+    # Sum the losses, such that each replica gets the gradient of its own loss.
+    losses = output_dict["loss"]
+    output_dict["loss"] = losses.sum()
+
+    # Keep track of the training summary statistics of each replica.
+    summary_dict["num_sentences"] += x.size(0)
+    summary_dict["loss"] += losses.detach() * x.size(0)
+    for name in ["KL", "ELBO"]:
+        if name in output_dict:
+            summary_dict[name] += output_dict[name].detach().reshape(model.num_replicas,
+                                                                      -1).sum(dim=-1)
+
+    # Summarize if the summary writer is given.
+    if summary_writer is not None:
+        num_sentences = summary_dict["num_sentences"]
+        for name in ["loss", "KL", "ELBO"]:
+            if name in summary_dict:
+                for idx, value in enumerate(summary_dict[name].tolist()):
+                    summary_writer.add_scalar(f"train/replica{idx}/{name}",
+                                              value / num_sentences, step)
+
+    return output_dict
+
+def save_replica(replica, idx, hparams):
+    """
+    Saves a replica as a model of its own to output_dir/replica{idx}, its parameters to
+    model.pt and hyperparameters with its own prior parameters to hparams, such that it can
+    be evaluated with alignments.eval --output_dir output_dir/replica{idx}.
+    """
+    replica_dir = Path(hparams.output_dir) / f"replica{idx}"
+    replica_dir.mkdir(parents=True, exist_ok=True)
+
+    # The replica is a view of the stacked parameters, save copies of its own slice.
+    state_dict = {name: tensor.clone() for name, tensor in replica.state_dict().items()}
+    torch.save(state_dict, replica_dir / "model.pt")
+
+    prior_params_1 = replica_values(hparams.replica_prior_param_1, hparams.prior_param_1,
+                                    hparams.num_replicas, "replica_prior_param_1")
+    prior_params_2 = replica_values(hparams.replica_prior_param_2, hparams.prior_param_2,
+                                    hparams.num_replicas, "replica_prior_param_2")
+    values = {"output_dir": str(replica_dir), "num_replicas": 1, "replica_prior_param_1": None,
+              "replica_prior_param_2": None, "prior_param_1": prior_params_1[idx],
+              "prior_param_2": prior_params_2[idx], "model_checkpoint": None}
+
+    # The vocabularies stay in the output directory of the training run, which saves
+    # created vocabularies as separate source and target files.
+    if hparams.vocab_prefix is not None:
+        vocab_prefix = Path(hparams.vocab_prefix).resolve()
+        values["vocab_prefix"] = str(vocab_prefix)
+        if vocab_prefix == (Path(hparams.output_dir) / "vocab").resolve():
+            values["share_vocab"] = False
+    replica_hparams = copy.deepcopy(hparams)
+    replica_hparams.update(values)
+    replica_hparams.save(replica_dir / "hparams")
+
+def validate(model, val_data, gold_alignments, vocab_src, vocab_tgt, device,
+             hparams, step, summary_writer=None):
+    """
+    Validates each replica and saves the best model of each, see save_replica. Returns the
+    mean AER of the replicas.
+    """
+    helper = replica_helper(hparams)
+    val_aers = []
+    for idx, replica in enumerate(model.replicas):
+        print(f"Replica {idx}:")
+        val_aer = helper.validate(replica, val_data, gold_alignments, vocab_src, vocab_tgt,
+                                  device, hparams, step, summary_writer=None)
+        val_aers.append(val_aer)
+        model.val_aer[idx] = val_aer
+        if summary_writer is not None:
+            summary_writer.add_scalar(f"validation/replica{idx}/AER", val_aer, step)
+
+        # Keep the best model of every replica.
+        if val_aer < model.best_aer[idx]:
+            model.best_aer[idx] = val_aer
+            save_replica(replica, idx, hparams)
+
+    mean_aer = float(np.mean(val_aers))
+    print(f"validation AER of the replicas: mean = {mean_aer:,.2f} -- min ="
+          f" {min(val_aers):,.2f} -- max = {max(val_aers):,.2f}")
+    if summary_writer is not None:
+        summary_writer.add_scalar("validation/AER", mean_aer, step)
+    return mean_aer
@@ -0,0 +1,253 @@
+"""
+Trains a sweep of hyperparameter configurations in parallel, and drops the worst ones early
+with successive halving on the validation AER.
+
+The data is read, the vocabularies are built and the training sentences are encoded as word
+ids only once, and the encoded training data is kept in shared memory that all training
+processes read from. Up to sweep_parallel configurations are trained at the same time, each
+in its own process pinned to its own set of cores. All configurations are first trained for
+sweep_min_epochs epochs, after which the best 1/sweep_halving_rate by validation AER continue
+training for sweep_halving_rate times as many epochs, and so on until num_epochs. Every
+configuration is trained in output_dir/<name>, and a table of the results of all
+configurations is written to output_dir/sweep_results.txt and output_dir/sweep_results.json.
+
+usage: python -m alignments.sweep --sweep_file sweep.json --output_dir experiments/sweep \
+                                  --num_epochs 9 [other training options]
+
+with for example the sweep file:
+
+    {"grid": {"prior_param_1": [0.5, 1.0, 2.0], "learning_rate": [0.001, 0.0003]},
+     "configs": [{"model_type": "neuralibm1"}]}
+"""
+import itertools
+import json
+import math
+import os
+import queue
+import sys
+import traceback
+import torch
+import torch.multiprocessing as multiprocessing
+
+from pathlib import Path
+
+from alignments.data import PAD_TOKEN, TokenizedParallelDataset
+from alignments.hparams import Hyperparameters
+from alignments.models import initialize_model
+from alignments.train import create_model, set_num_threads, train
+from alignments.train_utils import load_data, load_vocabularies, load_lexical_table
+from alignments.train_utils import create_optimizer, compile_model, create_validation_cache
+from alignments.train_utils import core_sets
+
+# The hyperparameters that determine the data and vocabularies, which are loaded once for all
+# configurations and can therefore not be overridden by a configuration.
+DATA_HPARAMS = ["training_prefix", "validation_prefix", "src", "tgt", "max_sentence_length",
+                "min_sentence_length", "max_vocabulary_size", "vocab_min_freq", "share_vocab",
+                "vocab_prefix", "dataset_storage"]
+
+def expand_configs(sweep):
+    """
+    Returns the hyperparameter overrides of all configurations in a sweep: every
+    combination of the values in sweep["grid"] followed by the configurations in
+    sweep["configs"]. Configurations cannot override the DATA_HPARAMS.
+    """
+    configs = []
+    grid = sweep.get("grid", {})
+    if len(grid) > 0:
+        names = list(grid.keys())
+        for values in itertools.product(*[grid[name] for name in names]):
+            configs.append(dict(zip(names, values)))
+    configs += sweep.get("configs", [])
+    if len(configs) == 0:
+        raise Exception("The sweep file contains no configurations.")
+    for config in configs:
+        data_hparams = [name for name in config if name in DATA_HPARAMS]
+        if len(data_hparams) > 0:
+            raise Exception(f"The data is shared by all configurations of a sweep, so they"
+                            f" cannot override {', '.join(data_hparams)}")
+    return configs
+
+def load_shared_data(hparams, out_dir):
+    """
+    Loads the data and vocabularies once for all configurations, and moves the encoded
+    training data to shared memory.
+    """
+    vocab_src, vocab_tgt = load_vocabularies(hparams)
+    if hparams.vocab_prefix is None:
+        if hparams.share_vocab:
+            vocab_src.save(out_dir / "vocab")
+        else:
+            vocab_src.save(out_dir / f"vocab.{hparams.src}")
+            vocab_tgt.save(out_dir / f"vocab.{hparams.tgt}")
+        hparams.update({"vocab_prefix": str(out_dir / "vocab")})
+
+    train_data, val_data, val_alignments = load_data(hparams)
+    train_data = TokenizedParallelDataset(train_data, vocab_src, vocab_tgt).share_memory_()
+    return train_data, val_data, val_alignments, vocab_src, vocab_tgt
+
+def run_config(hparams, run, num_epochs, cores, data, results):
+    """
+    Trains a configuration up to epoch num_epochs on the given cores, continuing from its
+    last checkpoint if there is one, and puts its training state in the results queue.
+    """
+    run_dir = Path(hparams.output_dir) / run["name"]
+    run_dir.mkdir(parents=True, exist_ok=True)
+    sys.stdout = sys.stderr = open(run_dir / "train.log", "a", buffering=1)
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        hparams.update(dict(run["config"], output_dir=str(run_dir), num_threads=len(cores),
+                            num_epochs=num_epochs, patience=0))
+        set_num_threads(hparams)
+
+        train_data, val_data, val_alignments, vocab_src, vocab_tgt = data
+        model, train_fn, validate_fn = create_model(hparams, vocab_src, vocab_tgt)
+        device = torch.device("cuda:0") if hparams.use_gpu else torch.device("cpu")
+        model = model.to(device)
+        optimizer, lr_scheduler = create_optimizer(model, hparams)
+        val_data = create_validation_cache(val_data, val_alignments, vocab_src, vocab_tgt,
+                                           device, hparams)
+
+        checkpoint_file = run_dir / "checkpoint.pt"
+        if checkpoint_file.exists():
+            checkpoint = torch.load(checkpoint_file)
+            model.load_state_dict(checkpoint["model"])
+            optimizer.load_state_dict(checkpoint["optimizer"])
+            lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+            state = checkpoint["state"]
+        else:
+            if hparams.model_checkpoint is None:
+                initialize_model(model, vocab_tgt[PAD_TOKEN], hparams.cell_type,
+                                 hparams.emb_init_scale)
+                if hparams.num_candidates > 0:
+                    lexical_table = load_lexical_table(hparams, train_data, vocab_src,
+                                                       vocab_tgt)
+                    model.lexical_table.load_state_dict(lexical_table.state_dict())
+            else:
+                model.load_state_dict(torch.load(hparams.model_checkpoint))
+            hparams.save(run_dir / "hparams")
+            state = None
+
+        if hparams.compile:
+            compile_model(model, hparams.compile_cache_size)
+        state = train(model, optimizer, lr_scheduler, train_data, val_data, val_alignments,
+                      vocab_src, vocab_tgt, device, run_dir, train_fn, validate_fn, hparams,
+                      state=state)
+        torch.save({"model": model.state_dict(), "optimizer": optimizer.state_dict(),
+                    "lr_scheduler": lr_scheduler.state_dict(), "state": state},
+                   checkpoint_file)
+        results.put({"name": run["name"], "state": state})
+    except Exception as e:
+        traceback.print_exc()
+        results.put({"name": run["name"], "error": repr(e)})
+
+def run_rung(hparams, runs, num_epochs, data, context):
+    """
+    Trains all runs up to epoch num_epochs, at most sweep_parallel at a time.
+    """
+    num_parallel = hparams.sweep_parallel if hparams.sweep_parallel > 0 \
+            else (os.cpu_count() or 1)
+    slots = core_sets(min(num_parallel, len(runs)))
+    free_slots = list(range(len(slots)))
+    pending = list(runs)
+    running = {}
+    results = context.Queue()
+    runs_by_name = {run["name"]: run for run in runs}
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(free_slots) > 0:
+            run = pending.pop(0)
+            slot = free_slots.pop(0)
+            process = context.Process(target=run_config, args=(hparams, run, num_epochs,
+                                                               slots[slot], data, results))
+            process.start()
+            running[run["name"]] = (process, slot)
+
+        try:
+            result = results.get(timeout=1.)
+        except queue.Empty:
+
+            # A process that exits with an error code died before it could report.
+            for name, (process, slot) in list(running.items()):
+                if not process.is_alive() and process.exitcode != 0:
+                    result = {"name": name, "error": f"exit code {process.exitcode}"}
+                    break
+            else:
+                continue
+
+        run = runs_by_name[result["name"]]
+        process, slot = running.pop(run["name"])
+        process.join()
+        free_slots.append(slot)
+        if "error" in result:
+            run["error"] = result["error"]
+            print(f"{run['name']}: failed with {run['error']}, see"
+                  f" {Path(hparams.output_dir) / run['name'] / 'train.log'}")
+        else:
+            run.update(result["state"], num_epochs=num_epochs)
+            print(f"{run['name']}: best validation AER = {run['best_aer']:.3f}"
+                  f" (epoch {run['best_epoch']}) after {num_epochs} epochs")
+
+def write_results(out_dir, runs):
+    """
+    Writes a table of all runs ordered by how far they got and their best validation AER.
+    """
+    runs = sorted(runs, key=lambda run: ("error" in run, -run.get("num_epochs", 0),
+                                         run.get("best_aer", math.inf)))
+    lines = [f"{'name':10}{'epochs':>8}{'best AER':>10}{'best epoch':>12}  config"]
+    for run in runs:
+        config = json.dumps(run["config"], sort_keys=True)
+        if "error" in run:
+            lines.append(f"{run['name']:10}{'failed':>8}{'':>10}{'':>12}  {config}")
+        else:
+            lines.append(f"{run['name']:10}{run['num_epochs']:>8}{run['best_aer']:>10.3f}"
+                         f"{run['best_epoch']:>12}  {config}")
+    with open(out_dir / "sweep_results.txt", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    with open(out_dir / "sweep_results.json", "w") as f:
+        json.dump(runs, f, indent=4)
+    return lines
+
+def main(hparams):
+    print("\n==== Hyperparameters")
+    hparams.print_values()
+    if hparams.sweep_file is None:
+        raise Exception("A sweep needs a sweep_file.")
+    if hparams.sweep_halving_rate < 2:
+        raise Exception("sweep_halving_rate should be at least 2.")
+    with open(hparams.sweep_file) as f:
+        configs = expand_configs(json.load(f))
+    out_dir = Path(hparams.output_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    runs = [{"name": f"run{idx:03d}", "config": config} for idx, config in enumerate(configs)]
+
+    print("\n==== Data")
+    data = load_shared_data(hparams, out_dir)
+    print(f"Training data: {len(data[0]):,} bilingual sentence pairs")
+    print(f"Validation data: {len(data[1]):,} bilingual sentence pairs")
+
+    # Spawn fresh processes, such that the number of threads can be set for each of them.
+    context = multiprocessing.get_context("spawn")
+    num_epochs = min(hparams.sweep_min_epochs, hparams.num_epochs)
+    active = runs
+    while True:
+        print(f"\n==== Training {len(active)} configurations up to epoch {num_epochs}")
+        run_rung(hparams, active, num_epochs, data, context)
+        write_results(out_dir, runs)
+        if num_epochs >= hparams.num_epochs:
+            break
+
+        # Successive halving: only continue with the best configurations.
+        active = sorted([run for run in active if "error" not in run],
+                        key=lambda run: run["best_aer"])
+        active = active[:max(1, len(active) // hparams.sweep_halving_rate)]
+        if len(active) == 0:
+            break
+        num_epochs = min(num_epochs * hparams.sweep_halving_rate, hparams.num_epochs)
+
+    print("\n==== Results")
+    print("\n".join(write_results(out_dir, runs)))
+    print(f"\nWritten to {out_dir / 'sweep_results.txt'}")
+
+if __name__ == "__main__":
+    hparams = Hyperparameters()
+    main(hparams)
@@ -5,20 +5,29 @@ import numpy as np
 
 import alignments.neuralibm1_helper as neuralibm1_helper
 import alignments.alignmentvae_helper as alignmentvae_helper
+import alignments.replicas_helper as replicas_helper
 
 from pathlib import Path
 from torch.utils.data import DataLoader
 from tensorboardX import SummaryWriter
 from collections import defaultdict
 
-from alignments.data import ParallelDataset, PAD_TOKEN, create_batch, BucketingParallelDataLoader
+from alignments.data import ParallelDataset, PAD_TOKEN, BucketingParallelDataLoader
+from alignments.data import collate_sentences, BatchPrefetcher, ValidationCache
 from alignments.hparams import Hyperparameters
 from alignments.train_utils import load_data, load_vocabularies, model_parameter_count
-from alignments.train_utils import create_optimizer, gradient_norm
+from alignments.train_utils import create_optimizer, gradient_norm, clip_gradient_norm_
+from alignments.train_utils import load_lexical_table, dense_gradient_values, compile_model
+from alignments.train_utils import CompileTimer, create_validation_cache
+from alignments.memory import MemoryTracker
 from alignments.models import initialize_model
 
 def create_model(hparams, vocab_src, vocab_tgt):
-    if hparams.model_type == "neuralibm1":
+    if hparams.num_replicas > 1:
+        model = replicas_helper.create_model(hparams, vocab_src, vocab_tgt)
+        train_fn = replicas_helper.train_step
+        validate_fn = replicas_helper.validate
+    elif hparams.model_type == "neuralibm1":
         model = neuralibm1_helper.create_model(hparams, vocab_src, vocab_tgt)
         train_fn = neuralibm1_helper.train_step
         validate_fn = neuralibm1_helper.validate
@@ -32,7 +41,7 @@ def create_model(hparams, vocab_src, vocab_tgt):
     return model, train_fn, validate_fn
 
 def train(model, optimizer, lr_scheduler, train_data, val_data, val_alignments, vocab_src,
-          vocab_tgt, device, out_dir, train_step, validate, hparams):
+          vocab_tgt, device, out_dir, train_step, validate, hparams, state=None):
     """
     :param train_step: function that performs a single training step and returns
                        training loss. Takes as inputs: model, x,
@@ -48,46 +57,88 @@ def train(model, optimizer, lr_scheduler, train_data, val_data, val_alignments,
                      This function should perform all evaluation, write
                      summaries and write any validation metrics to the
                      standard out.
+    :param state: the training state returned by an earlier call to train, to continue
+                  training from. The model, optimizer and learning rate scheduler should be
+                  restored by the caller.
+    :returns: the training state: the step and epoch to continue from, the best validation
+              AER and the step and epoch it was found at.
     """
 
     # Create a dataloader that buckets the batches.
     dl = DataLoader(train_data, batch_size=hparams.batch_size,
-                    shuffle=True, num_workers=4)
+                    shuffle=True, num_workers=hparams.num_workers,
+                    collate_fn=collate_sentences)
     bucketing_dl = BucketingParallelDataLoader(dl)
 
     # Save the best model based on development BLEU.
     best_model_location = out_dir / "model.pt"
-    best_aer = 2.
-    best_step = 0
-    best_epoch = 0
+    if state is None:
+        state = {"step": 0, "epoch_num": 1, "best_aer": 2., "best_step": 0, "best_epoch": 0,
+                 "evaluations_no_improvement": 0}
+    best_aer = state["best_aer"]
+    best_step = state["best_step"]
+    best_epoch = state["best_epoch"]
 
     # Keep track of some stuff in TensorBoard.
     summary_writer = SummaryWriter(log_dir=str(out_dir))
 
-    # Define training statistics to keep track of.
+    # Define training statistics to keep track of. The token count and loss are accumulated
+    # on the device, so that the training loop only synchronizes with it when printing.
     tokens_start = time.time()
-    num_tokens = 0
-    total_train_loss = 0.
+    num_tokens = torch.zeros((), dtype=torch.long, device=device)
+    total_train_loss = torch.zeros((), device=device)
     num_sentences = 0
-    step = 0
-    epoch_num = 1
-    evaluations_no_improvement = 0
+    step = state["step"]
+    epoch_num = state["epoch_num"]
+    evaluations_no_improvement = state["evaluations_no_improvement"]
     train_summary_dict = defaultdict(lambda: 0.)
     num_inf_params = model_parameter_count(model, tag="inf_network")
     num_gen_params = model_parameter_count(model) - num_inf_params
 
+    # With a compiled model, pad the batches to a few lengths to bound the number of shapes
+    # that are compiled.
+    length_buckets = sorted(int(length) for length in hparams.length_buckets.split(",")
+                            if length.strip()) if hparams.compile else None
+    compile_timer = CompileTimer(hparams.compile_cache_size, device)
+    compile_time = 0.
+
+    # Keep track of the memory use per training phase and batch shape if memory_profile is set.
+    memory_tracker = MemoryTracker(vocab_tgt.size(), device, enabled=hparams.memory_profile)
+
+    # With fast_eval_size set, evaluations first score a fixed subsample of the validation data.
+    fast_val_data = None
+    if hparams.fast_eval_size > 0:
+        if not isinstance(val_data, ValidationCache):
+            val_data = create_validation_cache(val_data, val_alignments, vocab_src, vocab_tgt,
+                                               device, hparams)
+        fast_val_data = val_data.subsample(hparams.fast_eval_size)
+
     # Define the evaluation function.
     def run_evaluation():
         nonlocal best_aer, best_epoch, best_step, evaluations_no_improvement
+        model.eval()
+
+        # Only run the full evaluation if the subsample does not rule out an improvement.
+        if fast_val_data is not None:
+            _, lower, _ = validate(model, fast_val_data, fast_val_data.gold_alignments,
+                                   vocab_src, vocab_tgt, device, hparams, step,
+                                   summary_writer=summary_writer, fast=True)
+            if lower >= best_aer:
+                print(f"Skipping the full evaluation, no improvement over the best AER ="
+                      f" {best_aer:.2f}")
+                evaluations_no_improvement += 1
+                return
 
         # Perform model validation, keep track of validation BLEU for model
         # selection.
-        model.eval()
         val_aer = validate(model, val_data, val_alignments, vocab_src, vocab_tgt, device,
                            hparams, step, summary_writer=summary_writer)
 
         # Update the learning rate scheduler.
-        if hparams.lr_reduce_patience >= 0:
+        # The learning rate of every replica is reduced on its own validation AER.
+        if hparams.lr_reduce_patience >= 0 and hparams.num_replicas > 1:
+            lr_scheduler.step(model.val_aer.tolist())
+        elif hparams.lr_reduce_patience >= 0:
             lr_scheduler.step(val_aer)
             if lr_scheduler.cooldown_counter == hparams.lr_reduce_cooldown:
                 print(f"Reduced the learning rate with a factor"
@@ -106,35 +157,54 @@ def train(model, optimizer, lr_scheduler, train_data, val_data, val_alignments,
     # Start the training loop.
     while (epoch_num <= hparams.num_epochs) or (evaluations_no_improvement < hparams.patience):
 
-        # Train for 1 epoch.
-        for sentences_x, sentences_y in bucketing_dl:
+        # Train for 1 epoch, optionally creating the next batches in the background.
+        batches = BatchPrefetcher(bucketing_dl, vocab_src, vocab_tgt, device,
+                                  num_batches=hparams.prefetch_batches,
+                                  include_null=(hparams.model_type == "neuralibm1"),
+                                  length_buckets=length_buckets)
+        while True:
             model.train()
+            memory_tracker.start_step(step)
+            batch = next(batches, None)
+            if batch is None:
+                memory_tracker.abort_step()
+                break
 
             # Perform a forward pass through the model
-            include_null = (hparams.model_type == "neuralibm1")
-            x, seq_mask_x, seq_len_x = create_batch(sentences_x,
-                                                    vocab_src, device,
-                                                    include_null=include_null)
-            y, seq_mask_y, seq_len_y = create_batch(sentences_y,
-                                                    vocab_tgt, device)
+            x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y = batch
             train_sw = summary_writer if (step % hparams.print_every == 0 and step > 0) else None
+            memory_tracker.phase("forward")
+            if hparams.compile:
+                compile_timer.start_step(x, y)
             train_output = train_step(model, x, seq_mask_x, seq_len_x,
                               y, seq_mask_y, seq_len_y, hparams, step,
                               train_summary_dict, summary_writer=train_sw)
             loss = train_output["loss"]
 
             # Backpropagate.
+            memory_tracker.phase("backward")
             loss.backward()
+            if hparams.compile:
+                compile_timer.end_step()
 
             # Update statistics.
-            num_tokens += (seq_len_x.sum() + seq_len_y.sum()).item()
+            num_tokens += seq_len_x.sum() + seq_len_y.sum()
             num_sentences += x.size(0)
-            total_train_loss += loss.item() * x.size(0)
+            total_train_loss += loss.detach() * x.size(0)
 
             # Print training stats every now and again.
             if step % hparams.print_every == 0:
                 elapsed = time.time() - tokens_start
-                tokens_per_sec = num_tokens / elapsed if step != 0 else 0
+                train_loss = total_train_loss.item() / num_sentences
+
+                # Don't count the time spent compiling for the throughput.
+                compile_info = ""
+                if hparams.compile:
+                    elapsed -= compile_timer.compile_time - compile_time
+                    compile_time = compile_timer.compile_time
+                    compile_info = f" -- compiled {len(compile_timer.shapes)} batch shapes in" \
+                                   f" {compile_time:,.1f}s"
+                tokens_per_sec = num_tokens.item() / elapsed if step != 0 else 0
 
                 # Compute some gradient statistics.
                 grad_norm = gradient_norm(model)
@@ -145,36 +215,43 @@ def train(model, optimizer, lr_scheduler, train_data, val_data, val_alignments,
                     avg_gen_grad_norm = gen_grad_norm / num_gen_params
 
                 print(f"({epoch_num}) step {step}: "
-                       f"training loss = {total_train_loss/num_sentences:,.2f} -- "
+                       f"training loss = {train_loss:,.2f} -- "
                        f"{tokens_per_sec:,.0f} tokens/s -- "
-                       f"gradient norm (unclipped) = {grad_norm:.2f}")
+                       f"gradient norm (unclipped) = {grad_norm:.2f}{compile_info}")
 
                 # Don't add a summary for the first step.
                 if step > 0:
-                    summary_writer.add_scalar("train/loss",
-                                              total_train_loss/num_sentences, step)
+                    summary_writer.add_scalar("train/loss", train_loss, step)
                     summary_writer.add_scalar("train/unclipped_grad_norm", grad_norm, step)
                     if num_inf_params > 0:
                         summary_writer.add_scalar("train/avg_inf_grad_norm", avg_inf_grad_norm, step)
                         summary_writer.add_scalar("train/avg_gen_grad_norm", avg_gen_grad_norm, step)
 
                 # Reset statistics.
-                num_tokens = 0
+                num_tokens.zero_()
                 tokens_start = time.time()
-                total_train_loss = 0.
+                total_train_loss.zero_()
                 num_sentences = 0
 
             # Clip the gradients and take a gradient step.
+            memory_tracker.phase("optimizer")
             if hparams.max_gradient_norm > 0:
-                nn.utils.clip_grad_norm_(model.parameters(),
-                                         hparams.max_gradient_norm)
-            optimizer.step()
+                # The gradients of replicas are clipped independently.
+                if hparams.num_replicas > 1:
+                    model.clip_gradient_norm_(hparams.max_gradient_norm)
+                else:
+                    clip_gradient_norm_(model.parameters(), hparams.max_gradient_norm)
+            if hparams.num_replicas > 1:
+                lr_scheduler.step_optimizer()
+            else:
+                optimizer.step()
 
             # Zero the gradient buffer.
             optimizer.zero_grad()
 
             # Do aditional updates of the inference network using PPO.
             if hparams.model_type == "bernoulli-RF" and hparams.PPO_steps > 0:
+                memory_tracker.phase("ppo")
                 A = train_output["A"]
                 pa = train_output["pa"]
                 KL_multiplier = train_output["KL_multiplier"]
@@ -188,8 +265,7 @@ def train(model, optimizer, lr_scheduler, train_data, val_data, val_alignments,
                                                 log_py_xa=log_py_xa, eps=hparams.PPO_eps,
                                                 KL_multiplier=KL_multiplier, reward=reward)
                     if hparams.max_gradient_norm > 0:
-                        nn.utils.clip_grad_norm_(model.parameters(),
-                                                 hparams.max_gradient_norm)
+                        clip_gradient_norm_(model.parameters(), hparams.max_gradient_norm)
                     optimizer.step()
                     optimizer.zero_grad()
 
@@ -209,6 +285,7 @@ def train(model, optimizer, lr_scheduler, train_data, val_data, val_alignments,
 
                 # Update the running average baselines.
                 model.update_baselines(reward, seq_len_y)
+            memory_tracker.end_step(x.size(0), x.size(1), y.size(1))
 
             # Run evaluation every evaluate_every steps if set.
             if hparams.evaluate_every > 0 and step > 0 and step % hparams.evaluate_every == 0:
@@ -225,30 +302,40 @@ def train(model, optimizer, lr_scheduler, train_data, val_data, val_alignments,
         epoch_num += 1
 
     print(f"Finished training.")
+    if hparams.compile:
+        print(f"Compiled {len(compile_timer.shapes)} batch shapes in"
+              f" {compile_timer.compile_time:,.1f}s")
+    memory_model = memory_tracker.save(out_dir / "memory_profile.json")
+    if memory_model is not None:
+        print(f"Saved the peak memory of {len(memory_tracker.shapes)} batch shapes to"
+              f" {out_dir / 'memory_profile.json'}")
     summary_writer.close()
 
-    # Load the best model and run validation again, make sure to not write
-    # summaries.
-    model.load_state_dict(torch.load(best_model_location))
-    print(f"Loaded best model found at step {best_step} (epoch {best_epoch}).")
-    model.eval()
-    validate(model, val_data, val_alignments, vocab_src, vocab_tgt, device, hparams, step,
-             summary_writer=None)
+    return {"step": step, "epoch_num": epoch_num, "best_aer": best_aer, "best_step": best_step,
+            "best_epoch": best_epoch, "evaluations_no_improvement": evaluations_no_improvement}
 
 def summarize_params(model, summary_writer, step):
     for name, param in model.named_parameters():
+        grad = param.grad.to_dense() if param.grad.is_sparse else param.grad
         summary_writer.add_histogram(f"train/grad_norm/{name}",
-                                     param.grad.norm(2).item(), step)
+                                     dense_gradient_values(param.grad).norm(2).item(), step)
         summary_writer.add_scalar(f"train/grad_mean/{name}",
-                                  param.grad.mean(dim=0).mean(), step)
+                                  grad.mean(dim=0).mean(), step)
         summary_writer.add_scalar(f"train/grad_variance/{name}",
-                                  param.grad.var(dim=0).mean(), step)
+                                  grad.var(dim=0).mean(), step)
+
+def set_num_threads(hparams):
+    if hparams.num_threads > 0:
+        torch.set_num_threads(hparams.num_threads)
+    if hparams.num_interop_threads > 0:
+        torch.set_num_interop_threads(hparams.num_interop_threads)
 
 def main(hparams):
 
     # Print hyperparameter values.
     print("\n==== Hyperparameters")
     hparams.print_values()
+    set_num_threads(hparams)
 
     # Load the data and print some statistics.
     train_data, val_data, val_alignments = load_data(hparams)
@@ -267,10 +354,14 @@ def main(hparams):
 
     # Create the model.
     model, train_fn, validate_fn = create_model(hparams, vocab_src, vocab_tgt)
-    optimizer, lr_scheduler = create_optimizer(model.parameters(), hparams)
+    optimizer, lr_scheduler = create_optimizer(model, hparams)
     device = torch.device("cuda:0") if hparams.use_gpu else torch.device("cpu")
     model = model.to(device)
 
+    # Create the validation batches once for all evaluations.
+    val_data = create_validation_cache(val_data, val_alignments, vocab_src, vocab_tgt, device,
+                                       hparams)
+
     # Print information about the model.
     param_count_M = model_parameter_count(model) / 1e6
     print("\n==== Model")
@@ -286,6 +377,11 @@ def main(hparams):
         print("\nInitializing parameters...")
         initialize_model(model, vocab_tgt[PAD_TOKEN], hparams.cell_type,
                          hparams.emb_init_scale, verbose=True)
+        if hparams.num_candidates > 0:
+            print(f"\nCreating the lexical table from {hparams.lexical_table}...")
+            lexical_table = load_lexical_table(hparams, train_data, vocab_src, vocab_tgt)
+            model.lexical_table.load_state_dict(lexical_table.state_dict())
+            print(f"Lexical table with {lexical_table.keys.numel():,} entries")
     else:
         print(f"\nRestoring model parameters from {hparams.model_checkpoint}...")
         model.load_state_dict(torch.load(hparams.model_checkpoint))
@@ -305,8 +401,18 @@ def main(hparams):
     # Train the model.
     print("\n==== Starting training")
     print(f"Using device: {device}\n")
-    train(model, optimizer, lr_scheduler, train_data, val_data, val_alignments, vocab_src,
-          vocab_tgt, device, out_dir, train_fn, validate_fn, hparams)
+    if hparams.compile:
+        compile_model(model, hparams.compile_cache_size)
+    state = train(model, optimizer, lr_scheduler, train_data, val_data, val_alignments,
+                  vocab_src, vocab_tgt, device, out_dir, train_fn, validate_fn, hparams)
+
+    # Load the best model and run validation again, make sure to not write
+    # summaries.
+    model.load_state_dict(torch.load(out_dir / "model.pt"))
+    print(f"Loaded best model found at step {state['best_step']} (epoch {state['best_epoch']}).")
+    model.eval()
+    validate_fn(model, val_data, val_alignments, vocab_src, vocab_tgt, device, hparams,
+                state["step"], summary_writer=None)
 
 if __name__ == "__main__":
     hparams = Hyperparameters()
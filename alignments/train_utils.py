@@ -1,12 +1,23 @@
+import json
+import os
+import time
+import torch
+import torch.nn as nn
 import torch.optim as optim
+from torch.optim.adam import adam
 import numpy as np
 import sacrebleu
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
-from alignments.data import Vocabulary, ParallelDataset, remove_subword_tokens
-from alignments.aer import read_naacl_alignments
+from pathlib import Path
+
+from alignments.data import Vocabulary, ParallelDataset, ValidationCache, PAD_TOKEN
+from alignments.data import remove_subword_tokens
+from alignments.aer import read_naacl_alignments, sentence_statistics, bootstrap_aer
+from alignments.components import LexicalTable
+from alignments.models import NeuralIBM1
 
 def load_data(hparams):
     train_src = f"{hparams.training_prefix}.{hparams.src}"
@@ -17,11 +28,60 @@ def load_data(hparams):
 
     # Load the parallel datasets.
     training_data = ParallelDataset(train_src, train_tgt, max_length=hparams.max_sentence_length,
-                                    min_length=hparams.min_sentence_length)
-    val_data = ParallelDataset(val_src, val_tgt)
+                                    min_length=hparams.min_sentence_length,
+                                    storage=hparams.dataset_storage)
+    val_data = ParallelDataset(val_src, val_tgt, storage=hparams.dataset_storage)
 
     return training_data, val_data, val_alignments
 
+def create_validation_cache(val_data, val_alignments, vocab_src, vocab_tgt, device, hparams):
+    """
+    Creates the validation batches once, such that they can be reused for every evaluation.
+    """
+    return ValidationCache(val_data, val_alignments, vocab_src, vocab_tgt, device,
+                           hparams.batch_size, include_null=(hparams.model_type == "neuralibm1"))
+
+def fast_validation(alignments, val_data, hparams, step, summary_writer=None):
+    """
+    Computes the AER of the alignments of a validation subsample with a bootstrap confidence
+    interval, prints it and writes summaries if a summary writer is given. Returns the AER
+    and the lower and upper bound of the interval.
+    """
+    statistics = sentence_statistics(alignments, val_data.gold_alignments)
+    val_aer, lower, upper = bootstrap_aer(statistics, hparams.fast_eval_bootstrap_samples,
+                                          hparams.fast_eval_confidence)
+    if summary_writer is not None:
+        summary_writer.add_scalar("fast_validation/AER", val_aer, step)
+        summary_writer.add_scalar("fast_validation/AER_lower", lower, step)
+        summary_writer.add_scalar("fast_validation/AER_upper", upper, step)
+    print(f"fast AER estimate = {val_aer:.2f} ({hparams.fast_eval_confidence:.0%} CI"
+          f" {lower:.2f} - {upper:.2f}) on {len(statistics):,} sentence pairs")
+    return val_aer, lower, upper
+
+def example_alignment(val_data, alignments, sen_idx):
+    """
+    Returns the source sentence, target sentence and alignment links of sentence pair sen_idx
+    of a ValidationCache, given the alignments in the order of its batches.
+    """
+    sen_x, sen_y = val_data[sen_idx]
+    return sen_x, sen_y, alignments[val_data.positions[sen_idx]]
+
+def print_example_alignment(sen_x, sen_y, links, step, summary_writer=None):
+    """
+    Prints an example alignment, and plots it if a summary writer is given.
+    """
+    sen_a = list(sorted(links, key=lambda link: link[1]))
+    tokens_x = sen_x.split()
+    tokens_y = sen_y.split()
+    print(f"Source sentence: {sen_x}\nTarget sentence: {sen_y}")
+    if len(sen_a) == 0:
+        print(" - no alignments")
+    else:
+        for link in sen_a:
+            print(f" - {tokens_y[link[1]-1]} is aligned to {tokens_x[link[0]-1]}")
+    if summary_writer is not None:
+        alignment_summary(tokens_x, tokens_y, sen_a, summary_writer, "validation/alignment", step)
+
 def load_vocabularies(hparams):
     train_src = f"{hparams.training_prefix}.{hparams.src}"
     train_tgt = f"{hparams.training_prefix}.{hparams.tgt}"
@@ -61,26 +121,232 @@ def load_vocabularies(hparams):
 
     return vocab_src, vocab_tgt
 
-def create_optimizer(parameters, hparams):
-    optimizer = optim.Adam(parameters, lr=hparams.learning_rate)
-
-    # Create the learning rate scheduler.
-    lr_scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer,
-                                                        mode="min", # minimize AER
-                                                        factor=hparams.lr_reduce_factor,
-                                                        patience=hparams.lr_reduce_patience,
-                                                        verbose=False,
-                                                        threshold=1e-2,
-                                                        threshold_mode="abs",
-                                                        cooldown=hparams.lr_reduce_cooldown,
-                                                        min_lr=hparams.min_lr)
+def load_lexical_table(hparams, train_data, vocab_src, vocab_tgt):
+    """
+    Creates the lexical table used to select candidate alignments, either from Dice
+    coefficients on the training data or from a trained neuralibm1 model.
+    """
+    if hparams.lexical_table == "dice":
+        return LexicalTable.from_cooccurrences(train_data, vocab_src, vocab_tgt,
+                                               hparams.lexical_table_size)
+
+    # Restore the neuralibm1 model and its vocabularies from its output directory.
+    model_dir = Path(hparams.lexical_table)
+    with open(model_dir / "hparams") as f:
+        model_hparams = json.load(f)
+    if model_hparams["model_type"] != "neuralibm1":
+        raise Exception(f"Lexical table {model_dir} is not a neuralibm1 model")
+    if model_hparams["vocab_prefix"] is None:
+        vocab_src_file = model_dir / f"vocab.{model_hparams['src']}"
+        vocab_tgt_file = model_dir / f"vocab.{model_hparams['tgt']}"
+    elif model_hparams["share_vocab"]:
+        vocab_src_file = vocab_tgt_file = model_hparams["vocab_prefix"]
+    else:
+        vocab_src_file = f"{model_hparams['vocab_prefix']}.{model_hparams['src']}"
+        vocab_tgt_file = f"{model_hparams['vocab_prefix']}.{model_hparams['tgt']}"
+    model_vocab_src = Vocabulary.from_file(vocab_src_file,
+                                           max_size=model_hparams["max_vocabulary_size"])
+    model_vocab_tgt = Vocabulary.from_file(vocab_tgt_file,
+                                           max_size=model_hparams["max_vocabulary_size"])
+    model = NeuralIBM1(src_vocab_size=model_vocab_src.size(),
+                       tgt_vocab_size=model_vocab_tgt.size(),
+                       emb_size=model_hparams["emb_size"],
+                       hidden_size=model_hparams["hidden_size"],
+                       pad_idx=model_vocab_src[PAD_TOKEN])
+    model.load_state_dict(torch.load(model_dir / "model.pt", map_location="cpu"))
+    model.eval()
+    return LexicalTable.from_neuralibm1(model, vocab_src, vocab_tgt, model_vocab_src,
+                                        model_vocab_tgt, hparams.lexical_table_size)
+
+class LazyAdam(optim.Optimizer):
+    """
+    Adam with a separate parameter group for the parameters with sparse gradients (the sparse
+    embeddings), marked with sparse = True. In that group only the moments and values of the
+    rows that occur in the gradient are updated, like SparseAdam does, so the cost of a step
+    does not depend on the vocabulary size. The other groups get the regular dense Adam
+    update of torch.optim.adam.
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8):
+        defaults = dict(lr=lr, betas=betas, eps=eps, sparse=False)
+        super().__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            if group["sparse"]:
+                self._sparse_step(group)
+            else:
+                self._dense_step(group)
+
+        return loss
+
+    def _state(self, p, step):
+        state = self.state[p]
+        if len(state) == 0:
+            state["step"] = step
+            state["exp_avg"] = torch.zeros_like(p, memory_format=torch.preserve_format)
+            state["exp_avg_sq"] = torch.zeros_like(p, memory_format=torch.preserve_format)
+        return state
+
+    def _dense_step(self, group):
+        params, grads, exp_avgs, exp_avg_sqs, state_steps = [], [], [], [], []
+        for p in group["params"]:
+            if p.grad is None:
+                continue
+            if p.grad.is_sparse:
+                raise Exception("Parameters with sparse gradients should be in a parameter"
+                                " group with sparse = True.")
+            state = self._state(p, torch.tensor(0.))
+            params.append(p)
+            grads.append(p.grad)
+            exp_avgs.append(state["exp_avg"])
+            exp_avg_sqs.append(state["exp_avg_sq"])
+            state_steps.append(state["step"])
+
+        beta1, beta2 = group["betas"]
+        adam(params, grads, exp_avgs, exp_avg_sqs, [], state_steps, amsgrad=False,
+             beta1=beta1, beta2=beta2, lr=group["lr"], weight_decay=0., eps=group["eps"],
+             maximize=False)
+
+    def _sparse_step(self, group):
+        beta1, beta2 = group["betas"]
+        for p in group["params"]:
+            if p.grad is None:
+                continue
+
+            state = self._state(p, 0)
+            state["step"] += 1
+            exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+            step_size = group["lr"] / (1. - beta1 ** state["step"])
+            bias_correction2_sqrt = np.sqrt(1. - beta2 ** state["step"])
+
+            grad = p.grad.coalesce()
+            rows = grad.indices()[0]
+            values = grad.values()
+            exp_avg_rows = exp_avg[rows].mul_(beta1).add_(values, alpha=1. - beta1)
+            exp_avg_sq_rows = exp_avg_sq[rows].mul_(beta2).addcmul_(values, values,
+                                                                    value=1. - beta2)
+            exp_avg[rows] = exp_avg_rows
+            exp_avg_sq[rows] = exp_avg_sq_rows
+            denom = (exp_avg_sq_rows.sqrt() / bias_correction2_sqrt).add_(group["eps"])
+            p.index_add_(0, rows, exp_avg_rows.div_(denom), alpha=-step_size)
+
+def core_sets(num_sets):
+    """
+    Splits the cores this process may run on into num_sets disjoint sets.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    num_sets = min(num_sets, len(cores))
+    return [set(cores_.tolist()) for cores_ in np.array_split(cores, num_sets)]
+
+def create_optimizer(model, hparams):
+    if hparams.sparse_embeddings:
+
+        # The embeddings with sparse gradients get their own parameter group.
+        sparse_params = [module.weight for module in model.modules()
+                         if isinstance(module, nn.Embedding) and module.sparse]
+        sparse_ids = set(id(p) for p in sparse_params)
+        dense_params = [p for p in model.parameters() if id(p) not in sparse_ids]
+        optimizer = LazyAdam([{"params": dense_params},
+                              {"params": sparse_params, "sparse": True}],
+                             lr=hparams.learning_rate)
+    else:
+        optimizer = optim.Adam(model.parameters(), lr=hparams.learning_rate)
+
+    # Create the learning rate scheduler, replicas each have their own.
+    if hparams.num_replicas > 1:
+        lr_scheduler = ReplicaLRScheduler(optimizer, hparams.num_replicas, hparams)
+    else:
+        lr_scheduler = create_lr_scheduler(optimizer, hparams)
     return optimizer, lr_scheduler
 
+def create_lr_scheduler(optimizer, hparams):
+    return optim.lr_scheduler.ReduceLROnPlateau(optimizer,
+                                                mode="min", # minimize AER
+                                                factor=hparams.lr_reduce_factor,
+                                                patience=hparams.lr_reduce_patience,
+                                                verbose=False,
+                                                threshold=1e-2,
+                                                threshold_mode="abs",
+                                                cooldown=hparams.lr_reduce_cooldown,
+                                                min_lr=hparams.min_lr)
+
+class ReplicaLRScheduler:
+    """
+    Reduces the learning rate of every replica of a Replicas model separately when its own
+    validation AER stops improving, with a ReduceLROnPlateau per replica. The replicas
+    share one optimizer over the stacked parameters, so step_optimizer applies the learning
+    rate of each replica as a scale of its slice of the parameter update.
+    """
+
+    def __init__(self, optimizer, num_replicas, hparams):
+        self.optimizer = optimizer
+        self.learning_rate = hparams.learning_rate
+        self.lr_reduce_factor = hparams.lr_reduce_factor
+
+        # Every scheduler keeps the learning rate of its replica in an optimizer of its own.
+        self.lr_schedulers = [create_lr_scheduler(optim.SGD([torch.zeros(1, requires_grad=True)],
+                                                            lr=hparams.learning_rate), hparams)
+                              for _ in range(num_replicas)]
+
+    def learning_rates(self):
+        return [lr_scheduler.optimizer.param_groups[0]["lr"]
+                for lr_scheduler in self.lr_schedulers]
+
+    def step(self, val_aers):
+        """
+        :param val_aers: the validation AER of every replica.
+        """
+        for idx, (lr_scheduler, val_aer) in enumerate(zip(self.lr_schedulers, val_aers)):
+            learning_rate = lr_scheduler.optimizer.param_groups[0]["lr"]
+            lr_scheduler.step(val_aer)
+            if lr_scheduler.optimizer.param_groups[0]["lr"] < learning_rate:
+                print(f"Reduced the learning rate of replica {idx} with a factor"
+                      f" {self.lr_reduce_factor}")
+
+    def step_optimizer(self):
+        """
+        Takes an optimizer step with the learning rate of every replica.
+        """
+        scales = [lr / self.learning_rate for lr in self.learning_rates()]
+        if all(scale == 1. for scale in scales):
+            self.optimizer.step()
+            return
+
+        params = [p for group in self.optimizer.param_groups for p in group["params"]
+                  if p.grad is not None]
+        with torch.no_grad():
+            old_params = [p.detach().clone() for p in params]
+            self.optimizer.step()
+            scales = torch.tensor(scales, device=params[0].device)
+            for p, old_p in zip(params, old_params):
+                p.sub_(old_p).mul_(scales.view([-1] + [1] * (p.dim() - 1))).add_(old_p)
+
+    def state_dict(self):
+        return {"learning_rates": self.learning_rates(),
+                "lr_schedulers": [lr_scheduler.state_dict()
+                                  for lr_scheduler in self.lr_schedulers]}
+
+    def load_state_dict(self, state_dict):
+        for lr_scheduler, learning_rate, scheduler_state in zip(
+                self.lr_schedulers, state_dict["learning_rates"], state_dict["lr_schedulers"]):
+            lr_scheduler.optimizer.param_groups[0]["lr"] = learning_rate
+            lr_scheduler.load_state_dict(scheduler_state)
+
 def model_parameter_count(model, tag=None):
     return sum(p.numel() for name, p in model.named_parameters() if (p.requires_grad and (tag is None or tag in name)))
 
 def gradient_norm(model, tag=None):
-    total_norm = 0.
+    grads = []
     for name, p in model.named_parameters():
         if tag is not None and tag not in name:
             continue
@@ -89,12 +355,104 @@ def gradient_norm(model, tag=None):
             print(f"WARNING: p.grad is None for parameter with size {p.size()}")
             continue
 
-        param_norm = p.grad.data.norm(2)
-        total_norm += param_norm.item() ** 2
+        grads.append(p.grad)
+
+    if len(grads) == 0:
+        return 0.
+    return total_gradient_norm(grads).item()
+
+def dense_gradient_values(grad):
+    """
+    Returns the values of a (possibly sparse) gradient that can be non-zero.
+    """
+    return grad.coalesce().values() if grad.is_sparse else grad
 
-    total_norm = np.sqrt(total_norm)
+def total_gradient_norm(grads):
+    """
+    Returns the 2-norm of all (possibly sparse) gradients together as a 0-dimensional
+    tensor on their device, the norms of the individual gradients are computed with a
+    single foreach kernel where available and nothing is copied to the host.
+    """
+    values = [dense_gradient_values(grad) for grad in grads]
+    if hasattr(torch, "_foreach_norm"):
+        norms = torch._foreach_norm(values, 2)
+    else:
+        norms = [value.norm(2) for value in values]
+    return torch.norm(torch.stack(norms), 2)
+
+def clip_gradient_norm_(parameters, max_norm):
+    """
+    Clips the gradient norm of the parameters like nn.utils.clip_grad_norm_, but also
+    supports sparse gradients. Returns the total norm as a tensor, without synchronizing
+    with the device.
+    """
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if len(grads) == 0:
+        return 0.
+    total_norm = total_gradient_norm(grads)
+    clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+    for grad in grads:
+        grad.mul_(clip_coef.to(grad.device))
     return total_norm
 
+def compile_model(model, cache_size_limit):
+    """
+    Replaces the methods listed in model.compiled_methods (possibly of submodules, e.g.
+    "inf_network.forward") by versions compiled with torch.compile, which are only used in
+    training mode. Each input shape is compiled separately, up to cache_size_limit shapes
+    per method after which new shapes run eagerly.
+    """
+    import torch._dynamo
+    torch._dynamo.config.cache_size_limit = cache_size_limit
+
+    def training_only(module, eager_fn, compiled_fn):
+        def fn(*args, **kwargs):
+            return compiled_fn(*args, **kwargs) if module.training else eager_fn(*args, **kwargs)
+        return fn
+
+    for path in model.compiled_methods:
+        module = model
+        *submodules, name = path.split(".")
+        for submodule in submodules:
+            module = getattr(module, submodule)
+        eager_fn = getattr(module, name)
+        compiled_fn = torch.compile(eager_fn, dynamic=False)
+        setattr(module, name, training_only(module, eager_fn, compiled_fn))
+
+class CompileTimer:
+    """
+    Measures the time spent compiling a model compiled with compile_model. Every batch shape
+    is compiled on its first forward and backward pass, so the training steps on a new batch
+    shape are timed and counted as compile time. Shapes past the cache size limit run eagerly
+    and are not counted.
+    """
+
+    def __init__(self, cache_size_limit, device):
+        self.cache_size_limit = cache_size_limit
+        self.device = device
+        self.shapes = set()
+        self.compile_time = 0.
+        self._start = None
+
+    def start_step(self, *tensors):
+        shape = tuple(tuple(tensor.shape) for tensor in tensors)
+        if shape in self.shapes or len(self.shapes) >= self.cache_size_limit:
+            return
+        self.shapes.add(shape)
+        self._synchronize()
+        self._start = time.time()
+
+    def end_step(self):
+        if self._start is None:
+            return
+        self._synchronize()
+        self.compile_time += time.time() - self._start
+        self._start = None
+
+    def _synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
 def alignment_summary(src_labels, tgt_labels, alignment_links, summary_writer, summary_name,
                       global_step):
     """
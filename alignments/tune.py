@@ -0,0 +1,249 @@
+"""
+Tunes the batch size, the number of DataLoader workers and the number of intra-op and
+inter-op threads of PyTorch for training throughput on this machine.
+
+Each configuration is tried by running short trials of the real training step (forward,
+backward and optimizer step, without PPO updates or compilation) in a fresh process, and
+measuring the tokens/s after a few warm-up steps together with the peak memory of the
+process and its DataLoader workers. The knobs are tuned one at a time, keeping the best
+value found so far for the others. The fastest configuration within the memory ceiling is
+written to the hparams JSON file given by hparams_file, or to output_dir/hparams.
+
+usage: python -m alignments.tune --hparams_file experiments/bernoulli-RF/hparams \
+                                 [--tune_max_memory 8000] [other training options]
+"""
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import time
+import torch
+
+from collections import defaultdict
+from pathlib import Path
+from torch.utils.data import DataLoader
+
+from alignments.data import PAD_TOKEN, create_batch, BucketingParallelDataLoader
+from alignments.data import collate_sentences
+from alignments.hparams import Hyperparameters
+from alignments.models import initialize_model
+from alignments.processes import process_tree
+from alignments.train import create_model, set_num_threads
+from alignments.train_utils import load_data, load_vocabularies, create_optimizer
+from alignments.train_utils import clip_gradient_norm_
+
+# The knobs in the order in which they are tuned.
+KNOBS = ["batch_size", "num_threads", "num_interop_threads", "num_workers"]
+
+def candidate_values(hparams):
+    def parse(values):
+        return [int(value) for value in values.split(",") if value.strip()]
+
+    if hparams.tune_num_threads is not None:
+        num_threads = parse(hparams.tune_num_threads)
+    else:
+        num_cpus = os.cpu_count() or 1
+        num_threads = [2 ** k for k in range(num_cpus.bit_length()) if 2 ** k < num_cpus]
+        num_threads.append(num_cpus)
+    return {"batch_size": parse(hparams.tune_batch_sizes),
+            "num_threads": num_threads,
+            "num_interop_threads": parse(hparams.tune_num_interop_threads),
+            "num_workers": parse(hparams.tune_num_workers)}
+
+def process_tree_peak_rss(pid):
+    """
+    Returns the sum of the peak resident set sizes (in MB) of a process and all of its
+    live descendants, or None if /proc is not available. Memory shared between the
+    processes is counted for each of them, so this is an upper bound.
+    """
+    total = 0.
+    try:
+        for cur_pid in process_tree(pid):
+            with open(f"/proc/{cur_pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1]) / 1024. # In kilobytes.
+    except (OSError, ValueError):
+        return None if total == 0. else total
+    return total
+
+def repeat_batches(dataloader):
+    while True:
+        for batch in dataloader:
+            yield batch
+
+def run_trial(hparams, config, results):
+    """
+    Runs hparams.tune_warmup_steps + hparams.tune_steps training steps with the given
+    configuration and puts the tokens/s and peak memory in the results queue.
+    """
+    for name, value in config.items():
+        setattr(hparams, name, value)
+    set_num_threads(hparams)
+
+    train_data, _, _ = load_data(hparams)
+    vocab_src, vocab_tgt = load_vocabularies(hparams)
+    model, train_fn, _ = create_model(hparams, vocab_src, vocab_tgt)
+    device = torch.device("cuda:0") if hparams.use_gpu else torch.device("cpu")
+    model = model.to(device)
+    optimizer, _ = create_optimizer(model, hparams)
+
+    # An empty lexical table selects the candidates closest to the diagonal, which is just
+    # as fast as a real table.
+    initialize_model(model, vocab_tgt[PAD_TOKEN], hparams.cell_type, hparams.emb_init_scale)
+
+    dl = DataLoader(train_data, batch_size=hparams.batch_size, shuffle=True,
+                    num_workers=hparams.num_workers, collate_fn=collate_sentences)
+    batches = repeat_batches(BucketingParallelDataLoader(dl))
+    include_null = (hparams.model_type == "neuralibm1")
+    num_tokens = torch.zeros((), dtype=torch.long, device=device)
+    summary_dict = defaultdict(float)
+    model.train()
+    for step in range(hparams.tune_warmup_steps + hparams.tune_steps):
+        if step == hparams.tune_warmup_steps:
+            if hparams.use_gpu:
+                torch.cuda.synchronize()
+            num_tokens.zero_()
+            start = time.time()
+
+        sentences_x, sentences_y = next(batches)
+        x, seq_mask_x, seq_len_x = create_batch(sentences_x, vocab_src, device,
+                                                include_null=include_null)
+        y, seq_mask_y, seq_len_y = create_batch(sentences_y, vocab_tgt, device)
+        summary_dict.clear()
+        output = train_fn(model, x, seq_mask_x, seq_len_x, y, seq_mask_y, seq_len_y, hparams,
+                          step, summary_dict, summary_writer=None)
+        output["loss"].backward()
+        if hparams.max_gradient_norm > 0:
+            clip_gradient_norm_(model.parameters(), hparams.max_gradient_norm)
+        optimizer.step()
+        optimizer.zero_grad()
+        if hparams.model_type == "bernoulli-RF":
+            model.update_baselines(output.get("reward_sc", output["reward"]), seq_len_y)
+        num_tokens += seq_len_x.sum() + seq_len_y.sum()
+
+    tokens_per_sec = num_tokens.item() / (time.time() - start)
+    results.put({"tokens_per_sec": tokens_per_sec,
+                 "peak_memory_mb": process_tree_peak_rss(os.getpid())})
+
+def terminate_process_tree(pid):
+    """
+    Terminates a process and all of its live descendants.
+    """
+    try:
+        pids = process_tree(pid)
+    except (OSError, ValueError):
+        pids = [pid]
+    for cur_pid in reversed(pids):
+        try:
+            os.kill(cur_pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+def wait_for_result(trial, results, timeout, max_memory=0):
+    """
+    Waits for the result of a trial process, returns an error if it fails or times out. With
+    max_memory > 0 the peak memory of the trial is checked while it runs, and it is
+    terminated as soon as it exceeds max_memory MB.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            return results.get(timeout=0.2)
+        except queue.Empty:
+            if not trial.is_alive():
+                break
+            peak_memory = process_tree_peak_rss(trial.pid) if max_memory > 0 else None
+            if peak_memory is not None and peak_memory > max_memory:
+                terminate_process_tree(trial.pid)
+                return {"error": "exceeds tune_max_memory", "peak_memory_mb": peak_memory}
+    try:
+        return results.get(timeout=1.)
+    except queue.Empty:
+        return {"error": "failed" if time.time() < deadline else "timed out"}
+
+def tune(hparams):
+    """
+    Tunes the knobs one at a time, returns the best configuration and all trial results.
+    """
+    candidates = candidate_values(hparams)
+    best_config = {"batch_size": hparams.batch_size,
+                   "num_threads": hparams.num_threads if hparams.num_threads > 0 \
+                           else torch.get_num_threads(),
+                   "num_interop_threads": hparams.num_interop_threads \
+                           if hparams.num_interop_threads > 0 else torch.get_num_interop_threads(),
+                   "num_workers": hparams.num_workers}
+    best_result = None
+    trials = {}
+
+    # Spawn a fresh interpreter for every trial, the number of inter-op threads can only be
+    # set once per process.
+    context = multiprocessing.get_context("spawn")
+    for knob in KNOBS:
+        for value in candidates[knob]:
+            config = dict(best_config, **{knob: value})
+            key = tuple(config[name] for name in KNOBS)
+            if key in trials:
+                continue
+
+            results = context.Queue()
+            trial = context.Process(target=run_trial, args=(hparams, config, results))
+            trial.start()
+            result = wait_for_result(trial, results, hparams.tune_trial_timeout,
+                                     hparams.tune_max_memory)
+            trial.join(timeout=10)
+            if trial.is_alive():
+                trial.terminate()
+
+            if "error" not in result and hparams.tune_max_memory > 0 and \
+                    result["peak_memory_mb"] is not None and \
+                    result["peak_memory_mb"] > hparams.tune_max_memory:
+                result["error"] = "exceeds tune_max_memory"
+            trials[key] = dict(config, **result)
+
+            summary = ", ".join(f"{name} = {config[name]}" for name in KNOBS)
+            if "error" in result:
+                print(f"{summary}: {result['error']}")
+                continue
+            memory = "?" if result["peak_memory_mb"] is None \
+                    else f"{result['peak_memory_mb']:,.0f}"
+            print(f"{summary}: {result['tokens_per_sec']:,.0f} tokens/s -- peak memory ="
+                  f" {memory} MB")
+            if best_result is None or result["tokens_per_sec"] > best_result["tokens_per_sec"]:
+                best_config = config
+                best_result = result
+
+    return best_config, best_result, list(trials.values())
+
+def main(hparams):
+    print("\n==== Hyperparameters")
+    hparams.print_values()
+
+    print("\n==== Tuning")
+    best_config, best_result, _ = tune(hparams)
+    if best_result is None:
+        raise Exception("No configuration could be run within the memory ceiling.")
+
+    # Write the best configuration to the hparams JSON file.
+    if hparams.hparams_file is not None:
+        hparams_file = Path(hparams.hparams_file)
+        with open(hparams_file) as f:
+            json_hparams = json.load(f)
+    else:
+        hparams_file = Path(hparams.output_dir) / "hparams"
+        hparams_file.parent.mkdir(parents=True, exist_ok=True)
+        json_hparams = {key: val for key, val in hparams._hparams.items()
+                        if not key.startswith("tune_")}
+    json_hparams.update(best_config)
+    with open(hparams_file, "w") as f:
+        json.dump(json_hparams, f, sort_keys=True, indent=4)
+
+    print("\n==== Best configuration")
+    for name in KNOBS:
+        print(f"{name} = {best_config[name]}")
+    print(f"{best_result['tokens_per_sec']:,.0f} tokens/s, written to {hparams_file}")
+
+if __name__ == "__main__":
+    hparams = Hyperparameters()
+    main(hparams)
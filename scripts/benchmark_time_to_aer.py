@@ -0,0 +1,254 @@
+"""
+Measures wall-clock time (and CPU time) until validation AER reaches a threshold for
+several model types, by running `alignments.train` on generated toy data.
+
+Each run is started as a separate process so that peak memory and CPU time can be
+attributed to it. The validation AER printed by the training script is recorded together
+with the elapsed time, which gives an AER-vs-time curve per run. A comparison report is
+written to the output directory as report.txt, results.json and curves.png.
+
+usage: python scripts/benchmark_time_to_aer.py --output_dir benchmark [--train_size 50000]
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+REPO_DIR = SCRIPTS_DIR.parent
+
+sys.path.insert(0, str(REPO_DIR))
+from alignments.processes import process_tree
+
+# Format: "run_name": command line arguments passed on to alignments.train. The concrete
+# model is left out as it has no prior implemented yet.
+RUNS = {
+    "neuralibm1": ["--model_type", "neuralibm1"],
+    "bernoulli-RF": ["--model_type", "bernoulli-RF", "--prior_param_1", "1.0"],
+    "bernoulli-RF-sc": ["--model_type", "bernoulli-RF", "--prior_param_1", "1.0",
+                        "--cv_self_critic", "True"],
+    "bernoulli-RF-ppo": ["--model_type", "bernoulli-RF", "--prior_param_1", "1.0",
+                         "--PPO_steps", "4"],
+    "bernoulli-RF-sc-ppo": ["--model_type", "bernoulli-RF", "--prior_param_1", "1.0",
+                            "--cv_self_critic", "True", "--PPO_steps", "4"],
+    "bernoulli-ST": ["--model_type", "bernoulli-ST", "--prior_param_1", "1.0"],
+}
+
+AER_PATTERN = re.compile(r"(?:^|-- )validation AER = ([0-9.]+)")
+STEP_PATTERN = re.compile(r"^\(\d+\) step (\d+):")
+
+def generate_data(data_dir, train_size, dev_size):
+    """
+    Generates toy data in the same way as generate_toy_data.sh does.
+    """
+    data_dir.mkdir(parents=True, exist_ok=True)
+    generate = str(SCRIPTS_DIR / "generate_toy_data.py")
+    subprocess.check_call([sys.executable, generate, str(train_size), str(data_dir / "train")])
+    subprocess.check_call([sys.executable, generate, str(dev_size), str(data_dir / "dev")])
+    subprocess.check_call([sys.executable, str(SCRIPTS_DIR / "create_naacl_for_bpe.py"),
+                           str(data_dir / "dev.split"), str(data_dir / "dev.wa.nonullalign")])
+    return data_dir
+
+def process_tree_cpu_time(pid):
+    """
+    Returns the CPU time (user + system, in seconds) used so far by a process and all of
+    its live descendants, or None if /proc is not available.
+    """
+    ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+    total = 0.
+    try:
+        for cur_pid in process_tree(pid):
+            with open(f"/proc/{cur_pid}/stat") as f:
+
+                # The command name can contain spaces, the fields after it are fixed.
+                fields = f.read().rsplit(")", 1)[1].split()
+            utime, stime, cutime, cstime = (int(field) for field in fields[11:15])
+            total += (utime + stime + cutime + cstime) / ticks
+    except (OSError, IndexError, ValueError):
+        return None if total == 0. else total
+    return total
+
+def run_training(name, train_args, data_dir, run_dir, args):
+    """
+    Runs alignments.train and records the validation AER curve.
+    """
+    run_dir.mkdir(parents=True, exist_ok=True)
+    command = [sys.executable, "-u", "-m", "alignments.train",
+               "--training_prefix", str(data_dir / "train"),
+               "--validation_prefix", str(data_dir / "dev"),
+               "--src", "split",
+               "--tgt", "merged",
+               "--output_dir", str(run_dir / "model"),
+               "--num_epochs", str(args.num_epochs),
+               "--patience", str(args.patience),
+               "--evaluate_every", str(args.evaluate_every),
+               "--batch_size", str(args.batch_size),
+               "--print_every", str(args.print_every)] + train_args + args.train_args
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([str(REPO_DIR)] + \
+            ([env["PYTHONPATH"]] if "PYTHONPATH" in env else []))
+
+    print(f"\n==== {name}")
+    print(" ".join(command))
+    curve = []
+    time_to_threshold = None
+    cpu_to_threshold = None
+    step = 0
+    stopped_early = False
+    start = time.time()
+    with open(run_dir / "train.log", "w") as log:
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True, env=env, cwd=str(run_dir))
+        for line in proc.stdout:
+            log.write(line)
+            elapsed = time.time() - start
+
+            # Ignore the re-validation of the best model after training.
+            if line.startswith("Finished training."):
+                break
+
+            step_match = STEP_PATTERN.match(line)
+            if step_match is not None:
+                step = int(step_match.group(1))
+
+            aer_match = AER_PATTERN.search(line)
+            if aer_match is None:
+                continue
+
+            aer = float(aer_match.group(1))
+            cpu_time = process_tree_cpu_time(proc.pid)
+            curve.append({"time": elapsed, "cpu_time": cpu_time, "step": step, "aer": aer})
+            print(f"{elapsed:8.1f}s  step {step:<8} AER = {aer:.3f}")
+            if time_to_threshold is None and aer <= args.threshold:
+                time_to_threshold = elapsed
+                cpu_to_threshold = cpu_time
+                if not args.run_to_completion:
+                    stopped_early = True
+                    proc.terminate()
+                    break
+
+            if args.max_time > 0 and elapsed > args.max_time:
+                stopped_early = True
+                proc.terminate()
+                break
+
+        # Drain the remaining output so the process does not block on a full pipe.
+        for line in proc.stdout:
+            log.write(line)
+
+        # Use wait4 rather than Popen.wait to get the resource usage of this run only.
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+
+    wall_time = time.time() - start
+    return {"name": name,
+            "arguments": train_args + args.train_args,
+            "curve": curve,
+            "threshold": args.threshold,
+            "time_to_threshold": time_to_threshold,
+            "cpu_hours_to_threshold": None if cpu_to_threshold is None else cpu_to_threshold / 3600.,
+            "best_aer": min([point["aer"] for point in curve], default=None),
+            "wall_time": wall_time,
+            "cpu_hours": (rusage.ru_utime + rusage.ru_stime) / 3600.,
+            "peak_rss_mb": rusage.ru_maxrss / 1024., # ru_maxrss is in kilobytes on Linux.
+            "failed": proc.returncode != 0 and not stopped_early}
+
+def format_report(results, args):
+    def fmt(value, spec):
+        return "-" if value is None else format(value, spec)
+
+    lines = [f"Time to validation AER <= {args.threshold}", ""]
+    lines.append(f"{'run':24}{'time (s)':>12}{'CPU-h':>10}{'best AER':>10}"
+                 f"{'total (s)':>12}{'total CPU-h':>13}{'peak RSS (MB)':>15}")
+    for result in sorted(results, key=lambda r: (r["time_to_threshold"] is None,
+                                                 r["time_to_threshold"] or 0.)):
+        name = result["name"] + (" (failed)" if result["failed"] else "")
+        lines.append(f"{name:24}"
+                     f"{fmt(result['time_to_threshold'], '.1f'):>12}"
+                     f"{fmt(result['cpu_hours_to_threshold'], '.4f'):>10}"
+                     f"{fmt(result['best_aer'], '.3f'):>10}"
+                     f"{result['wall_time']:>12.1f}"
+                     f"{result['cpu_hours']:>13.4f}"
+                     f"{result['peak_rss_mb']:>15,.0f}")
+    return "\n".join(lines)
+
+def plot_curves(results, threshold, filename):
+    fig, ax = plt.subplots()
+    for result in results:
+        if len(result["curve"]) == 0:
+            continue
+        ax.plot([point["time"] for point in result["curve"]],
+                [point["aer"] for point in result["curve"]],
+                marker=".", label=result["name"])
+    ax.axhline(threshold, color="grey", linestyle="--")
+    ax.set_xlabel("wall-clock time (s)")
+    ax.set_ylabel("validation AER")
+    ax.legend()
+    plt.tight_layout()
+    fig.savefig(filename)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time-to-target-AER benchmark.")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--data_prefix", type=str, default=None,
+                        help="Directory with existing toy data (train.* and dev.*),"
+                             " if not given toy data is generated.")
+    parser.add_argument("--train_size", type=int, default=50000)
+    parser.add_argument("--dev_size", type=int, default=100)
+    parser.add_argument("--runs", type=str, default=",".join(RUNS.keys()),
+                        help="Comma-separated list of runs out of: " + ", ".join(RUNS.keys()))
+    parser.add_argument("--threshold", type=float, default=0.3,
+                        help="The validation AER to reach.")
+    parser.add_argument("--num_epochs", type=int, default=10)
+    parser.add_argument("--patience", type=int, default=5)
+    parser.add_argument("--evaluate_every", type=int, default=100)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--print_every", type=int, default=100)
+    parser.add_argument("--max_time", type=float, default=-1.,
+                        help="Stop a run after this many seconds, disabled if <= 0.")
+    parser.add_argument("--run_to_completion", action="store_true",
+                        help="Keep training after the threshold has been reached.")
+    parser.add_argument("train_args", nargs=argparse.REMAINDER,
+                        help="Additional arguments for alignments.train, after a `--`.")
+    args = parser.parse_args()
+    if len(args.train_args) > 0 and args.train_args[0] == "--":
+        args.train_args = args.train_args[1:]
+
+    run_names = args.runs.split(",")
+    for name in run_names:
+        if name not in RUNS:
+            raise Exception(f"Unknown run: {name}")
+
+    output_dir = Path(args.output_dir).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if args.data_prefix is None:
+        data_dir = generate_data(output_dir / "data", args.train_size, args.dev_size)
+    else:
+        data_dir = Path(args.data_prefix).resolve()
+
+    results = []
+    for name in run_names:
+        results.append(run_training(name, RUNS[name], data_dir, output_dir / name, args))
+
+        # Write intermediate results, so that they survive an interrupted benchmark.
+        with open(output_dir / "results.json", "w") as f:
+            json.dump(results, f, indent=4)
+
+    report = format_report(results, args)
+    with open(output_dir / "report.txt", "w") as f:
+        f.write(f"{report}\n")
+    plot_curves(results, args.threshold, str(output_dir / "curves.png"))
+    print(f"\n{report}")
+
+if __name__ == "__main__":
+    main()
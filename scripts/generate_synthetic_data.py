@@ -0,0 +1,226 @@
+"""
+Scalable version of generate_toy_data.py for load and scaling tests.
+
+Generates the same kind of data (made up words constructed from a prefix, a root and a
+suffix word piece), but with configurable sentence length distributions, number of roots
+(vocabulary size) and Zipfian root frequencies. Sentences are generated with vectorized
+NumPy operations and written as shards by parallel processes, together with gold NAACL
+alignments like create_naacl_for_bpe.py produces. The output only depends on the seed and
+the shard size, not on the number of processes.
+
+usage: python scripts/generate_synthetic_data.py <dataset_size> <output_file_prefix> [options]
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import shutil
+
+import numpy as np
+
+from generate_toy_data import prefixes, suffixes, eos
+
+onsets = ["d", "z", "b", "g", "k", "t", "p", "s", "f", "v", "n", "l", "r", "m", "h", "j"]
+vowels = ["a", "e", "i", "o", "u"]
+codas = ["m", "n", "k", "t", "s", "l", "r", "x"]
+
+def make_roots(num_roots):
+    """
+    Deterministically constructs num_roots distinct word roots from one or more syllables.
+    """
+    syllables = ["".join(syllable) for syllable in itertools.product(onsets, vowels, codas)]
+    roots = []
+    num_syllables = 1
+    while len(roots) < num_roots:
+        for combination in itertools.product(syllables, repeat=num_syllables):
+            roots.append("".join(combination))
+            if len(roots) == num_roots:
+                break
+        num_syllables += 1
+    return roots
+
+def shard_filename(output_file_prefix, shard_idx, num_shards, extension):
+    if num_shards == 1:
+        return f"{output_file_prefix}.{extension}"
+    return f"{output_file_prefix}.{shard_idx:05d}.{extension}"
+
+class Generator:
+
+    def __init__(self, args):
+        self.args = args
+        roots = make_roots(args.num_roots)
+
+        # Word pieces as object arrays, so that words can be built by vectorized string
+        # concatenation. A piece followed by another piece of the same word gets "@@".
+        self.prefix = np.array(prefixes, dtype=object)
+        self.prefix_split = np.array([f"{p}@@ " if len(p) > 0 else "" for p in prefixes],
+                                     dtype=object)
+        self.has_prefix = np.array([len(p) > 0 for p in prefixes])
+        self.root = np.array(roots, dtype=object)
+        self.root_split = np.array([f"{r}@@ " for r in roots], dtype=object)
+        self.suffix = np.array(suffixes, dtype=object)
+        self.has_suffix = np.array([len(s) > 0 for s in suffixes])
+
+        # Zipfian root probabilities, uniform if the exponent is 0.
+        ranks = np.arange(1, args.num_roots + 1, dtype=np.float64)
+        root_probs = ranks ** -args.zipf_exponent
+        self.root_cdf = np.cumsum(root_probs / root_probs.sum())
+
+    def sample_lengths(self, rng, size):
+        args = self.args
+        if args.length_dist == "uniform":
+            lengths = rng.integers(args.min_length, args.max_length + 1, size=size)
+        elif args.length_dist == "poisson":
+            lengths = rng.poisson(args.mean_length, size=size)
+        elif args.length_dist == "lognormal":
+            mu = np.log(args.mean_length) - 0.5 * args.length_sigma ** 2
+            lengths = np.rint(rng.lognormal(mu, args.length_sigma, size=size)).astype(np.int64)
+        else:
+            raise Exception(f"Unknown length distribution: {args.length_dist}")
+        return np.clip(lengths, args.min_length, args.max_length)
+
+    def generate_chunk(self, rng, size, first_sentence_idx):
+        """
+        Generates size sentence pairs. Returns the merged and split sentences and the
+        NAACL alignment lines for the split -> merged alignments.
+        """
+
+        # Every sentence gets an end-of-sentence word, which is never split.
+        lengths = self.sample_lengths(rng, size) + 1
+        num_words = int(lengths.sum())
+        sentence_ends = np.cumsum(lengths)
+        sentence_starts = sentence_ends - lengths
+        is_eos = np.zeros(num_words, dtype=bool)
+        is_eos[sentence_ends - 1] = True
+
+        p = rng.integers(len(prefixes), size=num_words)
+        r = np.minimum(np.searchsorted(self.root_cdf, rng.random(num_words)),
+                       len(self.root) - 1)
+        s = rng.integers(len(suffixes), size=num_words)
+
+        merged_words = self.prefix[p] + self.root[r] + self.suffix[s]
+        has_suffix = self.has_suffix[s]
+        split_words = self.prefix_split[p] + np.where(has_suffix,
+                                                      self.root_split[r] + self.suffix[s],
+                                                      self.root[r])
+        merged_words[is_eos] = eos
+        split_words[is_eos] = eos
+
+        merged = [" ".join(merged_words[start:end])
+                  for start, end in zip(sentence_starts, sentence_ends)]
+        split = [" ".join(split_words[start:end])
+                 for start, end in zip(sentence_starts, sentence_ends)]
+
+        # Each word piece is aligned to the word it is part of (1-indexed positions).
+        num_pieces = np.where(is_eos, 1, 1 + self.has_prefix[p] + has_suffix)
+        word_sentence = np.repeat(np.arange(size), lengths)
+        word_pos = np.arange(num_words) - sentence_starts[word_sentence] + 1
+        pieces_per_sentence = np.add.reduceat(num_pieces, sentence_starts)
+        piece_sentence_starts = np.cumsum(pieces_per_sentence) - pieces_per_sentence
+        piece_sentence = np.repeat(word_sentence, num_pieces)
+        piece_pos = np.arange(int(num_pieces.sum())) - piece_sentence_starts[piece_sentence] + 1
+        links = np.stack([piece_sentence + first_sentence_idx + 1, piece_pos,
+                          np.repeat(word_pos, num_pieces)], axis=1)
+        return merged, split, links
+
+    def generate_shard(self, shard_idx):
+        args = self.args
+        num_shards = args.num_shards
+        first_sentence_idx = shard_idx * args.shard_size
+        shard_size = min(args.shard_size, args.size - first_sentence_idx)
+        rng = np.random.default_rng(np.random.SeedSequence(args.seed, spawn_key=(shard_idx,)))
+
+        merged_file = open(shard_filename(args.output_file_prefix, shard_idx, num_shards,
+                                          args.tgt), "w")
+        split_file = open(shard_filename(args.output_file_prefix, shard_idx, num_shards,
+                                         args.src), "w")
+        naacl_file = open(shard_filename(args.output_file_prefix, shard_idx, num_shards,
+                                         "wa.nonullalign"), "w") if args.alignments else None
+
+        # Generate the shard in chunks to keep memory usage bounded.
+        for chunk_start in range(0, shard_size, args.chunk_size):
+            chunk_size = min(args.chunk_size, shard_size - chunk_start)
+            merged, split, links = self.generate_chunk(rng, chunk_size,
+                                                       first_sentence_idx + chunk_start)
+            merged_file.write("\n".join(merged) + "\n")
+            split_file.write("\n".join(split) + "\n")
+            if naacl_file is not None:
+                np.savetxt(naacl_file, links, fmt="%d %d %d S")
+
+        merged_file.close()
+        split_file.close()
+        if naacl_file is not None:
+            naacl_file.close()
+        return shard_idx, shard_size
+
+def merge_shards(args):
+    extensions = [args.src, args.tgt] + (["wa.nonullalign"] if args.alignments else [])
+    for extension in extensions:
+        with open(f"{args.output_file_prefix}.{extension}", "wb") as merged_file:
+            for shard_idx in range(args.num_shards):
+                filename = shard_filename(args.output_file_prefix, shard_idx, args.num_shards,
+                                          extension)
+                with open(filename, "rb") as shard_file:
+                    shutil.copyfileobj(shard_file, merged_file)
+                os.remove(filename)
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate sharded synthetic toy data.")
+    parser.add_argument("size", type=int, help="The number of sentence pairs.")
+    parser.add_argument("output_file_prefix", type=str)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shard_size", type=int, default=1000000,
+                        help="The number of sentence pairs per shard.")
+    parser.add_argument("--chunk_size", type=int, default=50000,
+                        help="The number of sentence pairs generated at once.")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="The number of shards written in parallel.")
+    parser.add_argument("--merge", action="store_true",
+                        help="Concatenate the shards into a single file per language.")
+    parser.add_argument("--length_dist", type=str, default="uniform",
+                        choices=["uniform", "poisson", "lognormal"],
+                        help="The distribution of the number of words per sentence.")
+    parser.add_argument("--min_length", type=int, default=1)
+    parser.add_argument("--max_length", type=int, default=9)
+    parser.add_argument("--mean_length", type=float, default=5.,
+                        help="The mean length for the poisson and lognormal distributions.")
+    parser.add_argument("--length_sigma", type=float, default=0.5,
+                        help="The sigma of the lognormal length distribution.")
+    parser.add_argument("--num_roots", type=int, default=10,
+                        help="The number of distinct word roots, this controls the"
+                             " vocabulary size.")
+    parser.add_argument("--zipf_exponent", type=float, default=1.0,
+                        help="Exponent of the Zipfian root distribution, 0 for uniform.")
+    parser.add_argument("--no_alignments", dest="alignments", action="store_false",
+                        help="Do not write gold NAACL alignments.")
+    parser.add_argument("--src", type=str, default="split")
+    parser.add_argument("--tgt", type=str, default="merged")
+    args = parser.parse_args()
+
+    if args.min_length < 1 or args.max_length < args.min_length:
+        raise Exception(f"Invalid sentence lengths: [{args.min_length}, {args.max_length}]")
+    args.num_shards = max(1, -(-args.size // args.shard_size))
+
+    generator = Generator(args)
+    processes = max(1, min(args.processes, args.num_shards))
+    if processes == 1:
+        results = map(generator.generate_shard, range(args.num_shards))
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(generator.generate_shard, range(args.num_shards))
+
+    total = 0
+    for shard_idx, shard_size in results:
+        total += shard_size
+        print(f"Wrote shard {shard_idx+1}/{args.num_shards} -- {total:,}/{args.size:,}"
+              " sentence pairs")
+
+    if processes > 1:
+        pool.close()
+        pool.join()
+
+    if args.merge and args.num_shards > 1:
+        merge_shards(args)
+
+if __name__ == "__main__":
+    main()